@@ -0,0 +1,110 @@
+import argparse
+import os
+import time
+import numpy as np
+import cpu_engine
+from cpu_engine import KERNELS, ParallelEngine
+
+# Benchmark of the element-wise kernels of distributed_ex1.py on the CPU:
+#   python bench_cpu_engine.py --sizes 1000,5000,10000,20000 --workers 1,2,4
+# For every N, compares the Python double loop of add_cpu (up to --loop-max),
+# plain NumPy expressions (a + b, allocating the result), NumPy with out=,
+# cache-blocked tiles (forced, even for single-pass kernels) and
+# ParallelEngine with each number of workers.
+# Throughput is the bytes read and written per second (every operand once),
+# from the best of --repeat runs. Sizes whose operands do not fit in the
+# available memory are skipped
+
+EXPRESSIONS = {
+    'add': lambda a, b: a + b,
+    'subtract': lambda a, b: a - b,
+    'multiply': lambda a, b: a * b,
+    'fma': lambda a, b, c: a * b + c,
+}
+
+UFUNCS = {
+    'add': np.add,
+    'subtract': np.subtract,
+    'multiply': np.multiply,
+}
+
+# add_cpu's double loop (distributed_ex1.py itself needs numba to import)
+def loop_add(a, b, c):
+    n = len(a)
+    for i in range(n):
+        for j in range(n):
+            c[i][j] = a[i][j] + b[i][j]
+
+def available_memory():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+def best_time(run, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CPU engine for distributed_ex1.py's kernels")
+    parser.add_argument("--sizes", default="1000,2000,5000,10000,20000", help="comma separated N of the N x N arrays")
+    parser.add_argument("--kernel", choices=KERNELS, default="add")
+    parser.add_argument("--dtype", default="float64")
+    parser.add_argument("--workers", default=str(os.cpu_count()), help="comma separated worker counts")
+    parser.add_argument("--loop-max", type=int, default=1000, help="largest N for the Python loop")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    kernel = KERNELS[args.kernel]
+    num_inputs = kernel.__code__.co_argcount - 1
+    dtype = np.dtype(args.dtype)
+    worker_counts = [int(count) for count in args.workers.split(",")]
+    print(f"{args.kernel} on {dtype} N x N arrays, {cpu_engine.TILE_BYTES >> 10} KB tiles, GB/s:")
+    print(f"{'N':>6} {'loop':>8} {'numpy':>8} {'out=':>8} {'tiled':>8}" + "".join(f" {f'{count} proc':>8}" for count in worker_counts))
+
+    for n in (int(size) for size in args.sizes.split(",")):
+        total_bytes = (num_inputs + 1) * n * n * dtype.itemsize
+        memory = available_memory()
+        # a + b allocates one more array
+        if memory is not None and total_bytes * (num_inputs + 2) // (num_inputs + 1) > memory * 0.9:
+            print(f"{n:>6} skipped: needs {total_bytes / 1e9:.1f} GB, {memory / 1e9:.1f} GB available")
+            continue
+        rates = []
+        # The operands live in shared memory from the start, so every method
+        # runs on the same arrays and nothing is copied for the workers
+        with ParallelEngine(worker_counts[0]) as engine:
+            rng = np.random.default_rng(0)
+            inputs = [engine.empty((n, n), dtype) for _ in range(num_inputs)]
+            for array in inputs:
+                rng.random(dtype=dtype, out=array) if dtype.kind == 'f' else array.fill(1)
+            out = engine.empty((n, n), dtype)
+
+            def rate(run):
+                return total_bytes / best_time(run, args.repeat) / 1e9
+
+            if args.kernel == 'add' and n <= args.loop_max:
+                rates.append(total_bytes / best_time(lambda: loop_add(*inputs, out), 1) / 1e9)
+            else:
+                rates.append(None)
+            rates.append(rate(lambda: EXPRESSIONS[args.kernel](*inputs)))
+            ufunc = UFUNCS.get(args.kernel)
+            rates.append(rate(lambda: ufunc(*inputs, out=out)) if ufunc else None)
+            tile = cpu_engine.tile_size(num_inputs + 1, dtype.itemsize)
+            rates.append(rate(lambda: cpu_engine.evaluate(kernel, *inputs, out=out, tile=tile)))
+            expected = EXPRESSIONS[args.kernel](*inputs)
+            for count in worker_counts:
+                if count != engine.num_workers:
+                    engine.set_workers(count)
+                rates.append(rate(lambda: engine.evaluate(kernel, *inputs, out=out)))
+                if not np.allclose(out, expected):
+                    print(f"{n:>6} wrong result with {count} workers")
+            del expected
+        print(f"{n:>6}" + "".join(f" {'-' if value is None else f'{value:.2f}':>8}" for value in rates))
+
+if __name__ == "__main__":
+    main()
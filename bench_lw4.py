@@ -0,0 +1,77 @@
+import argparse
+import itertools
+import os
+import random
+import string
+import time
+from collections import Counter
+import lw4
+import lw4_numpy
+
+# Benchmark of the word-count mapper backends on a large corpus:
+#   python bench_lw4.py corpus.txt --size 512 --vocabulary 100000 --workers 4
+# Writes a corpus of --size MB of Zipf-distributed words first if the file
+# does not exist. Measures the mapper alone (one process, block by block, so
+# the backends are compared without pool and shuffle overhead) and then the
+# whole job through lw4.mapreduce and lw4_numpy.mapreduce_numpy, checking
+# that both count the same
+
+BACKENDS = {
+    'counter': lambda block: Counter(block.decode('utf-8', errors='replace').split()).items(),
+    'numpy': lw4_numpy.count_block,
+}
+
+# Words of 2-12 random letters with Zipf(exponent) frequencies, like natural
+# text: a few very common words and a long tail of rare ones
+def make_corpus(path, size, vocabulary, exponent=1.1, words_per_line=12, seed=0):
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 12))) for _ in range(vocabulary)]
+    weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, vocabulary + 1)))
+    written = 0
+    with open(path, 'w') as f:
+        while written < size:
+            lines = [' '.join(rng.choices(words, cum_weights=weights, k=words_per_line)) for _ in range(10000)]
+            text = '\n'.join(lines) + '\n'
+            f.write(text)
+            written += len(text)
+
+def bench_mapper(path, count, block_size):
+    size = os.path.getsize(path)
+    split = (path, 0, size)
+    start_time = time.perf_counter()
+    distinct = 0
+    for block in lw4.read_blocks(split, block_size):
+        distinct += len(list(count(block)))
+    elapsed = time.perf_counter() - start_time
+    return size / elapsed / (1 << 20), distinct
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the lw4 word-count mapper backends")
+    parser.add_argument("path", nargs="?", default="corpus.txt")
+    parser.add_argument("--size", type=int, default=256, help="MB of corpus to generate if path does not exist")
+    parser.add_argument("--vocabulary", type=int, default=100000, help="distinct words of the generated corpus")
+    parser.add_argument("--block-size", type=int, default=8 << 20, help="bytes per mapper call")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f"Writing {args.size} MB corpus to {args.path}")
+        make_corpus(args.path, args.size << 20, args.vocabulary)
+    size_mb = os.path.getsize(args.path) / (1 << 20)
+
+    print(f"Mapper alone, {args.block_size >> 20} MB blocks:")
+    for name, count in BACKENDS.items():
+        throughput, distinct = bench_mapper(args.path, count, args.block_size)
+        print(f"{name:>10} {throughput:>8.1f} MB/s  ({distinct} distinct words over all blocks)")
+
+    print(f"Whole job, {size_mb:.0f} MB with {args.workers} workers:")
+    counts, time_lasted = lw4.mapreduce(args.path, args.workers)
+    print(f"{'counter':>10} {size_mb / time_lasted:>8.1f} MB/s  {time_lasted:.2f} s")
+    numpy_counts, time_lasted = lw4_numpy.mapreduce_numpy(args.path, args.workers, block_size=args.block_size)
+    print(f"{'numpy':>10} {size_mb / time_lasted:>8.1f} MB/s  {time_lasted:.2f} s")
+    if numpy_counts != counts:
+        differing = sum(1 for word in counts.keys() | numpy_counts.keys() if counts[word] != numpy_counts[word])
+        print(f"Counts differ for {differing} words")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import os
+import numpy as np
+from multiprocessing import Pool, resource_tracker, shared_memory
+
+# CPU execution engine for the element-wise kernels of distributed_ex1.py
+# (c[i][j] = a[i][j] + b[i][j] and friends), for nodes without a GPU.
+# Kernels are NumPy ufuncs that write into a preallocated out array, so no
+# temporary is allocated per call. Kernels that go over their operands more
+# than once (like fma below) run tile by tile, a tile being about half of L2,
+# so that later passes find the tile still in cache; single-pass kernels read
+# every byte once whatever the order, and tiling them only adds overhead.
+# ParallelEngine splits the arrays over several worker processes: its arrays
+# live in multiprocessing shared_memory, which the workers map by name, so
+# nothing is copied or pickled but the bounds of each range.
+#   a = np.random.rand(N, N); b = np.random.rand(N, N); c = np.empty_like(a)
+#   evaluate(add, a, b, out=c)
+#   with ParallelEngine(4) as engine:
+#       a, b, c = engine.array(a), engine.array(b), engine.empty(a.shape)
+#       engine.evaluate(add, a, b, out=c)
+
+def cache_size():
+    try:
+        size = os.sysconf('SC_LEVEL2_CACHE_SIZE')
+    except (ValueError, OSError):
+        size = 0
+    return size if size > 0 else 1 << 20
+
+# Working set of one tile (all operands together): half of L2, leaving room
+# for everything else
+TILE_BYTES = int(os.environ.get('CPU_ENGINE_TILE_BYTES', cache_size() // 2))
+
+# Kernels take the operand tiles and the out tile. Kernels making more than
+# one pass over them set passes, which makes them tiled by default
+def add(a, b, out):
+    np.add(a, b, out=out)
+
+def subtract(a, b, out):
+    np.subtract(a, b, out=out)
+
+def multiply(a, b, out):
+    np.multiply(a, b, out=out)
+
+# out = a * b + c in two passes over the tile, the second one from cache
+def fma(a, b, c, out):
+    np.multiply(a, b, out=out)
+    np.add(out, c, out=out)
+
+fma.passes = 2
+
+KERNELS = {
+    'add': add,
+    'subtract': subtract,
+    'multiply': multiply,
+    'fma': fma,
+}
+
+# Elements per tile for num_arrays operands (out included) of itemsize bytes
+def tile_size(num_arrays, itemsize, tile_bytes=None):
+    return max((tile_bytes or TILE_BYTES) // (num_arrays * itemsize), 1)
+
+# Tile for kernel over inputs and out, None for no tiling
+def default_tile(kernel, inputs, out):
+    if getattr(kernel, 'passes', 1) > 1:
+        return tile_size(len(inputs) + 1, out.itemsize)
+    return None
+
+def check_operands(inputs, out):
+    for array in (*inputs, out):
+        if array.shape != out.shape:
+            raise ValueError(f"Operand shapes differ: {array.shape} and {out.shape}")
+        if not array.flags.c_contiguous:
+            raise ValueError("Operands must be C-contiguous arrays")
+
+# Run kernel over elements [start, stop) of the flattened operands, one tile
+# at a time (all at once without tile)
+def run_tiled(kernel, inputs, out, start=0, stop=None, tile=None):
+    flat_inputs = [array.reshape(-1) for array in inputs]
+    flat_out = out.reshape(-1)
+    stop = flat_out.size if stop is None else stop
+    tile = tile or max(stop - start, 1)
+    for i in range(start, stop, tile):
+        j = min(i + tile, stop)
+        kernel(*(array[i:j] for array in flat_inputs), out=flat_out[i:j])
+    return out
+
+# Single-core evaluation: out = kernel(*inputs), allocating out if not given
+def evaluate(kernel, *inputs, out=None, tile=None):
+    if out is None:
+        out = np.empty_like(inputs[0])
+    check_operands(inputs, out)
+    return run_tiled(kernel, inputs, out, tile=tile or default_tile(kernel, inputs, out))
+
+# Map an existing shared memory block. The process that created it unlinks
+# it; before Python 3.13 (no track) the workers register it again with the
+# resource tracker they share with that process, which is harmless. (With a
+# tracker of their own, it would unlink the block when the worker exits.)
+def attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name)
+
+# Worker side: shared memory name -> (block, array over it), kept for the
+# life of the worker so each array is mapped once (so freed arrays stay
+# mapped in the workers until the engine is closed)
+attached = {}
+
+def shared_view(spec):
+    name, shape, dtype = spec
+    if name not in attached:
+        block = attach(name)
+        attached[name] = (block, np.ndarray(shape, dtype, buffer=block.buf))
+    return attached[name][1]
+
+def run_shared(task):
+    kernel, input_specs, out_spec, start, stop, tile = task
+    inputs = [shared_view(spec) for spec in input_specs]
+    run_tiled(kernel, inputs, shared_view(out_spec), start, stop, tile)
+
+def release(block):
+    try:
+        block.close()
+    except BufferError:
+        # Arrays over the block are still alive; it is unmapped with them
+        pass
+    block.unlink()
+
+class ParallelEngine:
+    def __init__(self, num_workers=None, tasks_per_worker=4):
+        self.num_workers = num_workers or os.cpu_count()
+        self.tasks_per_worker = tasks_per_worker
+        # Started before the workers so that they share it (see attach)
+        resource_tracker.ensure_running()
+        self.pool = Pool(self.num_workers)
+        # Data address of every array handed out -> (block, spec)
+        self.blocks = {}
+
+    # Uninitialized array in shared memory
+    def empty(self, shape, dtype=np.float64):
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        self.blocks[array.ctypes.data] = (block, (block.name, tuple(array.shape), dtype.str))
+        return array
+
+    # Copy of array in shared memory
+    def array(self, array):
+        shared = self.empty(array.shape, array.dtype)
+        np.copyto(shared, array)
+        return shared
+
+    def spec(self, array):
+        entry = self.blocks.get(array.ctypes.data)
+        if entry is None or entry[1][1] != array.shape:
+            raise ValueError("Array was not allocated by this engine, copy it in with engine.array()")
+        return entry[1]
+
+    # Parallel evaluation: the flattened operands are cut into contiguous
+    # ranges (of whole tiles when tiled), a few per worker so a slow one
+    # evens out
+    def evaluate(self, kernel, *inputs, out=None, tile=None):
+        if out is None:
+            out = self.empty(inputs[0].shape, inputs[0].dtype)
+        check_operands(inputs, out)
+        tile = tile or default_tile(kernel, inputs, out)
+        num_tasks = self.num_workers * self.tasks_per_worker
+        unit = tile or 1
+        units = -(-out.size // unit)
+        step = max(-(-units // num_tasks) * unit, 1)
+        input_specs = [self.spec(array) for array in inputs]
+        out_spec = self.spec(out)
+        tasks = [(kernel, input_specs, out_spec, start, min(start + step, out.size), tile)
+                 for start in range(0, out.size, step)]
+        self.pool.map(run_shared, tasks)
+        return out
+
+    # Restart the pool with num_workers processes; the arrays stay where
+    # they are
+    def set_workers(self, num_workers):
+        self.pool.close()
+        self.pool.join()
+        self.num_workers = num_workers
+        self.pool = Pool(num_workers)
+
+    # Give back the shared memory of array (which must not be used
+    # afterwards). It is freed once the last view of it is gone
+    def free(self, array):
+        block, _ = self.blocks.pop(array.ctypes.data)
+        release(block)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for block, _ in self.blocks.values():
+            release(block)
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,6 +1,7 @@
 import numpy as np
 import numba as cuda
 import time
+import cpu_engine
 
 def add_cpu(a, b, c):
     start_time = time.time()
@@ -11,6 +12,21 @@ def add_cpu(a, b, c):
     execution_time = end_time - start_time
     return c, execution_time
 
+def add_cpu_vectorized(a, b, c):
+    start_time = time.time()
+    cpu_engine.evaluate(cpu_engine.add, a, b, out=c)
+    end_time = time.time()
+    execution_time = end_time - start_time
+    return c, execution_time
+
+# a, b and c must come from engine (engine.array / engine.empty)
+def add_cpu_parallel(engine, a, b, c):
+    start_time = time.time()
+    engine.evaluate(cpu_engine.add, a, b, out=c)
+    end_time = time.time()
+    execution_time = end_time - start_time
+    return c, execution_time
+
 @cuda.jit
 def add_gpu(a, b):
     start_time = time.time()
@@ -56,6 +72,17 @@ if __name__ == "__main__":
     cpu_result, cpu_execution = add_cpu(a, b, c)
     print("CPU Execution Time: ", cpu_execution, " seconds")
 
+    print("Starting vectorized CPU computation")
+    vectorized_result, vectorized_execution = add_cpu_vectorized(a, b, np.empty_like(a))
+    print("Vectorized CPU Execution Time: ", vectorized_execution, " seconds")
+
+    print("Starting parallel CPU computation")
+    with cpu_engine.ParallelEngine() as engine:
+        shared_a, shared_b = engine.array(a), engine.array(b)
+        parallel_result, parallel_execution = add_cpu_parallel(engine, shared_a, shared_b, engine.empty(a.shape))
+        print("Parallel CPU Execution Time: ", parallel_execution, " seconds")
+        print("Results match: ", np.array_equal(parallel_result, vectorized_result))
+
     print("Starting GPU computation")
     #Perform GPU computation
     gpu_result, gpu_execution = add_gpu(a, b)
@@ -1,27 +1,645 @@
-from collections import Counter
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import partial
 from multiprocessing import Pool
+from operator import itemgetter
+import glob
+import heapq
+import itertools
+import mmap
+import os
+import pickle
+import queue
+import shutil
+import statistics
+import sys
+import tempfile
 import time
+import zlib
 
-def mapper(text):
-    words = text.split()
-    return Counter(words)
+# Input splits are byte ranges (path, start, end) of the file, ending on a
+# line boundary. Only the offsets go to the workers: each worker maps the file
+# and reads its own range, so no input text passes through the parent and the
+# file never has to fit in memory. chunk_size is the bytes per split, or a
+# function giving the size of the next split from the bytes left in the file
+def split_file(path, chunk_size):
+    size = os.path.getsize(path)
+    splits = []
+    if size == 0:
+        return splits
+    next_size = chunk_size if callable(chunk_size) else lambda remaining: chunk_size
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = min(start + next_size(size - start), size)
+            if end < size:
+                # Extend to the end of the line the chunk stops in
+                newline = mm.find(b'\n', end - 1)
+                end = size if newline == -1 else newline + 1
+            splits.append((path, start, end))
+            start = end
+    return splits
 
-def reducer(counters):
-    return sum(counters, Counter())
+def read_split(split):
+    path, start, end = split
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm[start:end]
 
-def mapreduce(data, num_workers):
-    start_time = time.time()
-    pool = Pool(num_workers)
-    mapped_data = pool.map(mapper, data)
-    reduced_data = reducer(mapped_data)
-    end_time = time.time()
-    time_lasted = end_time - start_time
-    return reduced_data, time_lasted
+# Line-aligned blocks of about block_size bytes of a split, so a split can be
+# processed without holding all of it (and all its words) in memory
+def read_blocks(split, block_size):
+    path, start, end = split
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < end:
+            stop = min(start + block_size, end)
+            if stop < end:
+                newline = mm.find(b'\n', stop - 1, end)
+                stop = end if newline == -1 else newline + 1
+            yield mm[start:stop]
+            start = stop
+
+# Size of the next split when remaining bytes of input are left (guided
+# self-scheduling): a fraction of the remaining bytes per worker, so the first
+# splits are large, to keep per-task overhead down, and they shrink towards
+# the end of the input, so the last tasks are short and the workers finish
+# together instead of waiting on one that took a large split late
+def default_chunk_size(remaining, num_workers):
+    return min(max(remaining // (num_workers * 2), 1 << 20), 64 << 20)
+
+# Reduce partition of a key. Python's own hash() of a str differs between
+# processes, so the partition comes from a stable CRC32 instead
+def partition(key, num_partitions):
+    if isinstance(key, str):
+        data = key.encode()
+    elif isinstance(key, bytes):
+        data = key
+    else:
+        data = repr(key).encode()
+    return zlib.crc32(data) % num_partitions
+
+# Datasources (the Datasource of lw4.cc's mapreduce::job) turn the input into
+# map tasks: tasks(num_workers) lists them in the parent, read(task) yields
+# the (key, value) records of one task in a worker, and task_size(task)
+# (optional) tells the scheduler how large a task is (see run_tasks)
+#
+# FileSource: line-aligned byte ranges of a file; a record is
+# (path, text of a block of whole lines), or the raw bytes with binary=True
+class FileSource:
+    def __init__(self, path, chunk_size=None, block_size=1 << 20, binary=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.binary = binary
+
+    def paths(self):
+        return [self.path]
+
+    def tasks(self, num_workers):
+        if self.chunk_size:
+            return [split for path in self.paths() for split in split_file(path, self.chunk_size)]
+        sizes = {path: os.path.getsize(path) for path in self.paths()}
+        # Bytes in the files after the one being split
+        later = sum(sizes.values())
+        splits = []
+        for path, size in sizes.items():
+            later -= size
+            splits.extend(split_file(path, lambda remaining: default_chunk_size(remaining + later, num_workers)))
+        return splits
+
+    def task_size(self, split):
+        _, start, end = split
+        return end - start
+
+    def read(self, split):
+        for block in read_blocks(split, self.block_size):
+            if self.binary:
+                yield split[0], block
+                continue
+            # Blocks end on line boundaries, so no UTF-8 character is cut in half
+            yield split[0], block.decode('utf-8', errors='replace')
+
+# DirectorySource: every file matching a glob pattern, split like FileSource
+class DirectorySource(FileSource):
+    def paths(self):
+        return sorted(path for path in glob.glob(self.path, recursive=True) if os.path.isfile(path))
+
+# IteratorSource: (key, value) records from any iterable, sent to the workers
+# in batches of batch_size (so these do pass through the parent)
+class IteratorSource:
+    def __init__(self, records, batch_size=1000):
+        self.records = records
+        self.batch_size = batch_size
+
+    def tasks(self, num_workers):
+        records = iter(self.records)
+        return list(iter(lambda: list(itertools.islice(records, self.batch_size)), []))
+
+    def task_size(self, batch):
+        return len(batch)
+
+    # The workers only need read(); the records themselves (possibly a
+    # generator) stay in the parent
+    def __getstate__(self):
+        return {'records': None, 'batch_size': self.batch_size}
+
+    def read(self, batch):
+        return iter(batch)
+
+# Intermediate stores (the IntermediateStore of lw4.cc) hold the map output
+# between the phases. A map task adds its (key, value) pairs to
+# store.map_output(); finish() returns one handle per partition, and the
+# reducer of partition r gets the (key, values) groups of all its handles from
+# store.reduce_input().
+# Without a combiner the map output of a key is the list of its values. With
+# one it is a single combined value, and the stores combine again while
+# merging map outputs, so the reducer of a key gets a one-element list
+def combine(combiner, key, value, other):
+    return combiner(key, [value, other])
+
+# Map output buffered in a dict. spill(partitions) is called with the buffer
+# cut into partitions whenever it reaches max_keys keys, and at the end
+class MapOutput:
+    def __init__(self, num_partitions, combiner, spill, max_keys=None):
+        self.num_partitions = num_partitions
+        self.combiner = combiner
+        self.spill = spill
+        self.max_keys = max_keys
+        self.values = {}
+
+    def add(self, key, value):
+        values = self.values
+        if key in values:
+            if self.combiner is None:
+                values[key].append(value)
+            else:
+                values[key] = combine(self.combiner, key, values[key], value)
+            return
+        values[key] = [value] if self.combiner is None else value
+        if self.max_keys is not None and len(values) >= self.max_keys:
+            self.flush()
+
+    def flush(self):
+        partitions = [{} for _ in range(self.num_partitions)]
+        for key, value in self.values.items():
+            partitions[partition(key, self.num_partitions)][key] = value
+        self.values = {}
+        self.spill(partitions)
+
+    def finish(self):
+        self.flush()
+        return self.spill(None)
+
+# MemoryStore: the partitions go back to the parent in memory
+class MemoryStore:
+    # reduce_input() leaves the handles as they are, so a reduce task can run
+    # twice at the same time (speculative execution)
+    repeatable_reduce = True
+
+    # Map output only lives in the attempts' results
+    session_files = False
+
+    def session(self):
+        return nullcontext(self)
+
+    def map_output(self, num_partitions, combiner):
+        collected = []
+
+        def spill(partitions):
+            if partitions is None:
+                return collected[0] if collected else [{} for _ in range(num_partitions)]
+            collected.append(partitions)
+
+        return MapOutput(num_partitions, combiner, spill)
+
+    def discard(self, handles):
+        pass
+
+    def reduce_input(self, handles, combiner=None):
+        handles = sorted(handles, key=len, reverse=True)
+        if not handles:
+            return iter(())
+        # Merge into a copy of the largest map output, so most keys are
+        # taken over without a lookup
+        merged = dict(handles[0])
+        for values_by_key in handles[1:]:
+            merge_map_output(merged, values_by_key, combiner)
+        if combiner is None:
+            return iter(merged.items())
+        return ((key, [value]) for key, value in merged.items())
+
+# Add the map output values_by_key of one partition to merged
+def merge_map_output(merged, values_by_key, combiner=None):
+    for key, value in values_by_key.items():
+        if key not in merged:
+            merged[key] = value
+        elif combiner is None:
+            merged[key] = merged[key] + value
+        else:
+            merged[key] = combine(combiner, key, merged[key], value)
+
+# Rough memory per buffered key (dict slot, key and value objects)
+ENTRY_BYTES = 128
+RUN_BATCH = 4096
+MAX_OPEN_RUNS = 128
+
+# Runs are pickled batches of map output (key, value) pairs sorted by key.
+# items may be an iterator, so a merge pass is written as it is produced
+def write_run(path, items):
+    items = iter(items)
+    with open(path, 'wb') as f:
+        for batch in iter(lambda: list(itertools.islice(items, RUN_BATCH)), []):
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+# Merge sorted runs into sorted map output with one pair per key
+def merge_runs(paths, combiner=None):
+    merged = heapq.merge(*(read_run(path) for path in paths), key=itemgetter(0))
+    for key, group in itertools.groupby(merged, key=itemgetter(0)):
+        _, value = next(group)
+        for _, other in group:
+            value = value + other if combiner is None else combine(combiner, key, value, other)
+        yield key, value
+
+def new_run_path(spill_path, prefix):
+    fd, path = tempfile.mkstemp(dir=spill_path, prefix=prefix, suffix='.run')
+    os.close(fd)
+    return path
+
+# LocalDiskStore: out-of-core shuffle for intermediate data larger than memory.
+# Map tasks spill their buffer whenever it reaches memory_budget, as one run
+# file per partition sorted by key, into a temporary directory under spill_dir;
+# handles are the lists of run files. Reducers k-way merge their runs (at most
+# MAX_OPEN_RUNS files at a time, merging in several passes beyond that), so
+# no phase holds more than memory_budget of map output per worker. Keys must
+# be sortable
+class LocalDiskStore:
+    # Reducers delete their runs as they merge them
+    repeatable_reduce = False
+    # Map tasks write their runs into the session's directory
+    session_files = True
+
+    def __init__(self, memory_budget=256 << 20, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.spill_path = None
+
+    @contextmanager
+    def session(self):
+        with tempfile.TemporaryDirectory(dir=self.spill_dir, prefix='lw4-spill-') as spill_path:
+            store = LocalDiskStore(self.memory_budget, self.spill_dir)
+            store.spill_path = spill_path
+            yield store
+
+    def map_output(self, num_partitions, combiner):
+        runs = [[] for _ in range(num_partitions)]
+
+        def spill(partitions):
+            if partitions is None:
+                return runs
+            for r, values_by_key in enumerate(partitions):
+                if values_by_key:
+                    path = new_run_path(self.spill_path, f'run-{r:05d}-')
+                    write_run(path, sorted(values_by_key.items(), key=itemgetter(0)))
+                    runs[r].append(path)
+
+        return MapOutput(num_partitions, combiner, spill, max_keys=max(self.memory_budget // ENTRY_BYTES, 1))
+
+    def discard(self, handles):
+        for runs in handles:
+            for path in runs:
+                os.remove(path)
+
+    def reduce_input(self, handles, combiner=None):
+        paths = [path for runs in handles for path in runs]
+        while len(paths) > MAX_OPEN_RUNS:
+            merged_paths = []
+            for i in range(0, len(paths), MAX_OPEN_RUNS):
+                group = paths[i:i + MAX_OPEN_RUNS]
+                path = new_run_path(self.spill_path, 'merged-')
+                write_run(path, merge_runs(group, combiner))
+                for old_path in group:
+                    os.remove(old_path)
+                merged_paths.append(path)
+            paths = merged_paths
+        for key, value in merge_runs(paths, combiner):
+            yield key, value if combiner is None else [value]
+        for path in paths:
+            os.remove(path)
+
+# Raised in an attempt of a task that is no longer needed (see run_tasks)
+class TaskCancelled(Exception):
+    pass
+
+CANCEL_CHECK_SECONDS = 0.05
+
+# The items of iterable, stopping with TaskCancelled once cancelled() is true;
+# it is asked at most every CANCEL_CHECK_SECONDS
+def cancellable(iterable, cancelled):
+    if cancelled is None:
+        yield from iterable
+        return
+    next_check = 0
+    for item in iterable:
+        now = time.monotonic()
+        if now >= next_check:
+            if cancelled():
+                raise TaskCancelled()
+            next_check = now + CANCEL_CHECK_SECONDS
+        yield item
+
+def run_map_task(job, store, num_partitions, task, cancelled=None):
+    output = store.map_output(num_partitions, job.combiner)
+    try:
+        for key, value in cancellable(job.source.read(task), cancelled):
+            for intermediate_key, intermediate_value in job.mapper(key, value):
+                output.add(intermediate_key, intermediate_value)
+    except TaskCancelled:
+        output.values = {}
+        store.discard(output.finish())
+        raise
+    return output.finish()
+
+def run_reduce_task(job, store, output_dir, task, cancelled=None):
+    r, handles = task
+    results = ((key, job.reducer(key, values))
+               for key, values in cancellable(store.reduce_input(handles, job.combiner), cancelled))
+    if output_dir is None:
+        return dict(results)
+    output_path = os.path.join(output_dir, f'part-{r:05d}')
+    # Written aside and renamed, so a speculative copy of the task never
+    # writes into the same file
+    temp_path = f'{output_path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for key, value in results:
+                f.write(f'{key}\t{value}\n')
+    except TaskCancelled:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, output_path)
+    return output_path
+
+# Tasks are handed out one at a time, largest first, to whichever worker is
+# free: the idle workers take the remaining tasks from one queue, unlike
+# Pool.map's fixed chunks per worker, so a slow worker or a large task does
+# not keep the others waiting with work left. Once no task is left to start,
+# a task that has been running SPECULATION_FACTOR times longer than the
+# median task so far (and at least SPECULATION_MIN_SECONDS) is started again
+# on an idle worker, and whichever attempt finishes first is used
+# (speculative execution). A pool cannot cancel an attempt, so each task has a
+# token file while it is needed: an attempt checks it between records (see
+# cancellable) and, once the task is done elsewhere or the phase has ended,
+# stops with TaskCancelled and discards its map output. That frees its worker
+# for the next tasks or jobs within about one record
+SPECULATION_FACTOR = 2.0
+SPECULATION_MIN_SECONDS = 0.5
+
+# One finished attempt of a task: size is the task's size as given to
+# run_tasks, and won tells whether its result was used
+TaskTiming = namedtuple('TaskTiming', 'phase task attempt worker seconds size won')
+
+def run_attempt(fn, task, token):
+    start_time = time.perf_counter()
+    result = fn(task, lambda: not os.path.exists(token))
+    return os.getpid(), time.perf_counter() - start_time, result
+
+# fn(task, cancelled) for every task on pool, with at most num_workers attempts
+# running at once, largest of sizes first. Returns the results in task order;
+# the timings of the attempts are added to timings, and the AsyncResults of
+# the attempts still running (all of them cancelled) to leftovers
+def run_tasks(pool, fn, tasks, sizes, num_workers, phase, speculative=True, timings=None, leftovers=None):
+    pending = deque(sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True))
+    finished = queue.Queue()
+    results = [None] * len(tasks)
+    done = set()
+    # Task -> {attempt: start time} of its attempts still running
+    running = {}
+    attempts = Counter()
+    durations = []
+    in_flight = 0
+    token_dir = tempfile.mkdtemp(prefix='lw4-tasks-')
+    # (task, attempt) -> AsyncResult of the attempts still running
+    handles = {}
+
+    def token(i):
+        return os.path.join(token_dir, str(i))
+
+    def start(i):
+        nonlocal in_flight
+        attempt = attempts[i]
+        if attempt == 0:
+            open(token(i), 'x').close()
+        attempts[i] += 1
+        running.setdefault(i, {})[attempt] = time.perf_counter()
+        in_flight += 1
+        handles[i, attempt] = pool.apply_async(
+            run_attempt, (fn, tasks[i], token(i)),
+            callback=lambda reply: finished.put((i, attempt, reply, None)),
+            error_callback=lambda error: finished.put((i, attempt, None, error)))
+
+    # (task to start again, None) or (None, seconds until a task may need it)
+    def straggler():
+        candidates = [(started[0], i) for i, started in running.items()
+                      if i not in done and attempts[i] == 1 and 0 in started]
+        if not candidates or not durations:
+            return None, None
+        threshold = max(SPECULATION_FACTOR * statistics.median(durations), SPECULATION_MIN_SECONDS)
+        started, i = min(candidates)
+        wait = started + threshold - time.perf_counter()
+        return (i, None) if wait <= 0 else (None, wait)
+
+    try:
+        while len(done) < len(tasks):
+            while pending and in_flight < num_workers:
+                start(pending.popleft())
+            timeout = None
+            if speculative and not pending and in_flight < num_workers:
+                i, timeout = straggler()
+                if i is not None:
+                    start(i)
+                    continue
+            try:
+                i, attempt, reply, error = finished.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            in_flight -= 1
+            del running[i][attempt]
+            del handles[i, attempt]
+            if error is not None:
+                # Fails the job unless another attempt of the task may still succeed
+                if i in done or running[i]:
+                    continue
+                raise error
+            worker, seconds, result = reply
+            won = i not in done
+            if timings is not None:
+                timings.append(TaskTiming(phase, i, attempt, worker, seconds, sizes[i], won))
+            if won:
+                done.add(i)
+                results[i] = result
+                durations.append(seconds)
+                # Cancels the other attempts
+                os.remove(token(i))
+    finally:
+        # Cancels whatever is still running
+        shutil.rmtree(token_dir, ignore_errors=True)
+        if leftovers is not None:
+            leftovers.extend(handles.values())
+    return results
+
+# Per phase: spread of the task times, busy time of the workers and the
+# speculative attempts; with per_task, one line per finished attempt
+def format_task_timings(task_timings, per_task=False):
+    lines = []
+    for phase in PHASES:
+        timings = [timing for timing in task_timings if timing.phase == phase]
+        if not timings:
+            continue
+        seconds = [timing.seconds for timing in timings if timing.won]
+        busy = Counter()
+        for timing in timings:
+            busy[timing.worker] += timing.seconds
+        speculative = [timing for timing in timings if timing.attempt > 0]
+        lines.append(f"{phase}: {len(seconds)} tasks, {min(seconds):.3f}s min, {statistics.median(seconds):.3f}s median, "
+                     f"{max(seconds):.3f}s max; {len(busy)} workers busy {min(busy.values()):.3f}s to "
+                     f"{max(busy.values()):.3f}s; {len(speculative)} speculative attempts finished, "
+                     f"{sum(timing.won for timing in speculative)} used")
+        if per_task:
+            for timing in sorted(timings, key=lambda timing: (timing.task, timing.attempt)):
+                lines.append(f"  {phase} task {timing.task:>4} attempt {timing.attempt} worker {timing.worker:>7} "
+                             f"{timing.seconds:.3f}s size {timing.size}{'' if timing.won else ' (not used)'}")
+    return '\n'.join(lines)
+
+# A MapReduce job, the Python side of lw4.cc's
+# mapreduce::job<MapTask, ReduceTask, Datasource, Combiner, IntermediateStore>:
+#   mapper(key, value)     -> iterable of (intermediate key, value) pairs
+#   combiner(key, values)  -> one value; optional, merges the values of a key
+#                             inside a map task before the shuffle
+#   reducer(key, values)   -> the result for key
+# The callables run in the worker processes, so they must be module-level
+# functions (pickled by name), not lambdas.
+# run() maps every task of the source, shuffles the map output by key hash
+# into num_reducers partitions and reduces them in parallel. It returns
+# (results, seconds): results is a dict of key -> result, or with output_dir
+# the part-NNNNN files of "key<TAB>result" lines, one per partition.
+# With pool the job runs on that (long-lived) pool instead of starting and
+# stopping num_workers processes of its own. After a run, timings holds the
+# seconds spent in each phase: split (listing the map tasks), map (map tasks,
+# including sending their output back), shuffle (grouping the map output by
+# partition) and reduce (reduce tasks and joining their results), and
+# task_timings the TaskTiming of every map and reduce task (see run_tasks;
+# speculative=False starts every task once)
+PHASES = ('split', 'map', 'shuffle', 'reduce')
+
+class Job:
+    def __init__(self, mapper, reducer, source, combiner=None, store=None, speculative=True):
+        self.mapper = mapper
+        self.reducer = reducer
+        self.source = source
+        self.combiner = combiner
+        self.store = store or MemoryStore()
+        self.speculative = speculative
+        self.timings = {}
+        self.task_timings = []
+
+    def run(self, num_workers, num_reducers=None, output_dir=None, pool=None):
+        if pool is None:
+            with Pool(num_workers) as pool:
+                return self.run(num_workers, num_reducers, output_dir, pool)
+        start_time = time.time()
+        phase_start = start_time
+        timings = {}
+
+        def phase_done(phase):
+            nonlocal phase_start
+            now = time.time()
+            timings[phase] = now - phase_start
+            phase_start = now
+
+        num_reducers = num_reducers or num_workers
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        tasks = self.source.tasks(num_workers)
+        source_size = getattr(self.source, 'task_size', None)
+        sizes = [source_size(task) if source_size else 1 for task in tasks]
+        phase_done('split')
+        task_timings = []
+        leftovers = []
+        with self.store.session() as store:
+            try:
+                mapped_data = run_tasks(pool, partial(run_map_task, self, store, num_reducers), tasks, sizes,
+                                        num_workers, 'map', self.speculative, task_timings, leftovers)
+                phase_done('map')
+                reduce_tasks = [(r, [output[r] for output in mapped_data]) for r in range(num_reducers)]
+                del mapped_data
+                phase_done('shuffle')
+                reduced_data = run_tasks(pool, partial(run_reduce_task, self, store, output_dir), reduce_tasks,
+                                         [sum(map(len, handles)) for _, handles in reduce_tasks], num_workers,
+                                         'reduce', self.speculative and store.repeatable_reduce, task_timings,
+                                         leftovers)
+            finally:
+                # Cancelled attempts still writing into the session must stop
+                # before it is removed
+                if store.session_files:
+                    for attempt in leftovers:
+                        attempt.wait()
+        if output_dir is None:
+            # Partitions hold disjoint keys, so joining them is a plain update
+            results = {}
+            for part in reduced_data:
+                results.update(part)
+            reduced_data = results
+        phase_done('reduce')
+        self.timings = timings
+        self.task_timings = task_timings
+        end_time = time.time()
+        time_lasted = end_time - start_time
+        return reduced_data, time_lasted
+
+def format_timings(timings):
+    return ', '.join(f'{phase} {timings[phase]:.3f}s' for phase in PHASES if phase in timings)
+
+# Word count. The mapper counts a whole block at once (in-mapper combining),
+# so only its distinct words reach the map output
+def mapper(path, text):
+    return Counter(text.split()).items()
+
+def reducer(word, counts):
+    return sum(counts)
+
+def mapreduce(path, num_workers, chunk_size=None, num_reducers=None, pool=None):
+    job = Job(mapper, reducer, FileSource(path, chunk_size), combiner=reducer)
+    reduced_data, time_lasted = job.run(num_workers, num_reducers, pool=pool)
+    return Counter(reduced_data), time_lasted
+
+# Word count for vocabularies that do not fit in memory: the map output is
+# spilled to disk and the counts are written sorted by word to
+# output_dir/part-NNNNN; read_output() reads them back
+def mapreduce_out_of_core(path, output_dir, num_workers, memory_budget=256 << 20, chunk_size=None,
+                          num_reducers=None, spill_dir=None, pool=None):
+    job = Job(mapper, reducer, FileSource(path, chunk_size), combiner=reducer,
+              store=LocalDiskStore(memory_budget, spill_dir))
+    return job.run(num_workers, num_reducers, output_dir=output_dir, pool=pool)
+
+def read_output(paths):
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                word, count = line.rstrip('\n').split('\t')
+                yield word, int(count)
 
 if __name__ == "__main__":
     # Example usage
-    with open('data.txt') as f:
-        data = f.readlines()
-    print(type(data))
-    result, time_lasted = mapreduce(data, num_workers=2)
-    print(result, time_lasted)
\ No newline at end of file
+    path = sys.argv[1] if len(sys.argv) > 1 else 'data.txt'
+    job = Job(mapper, reducer, FileSource(path), combiner=reducer)
+    result, time_lasted = job.run(num_workers=2)
+    print(Counter(result), time_lasted)
+    print(format_task_timings(job.task_timings, per_task=True))
@@ -0,0 +1,505 @@
+import argparse
+import ipaddress
+import itertools
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from multiprocessing.connection import Client, Listener
+import lw4
+from lw4_server import DEFAULT_AUTHKEY, JobClient, JobError
+
+# MapReduce over several machines: worker daemons register with a coordinator
+# over TCP, the coordinator hands out map tasks one at a time to whichever
+# worker is free, and every worker streams its map output, partition by
+# partition, straight to the worker that reduces that partition (no map output
+# goes through the coordinator). Once all map tasks are done the coordinator
+# tells the workers to reduce and collects their results.
+#   python lw4_cluster.py coordinator --port 9000
+#   python lw4_cluster.py worker --coordinator 10.0.0.1:9000 --host 10.0.0.2   (on every node)
+#   python lw4_cluster.py wordcount /shared/data.txt --coordinator 10.0.0.1:9000 --min-workers 4
+# or, for testing, a coordinator and N worker processes on this machine:
+#   python lw4_cluster.py local data.txt --workers 3
+# Map tasks are the source's tasks (FileSource splits are (path, start, end),
+# so the input must be at the same path on every node, e.g. a shared file
+# system), and output_dir part files are written on the node of each reducer.
+# All connections are multiprocessing.connection ones, authenticated with
+# LW4_AUTHKEY. Jobs and map output are pickled, so whoever holds the authkey
+# can run code on the coordinator and the workers: every peer must be
+# trusted. The coordinator and the workers only listen on loopback addresses
+# unless LW4_AUTHKEY is set (to a secret, not the default). A worker lost in
+# the middle of a job fails the job.
+# Each daemon runs one task at a time: start one worker per core
+
+# Keys a map task buffers before sending them on to the reducers
+MAP_BUFFER_KEYS = 1 << 18
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        pass
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+# Raises ValueError for a listener other hosts could reach with the default
+# authkey
+def check_listen_address(host, authkey):
+    if not is_loopback(host) and authkey == DEFAULT_AUTHKEY and 'LW4_AUTHKEY' not in os.environ:
+        raise ValueError(f"Refusing to listen on {host} with the default authkey: set LW4_AUTHKEY")
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def format_address(address):
+    return f'{address[0]}:{address[1]}'
+
+class WorkerHandle:
+    def __init__(self, name, connection, data_address):
+        self.name = name
+        self.connection = connection
+        self.data_address = data_address
+        self.send_lock = threading.Lock()
+        self.alive = True
+
+    def send(self, *message):
+        with self.send_lock:
+            self.connection.send(message)
+
+class Coordinator:
+    def __init__(self, authkey=DEFAULT_AUTHKEY):
+        self.authkey = authkey
+        self.workers = {}
+        self.lock = threading.Lock()
+        self.registered = threading.Condition(self.lock)
+        # (worker, message) from all workers, consumed by the running job
+        self.events = queue.Queue()
+        self.job_lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.listener = None
+        self.stopping = False
+
+    def listen(self, address):
+        check_listen_address(address[0], self.authkey)
+        self.listener = Listener(address, authkey=self.authkey)
+        return self.listener.address
+
+    def serve(self):
+        try:
+            while not self.stopping:
+                try:
+                    connection = self.listener.accept()
+                except Exception:
+                    # Failed authentication or a peer that went away
+                    continue
+                if self.stopping:
+                    connection.close()
+                    break
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+        finally:
+            self.listener.close()
+
+    # The first message tells workers (register) from clients
+    def handle(self, connection):
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            connection.close()
+            return
+        if message[0] == 'register':
+            self.read_worker(WorkerHandle(message[1], connection, message[2]))
+        else:
+            self.serve_client(connection, message)
+
+    def read_worker(self, worker):
+        with self.registered:
+            self.workers[worker.name] = worker
+            self.registered.notify_all()
+        print(f"Worker {worker.name} registered, data on {format_address(worker.data_address)}", flush=True)
+        try:
+            while True:
+                self.events.put((worker, worker.connection.recv()))
+        except (EOFError, OSError):
+            pass
+        with self.lock:
+            worker.alive = False
+            if self.workers.get(worker.name) is worker:
+                del self.workers[worker.name]
+        print(f"Worker {worker.name} lost", flush=True)
+        self.events.put((worker, ('lost',)))
+
+    def serve_client(self, connection, request):
+        with connection:
+            while True:
+                command, *args = request
+                try:
+                    if command == 'run':
+                        connection.send(('ok', *self.run(*args)))
+                    elif command == 'workers':
+                        connection.send(('ok', sorted(self.workers)))
+                    elif command == 'shutdown':
+                        connection.send(('ok',))
+                        self.shutdown()
+                        return
+                    else:
+                        connection.send(('error', f'Unknown command: {command}'))
+                except Exception:
+                    connection.send(('error', traceback.format_exc()))
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+
+    def wait_for_workers(self, min_workers, timeout):
+        with self.registered:
+            if not self.registered.wait_for(lambda: len(self.workers) >= min_workers, timeout):
+                raise JobError(f"Only {len(self.workers)} of {min_workers} workers registered")
+            return list(self.workers.values())
+
+    # Next event of job_id; failures of the job's workers end it
+    def next_event(self, job_id, workers):
+        while True:
+            worker, message = self.events.get()
+            if message[0] == 'lost':
+                if worker in workers:
+                    raise JobError(f"Worker {worker.name} lost")
+                continue
+            if message[1] != job_id:
+                continue
+            if message[0] == 'error':
+                raise JobError(f"Worker {worker.name} failed:\n{message[2]}")
+            return worker, message
+
+    # The replies of kind from every worker, by worker
+    def wait_all(self, job_id, workers, kind):
+        replies = {}
+        while len(replies) < len(workers):
+            worker, message = self.next_event(job_id, workers)
+            if message[0] == kind:
+                replies[worker] = message[2:]
+        return replies
+
+    # (results, seconds, timings) like lw4_server.JobClient.run. The shuffle
+    # happens during map, so timings has split, map and reduce
+    def run(self, job, num_reducers=None, output_dir=None, min_workers=1, timeout=None):
+        with self.job_lock:
+            workers = self.wait_for_workers(min_workers, timeout)
+            job_id = next(self.job_ids)
+            try:
+                return self.run_job(job_id, job, workers, num_reducers, output_dir)
+            except BaseException:
+                for worker in workers:
+                    if worker.alive:
+                        try:
+                            worker.send('abort', job_id)
+                        except OSError:
+                            pass
+                raise
+
+    def run_job(self, job_id, job, workers, num_reducers, output_dir):
+        start_time = time.time()
+        timings = {}
+        num_reducers = num_reducers or len(workers)
+        tasks = job.source.tasks(len(workers))
+        timings['split'] = time.time() - start_time
+
+        # Partition r is reduced by worker r % len(workers). Map tasks only
+        # start once every worker knows the job, so no map output can reach
+        # a reducer before it does
+        phase_start = time.time()
+        reducer_addresses = [workers[r % len(workers)].data_address for r in range(num_reducers)]
+        for worker in workers:
+            worker.send('job', job_id, job, reducer_addresses)
+        self.wait_all(job_id, workers, 'ready')
+
+        pending = deque(enumerate(tasks))
+        idle = list(workers)
+        tasks_done = Counter()
+        keys_sent = 0
+        while sum(tasks_done.values()) < len(tasks):
+            while idle and pending:
+                task_id, task = pending.popleft()
+                idle.pop().send('map', job_id, task_id, task)
+            worker, message = self.next_event(job_id, workers)
+            if message[0] == 'map_done':
+                tasks_done[worker.name] += 1
+                keys_sent += message[3]
+                idle.append(worker)
+        timings['map'] = time.time() - phase_start
+
+        phase_start = time.time()
+        for worker in workers:
+            worker.send('reduce', job_id, output_dir)
+        parts = sorted(part for (reply,) in self.wait_all(job_id, workers, 'reduce_done').values() for part in reply)
+        if output_dir is None:
+            results = {}
+            for _, part in parts:
+                results.update(part)
+        else:
+            results = [path for _, path in parts]
+        timings['reduce'] = time.time() - phase_start
+        print(f"Job {job_id}: {len(tasks)} map tasks ({', '.join(f'{name} {count}' for name, count in sorted(tasks_done.items()))}), "
+              f"{keys_sent} keys shuffled, {lw4.format_timings(timings)}", flush=True)
+        end_time = time.time()
+        time_lasted = end_time - start_time
+        return results, time_lasted, timings
+
+    # accept() does not return on close() from another thread, so wake it up
+    # with a connection of our own
+    def shutdown(self):
+        self.stopping = True
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            try:
+                worker.send('shutdown')
+            except OSError:
+                pass
+        try:
+            Client(self.listener.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+
+# Store for lw4.run_map_task that sends the map output of each partition to
+# the worker reducing it, whenever the buffer fills up and at the end
+class ReducerStream:
+    def __init__(self, worker, job_id, buffer_keys):
+        self.worker = worker
+        self.job_id = job_id
+        self.buffer_keys = buffer_keys
+        self.keys_sent = 0
+
+    def map_output(self, num_partitions, combiner):
+        return lw4.MapOutput(num_partitions, combiner, self.spill, max_keys=self.buffer_keys)
+
+    def spill(self, partitions):
+        if partitions is None:
+            return self.keys_sent
+        for r, values_by_key in enumerate(partitions):
+            if values_by_key:
+                self.worker.deliver(self.job_id, r, values_by_key)
+                self.keys_sent += len(values_by_key)
+
+class Worker:
+    def __init__(self, coordinator_address, host='127.0.0.1', name=None, authkey=DEFAULT_AUTHKEY,
+                 buffer_keys=MAP_BUFFER_KEYS):
+        self.authkey = authkey
+        self.buffer_keys = buffer_keys
+        check_listen_address(host, authkey)
+        self.data_listener = Listener((host, 0), authkey=authkey)
+        self.data_address = self.data_listener.address
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.coordinator = Client(coordinator_address, authkey=authkey)
+        # Reducer data address -> connection, kept across jobs
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.job_id = None
+        self.job = None
+        self.reducer_addresses = []
+        # Partition this worker reduces -> its map output merged so far
+        self.merged = {}
+
+    def serve(self):
+        threading.Thread(target=self.accept_data, daemon=True).start()
+        self.coordinator.send(('register', self.name, self.data_address))
+        while True:
+            try:
+                command, *args = self.coordinator.recv()
+            except (EOFError, OSError):
+                return
+            if command == 'shutdown':
+                return
+            job_id = args[0]
+            try:
+                if command == 'job':
+                    self.start_job(*args)
+                    self.coordinator.send(('ready', job_id))
+                elif command == 'map':
+                    self.coordinator.send(('map_done', job_id, *self.run_map(*args)))
+                elif command == 'reduce':
+                    self.coordinator.send(('reduce_done', job_id, self.run_reduce(*args)))
+                elif command == 'abort':
+                    self.start_job(None, None, [])
+            except Exception:
+                self.coordinator.send(('error', job_id, traceback.format_exc()))
+
+    def start_job(self, job_id, job, reducer_addresses):
+        with self.lock:
+            self.job_id = job_id
+            self.job = job
+            self.reducer_addresses = reducer_addresses
+            self.merged = {r: {} for r, address in enumerate(reducer_addresses) if address == self.data_address}
+
+    def run_map(self, job_id, task_id, task):
+        return task_id, lw4.run_map_task(self.job, ReducerStream(self, job_id, self.buffer_keys),
+                                         len(self.reducer_addresses), task)
+
+    # Send map output to the reducer of partition r and wait for it to be
+    # merged there, so that map_done means the data has arrived
+    def deliver(self, job_id, r, values_by_key):
+        address = self.reducer_addresses[r]
+        if address == self.data_address:
+            if not self.receive(job_id, r, values_by_key):
+                raise JobError(f"Job {job_id} is no longer running")
+            return
+        connection = self.peers.get(address)
+        if connection is None:
+            connection = self.peers[address] = Client(address, authkey=self.authkey)
+        try:
+            connection.send(('data', job_id, r, values_by_key))
+            status, *reply = connection.recv()
+        except (EOFError, OSError):
+            del self.peers[address]
+            raise
+        if status != 'ok':
+            raise JobError(f"Reducer {format_address(address)}: {reply[0]}")
+
+    def receive(self, job_id, r, values_by_key):
+        with self.lock:
+            if job_id != self.job_id:
+                return False
+            lw4.merge_map_output(self.merged[r], values_by_key, self.job.combiner)
+            return True
+
+    def accept_data(self):
+        while True:
+            try:
+                connection = self.data_listener.accept()
+            except OSError:
+                return
+            except Exception:
+                continue
+            threading.Thread(target=self.serve_peer, args=(connection,), daemon=True).start()
+
+    def serve_peer(self, connection):
+        with connection:
+            while True:
+                try:
+                    _, job_id, r, values_by_key = connection.recv()
+                except (EOFError, OSError):
+                    return
+                if self.receive(job_id, r, values_by_key):
+                    connection.send(('ok',))
+                else:
+                    connection.send(('error', f"job {job_id} is not running here"))
+
+    # [(partition, result)] for the partitions of this worker
+    def run_reduce(self, job_id, output_dir):
+        with self.lock:
+            job, merged = self.job, self.merged
+            self.merged = {}
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        return [(r, lw4.run_reduce_task(job, lw4.MemoryStore(), output_dir, (r, [merged[r]])))
+                for r in sorted(merged)]
+
+class ClusterClient(JobClient):
+    def run(self, job, num_reducers=None, output_dir=None, min_workers=1, timeout=None):
+        return tuple(self.request('run', job, num_reducers, output_dir, min_workers, timeout))
+
+    def workers(self):
+        return self.request('workers')[0]
+
+def word_count_job(path, chunk_size=None):
+    return lw4.Job(lw4.mapper, lw4.reducer, lw4.FileSource(os.path.abspath(path), chunk_size), combiner=lw4.reducer)
+
+def print_results(results, time_lasted, timings, top):
+    print(f"{time_lasted:.3f}s ({lw4.format_timings(timings)})")
+    if isinstance(results, dict):
+        for word, count in sorted(results.items(), key=lambda item: item[1], reverse=True)[:top]:
+            print(f"{count:>10} {word}")
+    else:
+        print('\n'.join(results))
+
+# Coordinator in this process and num_workers worker processes on this machine
+def run_local(path, num_workers, num_reducers=None, chunk_size=None, output_dir=None, top=10):
+    coordinator = Coordinator()
+    address = coordinator.listen(('127.0.0.1', 0))
+    threading.Thread(target=coordinator.serve, daemon=True).start()
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = [subprocess.Popen([sys.executable, os.path.join(here, 'lw4_cluster.py'), 'worker',
+                                   '--coordinator', format_address(address)], cwd=here)
+                 for _ in range(num_workers)]
+    try:
+        results, time_lasted, timings = coordinator.run(word_count_job(path, chunk_size), num_reducers, output_dir,
+                                                        min_workers=num_workers, timeout=30)
+        print_results(results, time_lasted, timings, top)
+    finally:
+        coordinator.shutdown()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-node MapReduce for lw4")
+    commands = parser.add_subparsers(dest="command", required=True)
+    coordinator = commands.add_parser("coordinator", help="start the coordinator")
+    coordinator.add_argument("--host", default="127.0.0.1",
+                             help="address to listen on; other than loopback, LW4_AUTHKEY must be set")
+    coordinator.add_argument("--port", type=int, default=9000)
+    worker = commands.add_parser("worker", help="start a worker daemon")
+    worker.add_argument("--coordinator", default="127.0.0.1:9000")
+    worker.add_argument("--host", default="127.0.0.1", help="address the other workers reach this one on")
+    worker.add_argument("--name")
+    for name, help in (("wordcount", "run a word count job on the cluster"),
+                       ("local", "run a word count job on a coordinator and workers started here")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("path")
+        command.add_argument("--reducers", type=int)
+        command.add_argument("--chunk-size", type=int)
+        command.add_argument("--output-dir", help="write part files on the reducers instead of returning counts")
+        command.add_argument("--top", type=int, default=10, help="most common words to print")
+    commands.choices["wordcount"].add_argument("--coordinator", default="127.0.0.1:9000")
+    commands.choices["wordcount"].add_argument("--min-workers", type=int, default=1)
+    commands.choices["local"].add_argument("--workers", type=int, default=os.cpu_count())
+    shutdown = commands.add_parser("shutdown", help="stop the coordinator and its workers")
+    shutdown.add_argument("--coordinator", default="127.0.0.1:9000")
+    args = parser.parse_args()
+
+    if args.command == "coordinator":
+        server = Coordinator()
+        try:
+            address = server.listen((args.host, args.port))
+        except ValueError as e:
+            sys.exit(str(e))
+        print(f"lw4 coordinator on {format_address(address)}", flush=True)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "worker":
+        try:
+            daemon = Worker(parse_address(args.coordinator), args.host, args.name)
+        except ValueError as e:
+            sys.exit(str(e))
+        try:
+            daemon.serve()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "local":
+        run_local(args.path, args.workers, args.reducers, args.chunk_size, args.output_dir, args.top)
+    else:
+        try:
+            client = ClusterClient(parse_address(args.coordinator))
+        except OSError as e:
+            sys.exit(f"Cannot connect to the coordinator on {args.coordinator}: {e}")
+        with client:
+            if args.command == "shutdown":
+                client.shutdown()
+            else:
+                results, time_lasted, timings = client.run(word_count_job(args.path, args.chunk_size), args.reducers,
+                                                           args.output_dir, args.min_workers)
+                print_results(results, time_lasted, timings, args.top)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from collections import Counter
+import sys
+import numpy as np
+from lw4 import FileSource, Job, reducer
+
+# Vectorized word-count mapper: a whole block of bytes is tokenized, hashed
+# and counted with array operations, and Python only touches each distinct
+# word of the block once, to turn its id back into a str.
+# Words are separated by ASCII whitespace, like bytes.split(); the Counter
+# path splits the decoded text with str.split(), which also breaks on the
+# \x1c-\x1f separators and Unicode whitespace such as U+00A0, so the two
+# differ only on text containing those.
+# Words are identified by a 64-bit hash, so two distinct words of one block
+# are merged only if their hashes collide (about n^2 / 2^65 for n distinct
+# words)
+
+# Masks keeping the first i bytes of a little-endian 8-byte window, and the
+# odd multiplier that mixes every window into the hash
+MASKS = np.array([(1 << (8 * i)) - 1 for i in range(8)] + [(1 << 64) - 1], dtype=np.uint64)
+HASH_MIX = np.uint64(0x9e3779b97f4a7c15)
+
+# Start and end offsets of the words of buf
+def token_bounds(buf):
+    # Word bytes, with a non-word byte on either side: words start where this
+    # turns True and end where it turns False
+    is_word = np.zeros(len(buf) + 2, dtype=bool)
+    inner = is_word[1:-1]
+    # \t \n \v \f \r are 9-13; bytes below 9 wrap around to 247 and more
+    np.less(buf - np.uint8(9), 5, out=inner)
+    inner |= buf == ord(' ')
+    np.logical_not(inner, out=inner)
+    changes = np.flatnonzero(is_word[1:] != is_word[:-1])
+    return changes[0::2], changes[1::2]
+
+# Hash of every word from the 8-byte windows starting at each of its 8-byte
+# steps: a word of up to 8 bytes is a single masked window (times an odd
+# constant, which spreads it over the top bits), and longer words mix in
+# one more window per step, looping only over the words still that long
+def token_hashes(buf, starts, ends):
+    # 8 zero bytes of padding so the windows never run past the end
+    padded = np.zeros(len(buf) + 8, dtype=np.uint8)
+    padded[:len(buf)] = buf
+    windows = np.ndarray(shape=(len(buf) + 1,), dtype='<u8', buffer=padded, strides=(1,))
+    lengths = ends - starts
+    hashes = (windows[starts] & MASKS[np.minimum(lengths, 8)]) * HASH_MIX
+    long = np.flatnonzero(lengths > 8)
+    offset = 8
+    while len(long):
+        rest = lengths[long] - offset
+        window = windows[starts[long] + offset] & MASKS[np.minimum(rest, 8)]
+        hashes[long] = (hashes[long] ^ window) * HASH_MIX
+        offset += 8
+        long = long[rest > 8]
+    # Words differing only in trailing NUL bytes have the same windows
+    return hashes ^ lengths.astype(np.uint64)
+
+# The words at starts/ends (in buffer order) as str. Instead of slicing and
+# decoding them one by one, their bytes are gathered with one space after each
+# and decoded and split in a single call
+def decode_words(buf, starts, ends):
+    depth = np.zeros(len(buf) + 1, dtype=np.int8)
+    depth[starts] = 1
+    depth[ends] -= 1
+    in_word = np.cumsum(depth[:-1], dtype=np.int8).view(bool)
+    # The byte after every word is whitespace (or the end of the buffer)
+    keep = in_word.copy()
+    keep[ends[ends < len(buf)]] = True
+    gathered = buf[keep]
+    gathered[~in_word[keep]] = ord(' ')
+    return gathered.tobytes().decode('utf-8', errors='replace').split(' ')[:len(starts)]
+
+# Index of one token for each of the distinct hashes. A direct-mapped table
+# indexed by the top bits of the hash keeps the last token of every slot; only
+# the tokens whose hash lost its slot to another go through
+# np.unique(return_index=True), whose argsort costs ten times the plain sort
+def representatives(hashes, distinct):
+    bits = int(4 * distinct - 1).bit_length()
+    slots = (hashes >> np.uint64(64 - bits)).astype(np.intp)
+    table = np.full(1 << bits, -1, dtype=np.intp)
+    table[slots] = np.arange(len(hashes))
+    winners = table[table >= 0]
+    lost = np.flatnonzero(hashes[table[slots]] != hashes)
+    _, first = np.unique(hashes[lost], return_index=True)
+    return np.concatenate((winners, lost[first]))
+
+# Distinct words of a block with their counts: np.unique sorts the hashes and
+# counts the runs of equal ones, and a representative token of each hash
+# gives its word
+def count_block(block):
+    buf = np.frombuffer(block, dtype=np.uint8)
+    starts, ends = token_bounds(buf)
+    if len(starts) == 0:
+        return []
+    hashes = token_hashes(buf, starts, ends)
+    distinct, counts = np.unique(hashes, return_counts=True)
+    tokens = representatives(hashes, len(distinct))
+    # In the order of distinct, then in buffer order for decode_words
+    tokens = tokens[np.argsort(hashes[tokens])]
+    order = np.argsort(tokens)
+    tokens = tokens[order]
+    words = decode_words(buf, starts[tokens], ends[tokens])
+    return list(zip(words, counts[order].tolist()))
+
+def numpy_mapper(path, block):
+    return count_block(block)
+
+# Same job as lw4.mapreduce with the vectorized mapper. Bigger blocks than the
+# Counter path's amortize the per-call overhead of the array operations
+def mapreduce_numpy(path, num_workers, chunk_size=None, num_reducers=None, block_size=8 << 20, pool=None):
+    job = Job(numpy_mapper, reducer, FileSource(path, chunk_size, block_size, binary=True), combiner=reducer)
+    reduced_data, time_lasted = job.run(num_workers, num_reducers, pool=pool)
+    return Counter(reduced_data), time_lasted
+
+if __name__ == "__main__":
+    # Example usage
+    path = sys.argv[1] if len(sys.argv) > 1 else 'data.txt'
+    result, time_lasted = mapreduce_numpy(path, num_workers=2)
+    print(result, time_lasted)
@@ -0,0 +1,189 @@
+import argparse
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from multiprocessing import Pool
+from multiprocessing.connection import Client, Listener
+import lw4
+
+# Job server for repeated MapReduce runs: one long-lived pool of worker
+# processes runs every job, so jobs after the first pay neither process
+# start-up nor imports, and no job leaves workers behind.
+#   python lw4_server.py serve --workers 4
+#   python lw4_server.py wordcount data.txt --repeat 3
+# Clients connect over a Unix socket (multiprocessing.connection, which
+# checks authkey before accepting anything) and send lw4.Job objects. Jobs are
+# pickled, so their mapper/combiner/reducer must be importable by the server
+# (start it from the directory of the modules that define them). Every reply
+# carries the job's per-phase timings (lw4.PHASES). Jobs from several clients
+# run at the same time and share the workers
+
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'lw4.sock')
+DEFAULT_AUTHKEY = os.environ.get('LW4_AUTHKEY', 'lw4').encode()
+
+class JobError(Exception):
+    pass
+
+class JobServer:
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.pool = Pool(num_workers)
+        self.started = time.time()
+        self.jobs_run = 0
+        self.lock = threading.Lock()
+        self.listener = None
+        self.authkey = None
+        self.stopping = False
+
+    def run(self, job, num_reducers=None, output_dir=None):
+        results, time_lasted = job.run(self.num_workers, num_reducers, output_dir, pool=self.pool)
+        with self.lock:
+            self.jobs_run += 1
+        return results, time_lasted, job.timings
+
+    def stats(self):
+        return {'workers': self.num_workers, 'jobs_run': self.jobs_run, 'uptime': time.time() - self.started}
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                command, *args = request
+                try:
+                    if command == 'run':
+                        connection.send(('ok', *self.run(*args)))
+                    elif command == 'stats':
+                        connection.send(('ok', self.stats()))
+                    elif command == 'shutdown':
+                        connection.send(('ok',))
+                        self.shutdown()
+                        return
+                    else:
+                        connection.send(('error', f'Unknown command: {command}'))
+                except Exception:
+                    connection.send(('error', traceback.format_exc()))
+
+    def serve(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+        # A socket left by an earlier server is replaced; anything else at
+        # the path is left alone (and Listener fails on it)
+        try:
+            if stat.S_ISSOCK(os.lstat(address).st_mode):
+                os.remove(address)
+        except FileNotFoundError:
+            pass
+        self.authkey = authkey
+        self.listener = Listener(address, 'AF_UNIX', authkey=authkey)
+        try:
+            while not self.stopping:
+                try:
+                    connection = self.listener.accept()
+                except Exception:
+                    # Failed authentication or a client that went away
+                    continue
+                if self.stopping:
+                    connection.close()
+                    break
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+        finally:
+            self.listener.close()
+            self.close()
+
+    # accept() does not return on close() from another thread, so wake it up
+    # with a connection of our own
+    def shutdown(self):
+        self.stopping = True
+        try:
+            Client(self.listener.address, 'AF_UNIX', authkey=self.authkey).close()
+        except OSError:
+            pass
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class JobClient:
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+        self.connection = Client(address, authkey=authkey)
+
+    def request(self, *request):
+        self.connection.send(request)
+        status, *reply = self.connection.recv()
+        if status != 'ok':
+            raise JobError(reply[0])
+        return reply
+
+    # What lw4.Job.run returns, plus the job's phase timings
+    def run(self, job, num_reducers=None, output_dir=None):
+        return tuple(self.request('run', job, num_reducers, output_dir))
+
+    def stats(self):
+        return self.request('stats')[0]
+
+    def shutdown(self):
+        self.request('shutdown')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-lived MapReduce job server for lw4")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="Unix socket path")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="start the server")
+    serve.add_argument("--workers", type=int, default=os.cpu_count())
+    wordcount = commands.add_parser("wordcount", help="run word count jobs on the server")
+    wordcount.add_argument("path")
+    wordcount.add_argument("--reducers", type=int)
+    wordcount.add_argument("--chunk-size", type=int)
+    wordcount.add_argument("--repeat", type=int, default=1)
+    wordcount.add_argument("--top", type=int, default=10, help="most common words to print")
+    commands.add_parser("stats", help="print the server's counters")
+    commands.add_parser("shutdown", help="stop the server")
+    args = parser.parse_args()
+    if args.command == "wordcount" and args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    if args.command == "serve":
+        server = JobServer(args.workers)
+        print(f"lw4 job server with {args.workers} workers on {args.address}", flush=True)
+        try:
+            server.serve(args.address)
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            sys.exit(f"Cannot listen on {args.address}: {e}")
+        return
+
+    try:
+        client = JobClient(args.address)
+    except OSError as e:
+        sys.exit(f"Cannot connect to the job server on {args.address}: {e}")
+    with client:
+        if args.command == "wordcount":
+            path = os.path.abspath(args.path)
+            for _ in range(args.repeat):
+                job = lw4.Job(lw4.mapper, lw4.reducer, lw4.FileSource(path, args.chunk_size), combiner=lw4.reducer)
+                results, time_lasted, timings = client.run(job, args.reducers)
+                print(f"{time_lasted:.3f}s ({lw4.format_timings(timings)})")
+            for word, count in sorted(results.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+                print(f"{count:>10} {word}")
+        elif args.command == "stats":
+            print(client.stats())
+        else:
+            client.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,41 @@
 import os
 import socket
 import random
-import requests
+from upstream_pool import UpstreamPool, UpstreamError
+from http_cache import ResponseCache
+from relay import relay_response
+from health import BackendHealth
 from kubernetes import client, config
 
+# LB_BACKENDS="http://host:port/,..." replaces the Reddit servers (e.g. with
+# local stub backends for benchmarks) and needs no Kubernetes configuration
+lb_backends = os.getenv("LB_BACKENDS")
+
 # Load Kubernetes configuration
-config.load_kube_config()
+if not lb_backends:
+    config.load_kube_config()
 
 # Kubernetes API client
 v1 = client.CoreV1Api()
 
 # Function to get the list of Reddit server pods
 def get_reddit_servers():
+    if lb_backends:
+        return lb_backends.split(",")
     reddit_servers = ['https://www.reddit.com/r/Music/', 'https://www.reddit.com/r/musictheory/', 'https://www.reddit.com/r/red_velvet/']
     return reddit_servers
 
 # Round-robin load balancing algorithm
 def handle_request_round_robin(next_server_index):
-    reddit_servers = get_reddit_servers()
+    reddit_servers = backend_health.get()
+    next_server_index %= len(reddit_servers)
     reddit_server = reddit_servers[next_server_index]
     next_server_index = (next_server_index + 1) % len(reddit_servers)
     return reddit_server, next_server_index
 
 # Least connections load balancing algorithm
 def handle_request_least_connections(next_server_index):
-    reddit_servers = get_reddit_servers()
+    reddit_servers = backend_health.get()
     reddit_server = min(reddit_servers, key=lambda server: get_connection_count(server))
     return reddit_server, next_server_index
 
@@ -42,6 +53,49 @@ sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 sock.bind((lb_address, lb_port))
 sock.listen(5)
 
+# Keep-alive connections to the Reddit servers, reused across clients
+upstream = UpstreamPool(
+    max_connections=int(os.getenv("LB_POOL_MAX_CONNECTIONS", 10)),
+    idle_timeout=float(os.getenv("LB_POOL_IDLE_TIMEOUT", 30)),
+)
+upstream.start_reaper()
+
+# Responses are relayed through one fixed buffer ("splice", "stream" or "buffered")
+relay_mode = os.getenv("LB_RELAY", "splice")
+relay_buffer = bytearray(int(os.getenv("LB_RELAY_BUFFER", 64 * 1024)))
+
+# Cache of Reddit server responses (LB_CACHE_BYTES of bodies, 0 disables it).
+# Backends' Cache-Control/ETag headers decide what is cached and for how long;
+# LB_CACHE_TTL / LB_CACHE_SWR apply to responses that say nothing
+cache_bytes = int(os.getenv("LB_CACHE_BYTES", 64 * 1024 * 1024))
+response_cache = None
+if cache_bytes > 0:
+    response_cache = ResponseCache(
+        upstream,
+        max_bytes=cache_bytes,
+        default_ttl=float(os.getenv("LB_CACHE_TTL", 0)),
+        default_swr=float(os.getenv("LB_CACHE_SWR", 0)),
+    )
+
+# Health of the Reddit servers: active probes every LB_HEALTH_INTERVAL seconds
+# ("http", "tcp" or none), and servers whose requests keep failing are ejected
+# for a while. Only available servers are chosen
+backend_health = BackendHealth(
+    probe=os.getenv("LB_HEALTH_PROBE", "http"),
+    interval=float(os.getenv("LB_HEALTH_INTERVAL", 5)),
+    timeout=float(os.getenv("LB_HEALTH_TIMEOUT", 2)),
+    failure_threshold=int(os.getenv("LB_EJECT_FAILURES", 5)),
+    base_ejection=float(os.getenv("LB_EJECT_TIME", 10)),
+)
+backend_health.set_backends(get_reddit_servers())
+backend_health.start()
+
+# Get the response for a Reddit server, from the cache when possible
+def open_response(reddit_server):
+    if response_cache is not None:
+        return response_cache.get(reddit_server)
+    return upstream.open(reddit_server)
+
 # Next server index for round-robin
 next_server_index = 0
 
@@ -58,14 +112,23 @@ while True:
 
     # Forward the request to the Reddit server
     try:
-        response = requests.get(reddit_server)
+        response = open_response(reddit_server)
         response.raise_for_status()
-    except requests.exceptions.RequestException as e:
+    except UpstreamError as e:
+        backend_health.report(reddit_server, not e.is_backend_failure())
         print(f'Error forwarding request to Reddit server: {e}')
         conn.sendall(b'Error: Could not connect to Reddit server.')
         conn.close()
         continue
 
-    # Send the response back to the client
-    conn.sendall(response.content)
+    backend_health.report(reddit_server, True)
+
+    # Send the response back to the client as it arrives
+    try:
+        with response:
+            relay_response(response, conn, relay_buffer, relay_mode)
+    except (UpstreamError, OSError) as e:
+        print(f'Error relaying response to {addr}: {e}')
+        conn.close()
+        continue
     conn.close()
\ No newline at end of file
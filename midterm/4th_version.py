@@ -1,17 +1,30 @@
 import os
 import socket
 import random
-import requests
+from upstream_pool import UpstreamPool, UpstreamError
+from http_cache import ResponseCache
+from relay import relay_stream_async
 from kubernetes import client, config
 import logging
-import threading
-
-# Configure logging
-logging.basicConfig(
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import async_server
+from discovery import BackendRegistry, KubernetesPodSource, StaticSource
+from scheduler import make_scheduler, parse_weights
+from health import BackendHealth
+from policy import ForwardPolicy, NoBackendError
+from metrics import Registry, start_http_server
+from logs import SampledLogger, setup_logging
+
+# Configure logging: written by a background thread, and only LB_LOG_SAMPLE
+# of the per-request lines are kept (warnings and errors always are)
+setup_logging(
     level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    format='%(asctime)s [%(levelname)s] [%(process)d] %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
 )
+request_log = SampledLogger(logging.getLogger(), float(os.getenv("LB_LOG_SAMPLE", 0.01)))
 
 # Kubernetes API client configuration
 kubernetes_host = os.getenv("KUBERNETES_HOST", "https://kubernetes.default.svc")
@@ -25,121 +38,213 @@ configuration.verify_ssl = False
 client.Configuration.set_default(configuration)
 v1 = client.CoreV1Api()
 
-# Function to get the list of Reddit server pods
-def get_reddit_servers():
-    try:
-        pods = v1.list_pod_for_all_namespaces(watch=False)
-        reddit_servers = []
-        for pod in pods.items:
-            if pod.metadata.name.startswith("reddit-server-"):
-                reddit_servers.append(f"http://{pod.status.pod_ip}:8000")
-        
-        print(len(reddit_servers))
-        return reddit_servers
-    
-    except Exception as e:
-        logging.error(f"Error getting Reddit server pods: {e}")
-        return []
-
-
-# Round-robin load balancing algorithm
-def handle_request_round_robin(next_server_index):
-    reddit_servers = get_reddit_servers()
-    if not reddit_servers:
-        return None, next_server_index
-    reddit_server = reddit_servers[next_server_index]
-    next_server_index = (next_server_index + 1) % len(reddit_servers)
-    return reddit_server, next_server_index
-
-# Least connections load balancing algorithm
-def handle_request_least_connections(next_server_index):
-    reddit_servers = get_reddit_servers()
-    if not reddit_servers:
-        return None, next_server_index
-    reddit_server = min(reddit_servers, key=lambda server: get_connection_count(server))
-    return reddit_server, next_server_index
-
-# Dictionary to store the connection counts for each Reddit server
-connection_counts = {}
-
-# Function to get the number of active connections for a Reddit server
-def get_connection_count(reddit_server):
-    if reddit_server in connection_counts:
-        return connection_counts[reddit_server]
-    else:
-        return 0
-
-# Function to update the connection count for a Reddit server
-def update_connection_count(reddit_server, increment):
-    if reddit_server in connection_counts:
-        connection_counts[reddit_server] += increment
-    else:
-        connection_counts[reddit_server] = 1 if increment > 0 else 0
+# Reddit server pods are listed once and then kept current by a background
+# watch, instead of listing every pod in the cluster on each request.
+# LB_BACKENDS="http://host:port/,..." uses a fixed list instead (e.g. local
+# stub backends for benchmarks)
+if os.getenv("LB_BACKENDS"):
+    reddit_source = StaticSource(os.getenv("LB_BACKENDS").split(","))
+else:
+    reddit_source = KubernetesPodSource(
+        v1,
+        namespace=os.getenv("LB_NAMESPACE") or None,
+        label_selector=os.getenv("LB_LABEL_SELECTOR") or None,
+        name_prefix=os.getenv("LB_POD_PREFIX", "reddit-server-"),
+        port=int(os.getenv("LB_POD_PORT", 8000)),
+    )
+reddit_registry = BackendRegistry(reddit_source, watch_timeout=int(os.getenv("LB_WATCH_TIMEOUT", 300)))
 
 # Load balancer server address and port
 lb_address = os.getenv("LB_ADDRESS", "127.0.0.1")
 lb_port = int(os.getenv("LB_PORT", 8080))
 
-# Create a socket for the load balancer
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sock.bind((lb_address, lb_port))
-sock.listen(5)
+# Scheduling policy: "least_connections" (default), "round_robin", "power_of_two"
+# or "peak_ewma" (latency-aware),
+# optionally weighted with LB_WEIGHTS="http://10.0.0.1:8000=2,..."
+lb_policy = os.getenv("LB_POLICY", "least_connections")
+lb_weights = parse_weights(os.getenv("LB_WEIGHTS"))
 
-# Next server index for round-robin
-next_server_index = 0
+# Number of event-loop worker processes (SO_REUSEPORT when > 1)
+lb_workers = int(os.getenv("LB_WORKERS", 1))
 
-logging.info(f'Load balancer listening on {lb_address}:{lb_port}')
+# Maximum number of open client connections per worker
+lb_max_clients = int(os.getenv("LB_MAX_CLIENTS", 10000))
 
-def handle_client(conn, addr, next_server_index):
-    try:
-        # Choose a Reddit server
-        reddit_server, next_server_index = handle_request_least_connections(next_server_index)
-        if not reddit_server:
-            logging.error("No Reddit servers available, unable to forward request")
-            conn.sendall(b'Error: No Reddit servers available.')
-            conn.close()
-            return
+# Maximum number of requests being forwarded to Reddit servers at once per worker
+lb_max_inflight = int(os.getenv("LB_MAX_INFLIGHT", 64))
+
+# The upstream calls are blocking, so they run on a bounded
+# thread pool; the semaphore keeps waiting clients in the event loop instead
+# of queueing unbounded work in the executor
+executor = ThreadPoolExecutor(max_workers=lb_max_inflight, thread_name_prefix="forward")
+inflight = asyncio.Semaphore(lb_max_inflight)
 
-        logging.info(f'[{threading.current_thread().name}] Forwarding request to Reddit server: {reddit_server}')
+# Keep-alive connections to the Reddit servers, reused across clients
+upstream = UpstreamPool(
+    max_connections=int(os.getenv("LB_POOL_MAX_CONNECTIONS", 10)),
+    idle_timeout=float(os.getenv("LB_POOL_IDLE_TIMEOUT", 30)),
+)
 
-        # Update the connection count for the Reddit server
-        update_connection_count(reddit_server, 1)
+# Responses are streamed to the client through a fixed per-connection buffer;
+# LB_RELAY=buffered reads the whole body first instead
+relay_mode = os.getenv("LB_RELAY", "stream")
+relay_buffer_size = int(os.getenv("LB_RELAY_BUFFER", 64 * 1024))
+
+# Cache of Reddit server responses (LB_CACHE_BYTES of bodies, 0 disables it).
+# Backends' Cache-Control/ETag headers decide what is cached and for how long;
+# LB_CACHE_TTL / LB_CACHE_SWR apply to responses that say nothing
+cache_bytes = int(os.getenv("LB_CACHE_BYTES", 64 * 1024 * 1024))
+response_cache = None
+if cache_bytes > 0:
+    response_cache = ResponseCache(
+        upstream,
+        max_bytes=cache_bytes,
+        default_ttl=float(os.getenv("LB_CACHE_TTL", 0)),
+        default_swr=float(os.getenv("LB_CACHE_SWR", 0)),
+    )
+
+# Health of the discovered Reddit servers: active probes every
+# LB_HEALTH_INTERVAL seconds ("http", "tcp" or "none") plus ejection of servers
+# whose requests keep failing. Only available servers reach the scheduler
+backend_health = BackendHealth(
+    probe=os.getenv("LB_HEALTH_PROBE", "http"),
+    interval=float(os.getenv("LB_HEALTH_INTERVAL", 5)),
+    timeout=float(os.getenv("LB_HEALTH_TIMEOUT", 2)),
+    failure_threshold=int(os.getenv("LB_EJECT_FAILURES", 5)),
+    base_ejection=float(os.getenv("LB_EJECT_TIME", 10)),
+    max_ejection_percent=float(os.getenv("LB_MAX_EJECTION_PERCENT", 50)),
+)
+reddit_registry.subscribe(backend_health.set_backends)
+
+# Chooses the Reddit server for each client and tracks the requests in flight
+scheduler = make_scheduler(lb_policy, weights=lb_weights)
+backend_health.subscribe(lambda servers: scheduler.set_backends(servers, lb_weights))
+
+# Failed requests are retried on another Reddit server (LB_MAX_ATTEMPTS
+# attempts in total); with LB_HEDGE=1 a request that takes longer than the
+# p95 of recent requests is also sent to a second server and the faster one
+# wins. Retries and hedges together stay within LB_RETRY_BUDGET of the traffic
+forward_policy = ForwardPolicy(
+    scheduler,
+    health=backend_health,
+    max_attempts=int(os.getenv("LB_MAX_ATTEMPTS", 2)),
+    retryable=lambda e: isinstance(e, UpstreamError) and e.is_backend_failure(),
+    hedge=os.getenv("LB_HEDGE", "0") == "1",
+    hedge_quantile=float(os.getenv("LB_HEDGE_QUANTILE", 0.95)),
+    budget_ratio=float(os.getenv("LB_RETRY_BUDGET", 0.2)),
+    max_workers=2 * lb_max_inflight,
+)
 
-        # Forward the request to the Reddit server
+# Metrics in the Prometheus format on LB_METRICS_PORT (0 disables them);
+# with several workers, worker i serves its own metrics on LB_METRICS_PORT + i
+metrics_port = int(os.getenv("LB_METRICS_PORT", 9100))
+metrics = Registry()
+requests_total = metrics.counter("lb_requests_total", "Client requests by Reddit server and outcome", ("backend", "outcome"))
+upstream_latency = metrics.histogram(
+    "lb_upstream_latency_seconds", "Time until the Reddit server's response headers, retries included", ("backend",))
+request_duration = metrics.histogram("lb_request_duration_seconds", "Time from accepting a client to the end of its response")
+relayed_bytes = metrics.counter("lb_relayed_bytes_total", "Response bytes sent to clients", ("backend",))
+metrics.callback("lb_inflight_requests", "Requests in flight per Reddit server", "gauge",
+                 lambda: {(backend,): count for backend, count in scheduler.snapshot().items()}, ("backend",))
+metrics.callback("lb_available_backends", "Reddit servers that pass their health checks", "gauge",
+                 lambda: len(backend_health.get()))
+metrics.callback("lb_forward_events_total", "Retries and hedged requests", "counter",
+                 lambda: {(name,): value for name, value in forward_policy.stats().items() if name != "hedge_delay"}, ("event",))
+metrics.callback("lb_hedge_delay_seconds", "Current delay before a request is hedged", "gauge",
+                 lambda: forward_policy.stats()["hedge_delay"])
+
+# One metric per connection pool statistic, labelled by Reddit server
+def pool_stat(name):
+    return lambda: {(backend,): stats[name] for backend, stats in upstream.stats().items()}
+
+metrics.callback("lb_pool_idle_connections", "Idle keep-alive connections", "gauge", pool_stat("idle"), ("backend",))
+metrics.callback("lb_pool_created_total", "Connections opened", "counter", pool_stat("created"), ("backend",))
+metrics.callback("lb_pool_reused_total", "Requests sent on a reused connection", "counter", pool_stat("reused"), ("backend",))
+metrics.callback("lb_pool_waits_total", "Requests that waited for a free connection", "counter", pool_stat("waited"), ("backend",))
+metrics.callback("lb_pool_wait_seconds_total", "Time spent waiting for a free connection", "counter", pool_stat("wait_time"), ("backend",))
+metrics.callback("lb_pool_timeouts_total", "Requests that gave up waiting for a connection", "counter", pool_stat("timeouts"), ("backend",))
+if response_cache is not None:
+    metrics.callback("lb_cache_events_total", "Response cache lookups by result", "counter",
+                     lambda: {(name,): value for name, value in response_cache.stats().items()
+                              if name in ("hits", "stale_hits", "misses", "revalidated", "coalesced")}, ("event",))
+    metrics.callback("lb_cache_bytes", "Size of the cached responses", "gauge", lambda: response_cache.stats()["size"])
+
+def forward_request(reddit_server):
+    if response_cache is not None:
+        return response_cache.get(reddit_server)
+    response = upstream.open(reddit_server)
+    response.raise_for_status()
+    return response
+
+async def handle_client(reader, writer, addr):
+    request_log.info('Received connection from %s', addr)
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+
+    # Choose a Reddit server and forward the request to it
+    async with inflight:
         try:
-            response = requests.get(reddit_server)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logging.error(f'[{threading.current_thread().name}] Error forwarding request to Reddit server: {e}')
-            conn.sendall(b'Error: Could not connect to Reddit server.')
-            conn.close()
-            update_connection_count(reddit_server, -1)
+            reddit_server, response = await loop.run_in_executor(executor, forward_policy.forward, forward_request)
+        except NoBackendError:
+            requests_total.labels("", "no_backend").inc()
+            logging.error("No Reddit servers available, unable to forward request")
+            writer.write(b'Error: No Reddit servers available.')
+            await writer.drain()
             return
+        except UpstreamError as e:
+            requests_total.labels("", "upstream_error").inc()
+            logging.error(f'Error forwarding request from {addr} to Reddit server: {e}')
+            writer.write(b'Error: Could not connect to Reddit server.')
+            await writer.drain()
+            return
+
+    upstream_latency.labels(reddit_server).observe(time.monotonic() - start)
+    request_log.info('Forwarded request from %s to Reddit server: %s', addr, reddit_server)
 
-        # Send the response back to the client
-        conn.sendall(response.content)
-        logging.info(f'[{threading.current_thread().name}] Sent response to {addr}')
+    # The scheduler slot is held until the client is done, however the relay
+    # ends (errors, cancellation); an inflight slot only while the body is
+    # read on the executor, not while an idle client stays connected
+    try:
+        # Send the response back to the client as it arrives
+        try:
+            async with inflight:
+                with response:
+                    if relay_mode == "buffered":
+                        content = await loop.run_in_executor(executor, response.read)
+                        writer.write(content)
+                        await writer.drain()
+                        relayed = len(content)
+                    else:
+                        relayed = await relay_stream_async(response, writer, bytearray(relay_buffer_size), executor)
+        except (UpstreamError, OSError) as e:
+            requests_total.labels(reddit_server, "relay_error").inc()
+            logging.error(f'Error relaying response to {addr}: {e}')
+            if isinstance(e, UpstreamError):
+                backend_health.report(reddit_server, not e.is_backend_failure())
+            return
+        requests_total.labels(reddit_server, "ok").inc()
+        relayed_bytes.labels(reddit_server).inc(relayed)
+        request_duration.observe(time.monotonic() - start)
+        request_log.info('Sent response to %s', addr)
 
         # Wait for the client to disconnect
-        conn.settimeout(60)  # Timeout after 60 seconds of inactivity
         try:
-            data = conn.recv(1)
-            if not data:
-                update_connection_count(reddit_server, -1)
-                logging.info(f'[{threading.current_thread().name}] Client {addr} disconnected')
-        except socket.timeout:
-            update_connection_count(reddit_server, -1)
-            logging.info(f'[{threading.current_thread().name}] Client {addr} disconnected (timeout)')
-        finally:
-            conn.close()
-    except Exception as e:
-        logging.error(f'[{threading.current_thread().name}] Unexpected error: {e}')
-
-while True:
-    try:
-        # Wait for a connection
-        conn, addr = sock.accept()
-        logging.info(f'Received connection from {addr}')
-        threading.Thread(target=handle_client, args=(conn, addr, next_server_index), daemon=True).start()
-    except Exception as e:
-        logging.error(f'Unexpected error: {e}')
\ No newline at end of file
+            # Timeout after 60 seconds of inactivity
+            await asyncio.wait_for(reader.read(1), timeout=60)
+            request_log.info('Client %s disconnected', addr)
+        except asyncio.TimeoutError:
+            request_log.info('Client %s disconnected (timeout)', addr)
+    finally:
+        scheduler.release(reddit_server)
+
+# Called in every worker process before it starts serving
+def init_worker(index):
+    reddit_registry.start()
+    backend_health.start()
+    upstream.start_reaper()
+    if metrics_port:
+        start_http_server(metrics, lb_address, metrics_port + index)
+
+if __name__ == "__main__":
+    logging.info(f'Load balancer listening on {lb_address}:{lb_port} ({lb_workers} worker(s), policy {lb_policy})')
+    async_server.run(handle_client, lb_address, lb_port, workers=lb_workers, max_clients=lb_max_clients, init=init_worker)
@@ -4,13 +4,23 @@ import random
 import redis
 import logging
 import threading
+import time
+from scheduler import make_scheduler, parse_weights
+from redis_pool import RedisPools
+from health import BackendHealth
+from cache import LocalCache, SingleFlight
+from metrics import Registry, start_http_server
+from logs import SampledLogger, setup_logging
+from resp import RequestParser, ProtocolError, LINE, encode_array, encode_bulk, encode_error, encode_simple
 
-# Configure logging
-logging.basicConfig(
+# Configure logging: written by a background thread, and only LB_LOG_SAMPLE
+# of the per-request lines are kept (warnings and errors always are)
+setup_logging(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    datefmt='%Y-%m-%d %H:%M:%S',
 )
+request_log = SampledLogger(logging.getLogger(), float(os.getenv("LB_LOG_SAMPLE", 0.01)))
 
 # Redis server configuration
 
@@ -21,43 +31,106 @@ redis_hosts = os.getenv("REDIS_HOSTS", "127.0.0.1:6379").split(",") #redis_hosts
 
 print(redis_hosts)
 
-# Round-robin load balancing algorithm
-def handle_request_round_robin(next_server_index):
-    if not redis_hosts:
-        return None, next_server_index
-    redis_server = redis_hosts[next_server_index]
-    next_server_index = (next_server_index + 1) % len(redis_hosts)
-    return redis_server, next_server_index
+# Scheduling policy: "round_robin" (default), "least_connections", "power_of_two",
+# "peak_ewma" (latency-aware) or "consistent_hash", optionally weighted with
+# LB_WEIGHTS="10.0.0.1:6379=2,..."
+lb_policy = os.getenv("LB_POLICY", "round_robin")
 
-#--------------------------------------------------------------------------------#
-# This is used for the least connection algorithm
+# consistent_hash sends the same key to the same Redis server, so each key is
+# cached on one node; LB_LOAD_FACTOR bounds how far above the average load a
+# node may go before its keys spill to the next node ("none" to disable)
+scheduler_options = {}
+if lb_policy == "consistent_hash":
+    load_factor = os.getenv("LB_LOAD_FACTOR", "1.25")
+    scheduler_options = {
+        "vnodes": int(os.getenv("LB_VNODES", 160)),
+        "load_factor": None if load_factor == "none" else float(load_factor),
+    }
 
-# Least connections load balancing algorithm
-def handle_request_least_connections(next_server_index):
-    if not redis_hosts:
-        return None, next_server_index
-    redis_server = min(redis_hosts, key=lambda host: get_connection_count(host))
-    return redis_server, next_server_index
+# Chooses the Redis server for each client and tracks the requests in flight
+lb_weights = parse_weights(os.getenv("LB_WEIGHTS"))
+scheduler = make_scheduler(lb_policy, weights=lb_weights, **scheduler_options)
 
-# Dictionary to store the connection counts for each Redis server
-connection_counts = {}
+# Health of the Redis servers: PING every LB_HEALTH_INTERVAL seconds plus
+# ejection of servers whose requests keep failing. Only available servers
+# reach the scheduler (with consistent_hash, the keys of an ejected server move
+# to the next node on the ring and come back when it does)
+backend_health = BackendHealth(
+    probe=os.getenv("LB_HEALTH_PROBE", "redis"),
+    interval=float(os.getenv("LB_HEALTH_INTERVAL", 5)),
+    timeout=float(os.getenv("LB_HEALTH_TIMEOUT", 2)),
+    failure_threshold=int(os.getenv("LB_EJECT_FAILURES", 5)),
+    base_ejection=float(os.getenv("LB_EJECT_TIME", 10)),
+    max_ejection_percent=float(os.getenv("LB_MAX_EJECTION_PERCENT", 50)),
+)
+backend_health.set_backends(redis_hosts)
+backend_health.subscribe(lambda servers: scheduler.set_backends(servers, lb_weights))
+backend_health.start()
+
+# Persistent connections to every Redis server, shared by all client threads
+redis_pools = RedisPools(
+    redis_hosts,
+    max_connections=int(os.getenv("REDIS_POOL_MAX_CONNECTIONS", 50)),
+    pool_timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 5)),
+    socket_timeout=5,
+)
+
+# Optional local cache for hot keys: REDIS_CACHE_SIZE entries (0 disables it),
+# kept for REDIS_CACHE_TTL seconds, evicted with REDIS_CACHE_POLICY
+# ("tinylfu" or "lru"). Values may be up to REDIS_CACHE_TTL seconds stale
+cache_size = int(os.getenv("REDIS_CACHE_SIZE", 0))
+hot_cache = None
+if cache_size > 0:
+    hot_cache = LocalCache(
+        max_size=cache_size,
+        ttl=float(os.getenv("REDIS_CACHE_TTL", 1)),
+        policy=os.getenv("REDIS_CACHE_POLICY", "tinylfu"),
+    )
+hot_key_flights = SingleFlight()
+
+# Log the pool and cache statistics every LB_STATS_INTERVAL seconds (0 disables)
+stats_interval = float(os.getenv("LB_STATS_INTERVAL", 60))
+
+def report_pool_stats():
+    while True:
+        time.sleep(stats_interval)
+        for host, stats in redis_pools.snapshot().items():
+            logging.info(f'Redis pool {host}: {stats}')
+        if hot_cache is not None:
+            logging.info(f'Hot key cache: {hot_cache.stats()}, coalesced {hot_key_flights.coalesced}')
 
-# Function to get the number of active connections for a Redis server
-def get_connection_count(redis_server):
-    if redis_server in connection_counts:
-        return connection_counts[redis_server]
-    else:
-        return 0
+if stats_interval > 0:
+    threading.Thread(target=report_pool_stats, name="pool-stats", daemon=True).start()
 
-# Function to update the connection count for a Redis server
-def update_connection_count(redis_server, increment):
-    if redis_server in connection_counts:
-        connection_counts[redis_server] += increment
-    else:
-        connection_counts[redis_server] = 1 if increment > 0 else 0
+# Metrics in the Prometheus format on LB_METRICS_PORT (0 disables them)
+metrics_port = int(os.getenv("LB_METRICS_PORT", 9100))
+metrics = Registry()
+requests_total = metrics.counter("lb_requests_total", "Client requests (commands or lines)")
+request_duration = metrics.histogram("lb_request_duration_seconds", "Time to answer one batch of pipelined requests")
+keys_total = metrics.counter("lb_keys_total", "Keys looked up by Redis server and outcome", ("backend", "outcome"))
+redis_latency = metrics.histogram("lb_redis_latency_seconds", "Time of one GET/MGET round trip", ("backend",))
+metrics.callback("lb_inflight_requests", "Lookups in flight per Redis server", "gauge",
+                 lambda: {(backend,): count for backend, count in scheduler.snapshot().items()}, ("backend",))
+metrics.callback("lb_available_backends", "Redis servers that pass their health checks", "gauge",
+                 lambda: len(backend_health.get()))
 
-#--------------------------------------------------------------------------------#
+# One metric per connection pool statistic, labelled by Redis server
+def pool_stat(name):
+    return lambda: {(host,): stats[name] for host, stats in redis_pools.snapshot().items()}
 
+metrics.callback("lb_pool_acquired_total", "Connections taken from the pool", "counter", pool_stat("acquired"), ("backend",))
+metrics.callback("lb_pool_waits_total", "Lookups that waited for a free connection", "counter", pool_stat("waited"), ("backend",))
+metrics.callback("lb_pool_wait_seconds_total", "Time spent waiting for a free connection", "counter", pool_stat("wait_time"), ("backend",))
+metrics.callback("lb_pool_timeouts_total", "Lookups that gave up waiting for a connection", "counter", pool_stat("timeouts"), ("backend",))
+if hot_cache is not None:
+    metrics.callback("lb_cache_events_total", "Hot key cache lookups by result", "counter",
+                     lambda: {(name,): value for name, value in hot_cache.stats().items()
+                              if name in ("hits", "misses", "evictions", "expirations", "rejections")}, ("event",))
+    metrics.callback("lb_cache_coalesced_total", "Lookups that waited for another thread's fetch", "counter",
+                     lambda: hot_key_flights.coalesced)
+
+if metrics_port:
+    start_http_server(metrics, os.getenv("LB_ADDRESS", "127.0.0.1"), metrics_port)
 
 # Load balancer server address and port
 lb_address = os.getenv("LB_ADDRESS", "127.0.0.1")
@@ -68,65 +141,186 @@ sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 sock.bind((lb_address, lb_port))
 sock.listen(5)
 
-# Next server index for round-robin
-next_server_index = 0
-
 logging.info(f'Load balancer listening on {lb_address}:{lb_port}')
 
-def handle_client(conn, addr, next_server_index):
+# Error returned for keys that could not be looked up
+NO_SERVERS = redis.exceptions.ConnectionError('No Redis servers available')
+
+# Fetch keys from the Redis servers: every key goes to the server the
+# scheduler picks for it and the keys of one server are fetched with a single
+# MGET. Returns one result per key: the value, None if the key does not exist,
+# or the RedisError if its server could not be reached
+def fetch_keys(keys):
+    servers = [scheduler.acquire(key) for key in keys]
     try:
-        # Choose a Redis server
-        redis_server, next_server_index = handle_request_round_robin(next_server_index)
+        keys_by_server = {}
+        for i, redis_server in enumerate(servers):
+            keys_by_server.setdefault(redis_server, []).append(i)
 
-        if not redis_server:
-            logging.error("No Redis servers available, unable to forward request")
-            conn.sendall(b'Error: No Redis servers available.')
-            conn.close()
-            return
+        results = [None] * len(keys)
+        for redis_server, indexes in keys_by_server.items():
+            if redis_server is None:
+                keys_total.labels("", "no_backend").inc(len(indexes))
+                logging.error("No Redis servers available, unable to forward request")
+                values = [NO_SERVERS] * len(indexes)
+            else:
+                try:
+                    start = time.monotonic()
+                    values = redis_pools.get_many(redis_server, [keys[i] for i in indexes])
+                    latency = time.monotonic() - start
+                    scheduler.observe(redis_server, latency)
+                    redis_latency.labels(redis_server).observe(latency)
+                    keys_total.labels(redis_server, "ok").inc(len(indexes))
+                    backend_health.report(redis_server, True)
+                except redis.exceptions.RedisError as e:
+                    keys_total.labels(redis_server, "error").inc(len(indexes))
+                    # Command errors are the client's problem, not the server's
+                    backend_health.report(redis_server, not isinstance(e, (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)))
+                    logging.error(f'[{threading.current_thread().name}] Error forwarding request to Redis server {redis_server}: {e}')
+                    values = [e] * len(indexes)
+            for i, value in zip(indexes, values):
+                results[i] = value
+        return results
+    finally:
+        for redis_server in servers:
+            if redis_server is not None:
+                scheduler.release(redis_server)
 
-        logging.info(f'[{threading.current_thread().name}] Forwarding request to Redis server: {redis_server}')
+# Look up keys, serving hot keys from the local cache when it is enabled.
+# Missing keys are fetched in one batch; a key that another thread is already
+# fetching is not fetched again, we wait for that thread's result instead
+def lookup_keys(keys):
+    if hot_cache is None:
+        return fetch_keys(keys)
 
-        # Update the connection count for the Redis server
-        update_connection_count(redis_server, 1)
+    results = [None] * len(keys)
+    leading = []  # (index, key, call) fetched by this thread
+    waiting = []  # (index, call) fetched by another request
+    for i, key in enumerate(keys):
+        hit, value = hot_cache.get(key)
+        if hit:
+            results[i] = value
+            continue
+        leader, call = hot_key_flights.begin(key)
+        if leader:
+            leading.append((i, key, call))
+        else:
+            waiting.append((i, call))
 
-        # Forward the request to the Redis server
-        try:
-            r = redis.Redis(host=redis_server.split(":")[0], port=int(redis_server.split(":")[1]), socket_timeout=5)
-            response = r.get(conn.recv(1024))
-            if response:
-                conn.sendall(response)
-            else:
-                conn.sendall(b'Error: Key not found.')
-        except redis.exceptions.RedisError as e:
-            logging.error(f'[{threading.current_thread().name}] Error forwarding request to Redis server: {e}')
-            conn.sendall(b'Error: Could not connect to Redis server.')
-            conn.close()
-            update_connection_count(redis_server, -1)
-            return
-
-        logging.info(f'[{threading.current_thread().name}] Sent response to {addr}')
-
-        # Wait for the client to disconnect
-        conn.settimeout(60)  # Timeout after 60 seconds of inactivity
+    try:
+        values = fetch_keys([key for _, key, _ in leading]) if leading else []
+    except Exception as e:
+        # Do not leave the other requests waiting for keys we will not fetch
+        for _, key, call in leading:
+            hot_key_flights.finish(key, call, error=e)
+        raise
+    for (i, key, call), value in zip(leading, values):
+        if not isinstance(value, redis.exceptions.RedisError):
+            hot_cache.set(key, value)
+        hot_key_flights.finish(key, call, value)
+        results[i] = value
+
+    for i, call in waiting:
         try:
-            data = conn.recv(1)
+            results[i] = call.wait(timeout=10)
+        except TimeoutError as e:
+            results[i] = redis.exceptions.TimeoutError(str(e))
+    return results
+
+# Keys a request looks up (GET, MGET and line requests)
+def request_keys(protocol, args):
+    if protocol == LINE:
+        return args
+    command = args[0].upper()
+    if command == b'GET' and len(args) == 2:
+        return args[1:]
+    if command == b'MGET' and len(args) > 1:
+        return args[1:]
+    return []
+
+def line_reply(value):
+    if isinstance(value, redis.exceptions.RedisError):
+        return b'Error: Could not connect to Redis server.\n'
+    if value is None:
+        return b'Error: Key not found.\n'
+    return value + b'\n'
+
+def resp_reply(args, values):
+    errors = [value for value in values if isinstance(value, redis.exceptions.RedisError)]
+    if errors:
+        return encode_error(f'ERR Could not connect to Redis server: {errors[0]}')
+    if args[0].upper() == b'GET':
+        return encode_bulk(values[0])
+    return encode_array(values)
+
+# Answer all the requests that arrived in one read. Their keys are looked up
+# together, so pipelined requests cost one MGET per server rather than one
+# round trip each. Returns the replies and whether the client asked to close
+def handle_requests(requests):
+    keys_per_request = [request_keys(protocol, args) for protocol, args in requests]
+    values = lookup_keys([key for keys in keys_per_request for key in keys])
+
+    replies = []
+    position = 0
+    for (protocol, args), keys in zip(requests, keys_per_request):
+        request_values = values[position:position + len(keys)]
+        position += len(keys)
+        if protocol == LINE:
+            replies.append(line_reply(request_values[0]))
+            continue
+        command = args[0].upper()
+        if keys:
+            replies.append(resp_reply(args, request_values))
+        elif command == b'PING':
+            replies.append(encode_simple('PONG'))
+        elif command == b'QUIT':
+            replies.append(encode_simple('OK'))
+            return b''.join(replies), True
+        else:
+            replies.append(encode_error(f"ERR unknown or unsupported command '{args[0].decode(errors='replace')}'"))
+    return b''.join(replies), False
+
+def handle_client(conn, addr):
+    parser = RequestParser()
+    conn.settimeout(60)  # Timeout after 60 seconds of inactivity
+    try:
+        while True:
+            try:
+                data = conn.recv(65536)
+            except socket.timeout:
+                request_log.info('Client %s disconnected (timeout)', addr)
+                break
             if not data:
-                update_connection_count(redis_server, -1)
-                logging.info(f'[{threading.current_thread().name}] Client {addr} disconnected')
-        except socket.timeout:
-            update_connection_count(redis_server, -1)
-            logging.info(f'[{threading.current_thread().name}] Client {addr} disconnected (timeout)')
-        finally:
-            conn.close()
+                request_log.info('Client %s disconnected', addr)
+                break
+
+            try:
+                requests = parser.feed(data)
+            except ProtocolError as e:
+                conn.sendall(encode_error(f'ERR Protocol error: {e}'))
+                break
+            if not requests:
+                continue
+
+            request_log.info('Forwarding %d request(s) from %s', len(requests), addr)
+            start = time.monotonic()
+            replies, close = handle_requests(requests)
+            requests_total.inc(len(requests))
+            request_duration.observe(time.monotonic() - start)
+            conn.sendall(replies)
+            if close:
+                break
     except Exception as e:
         logging.error(f'[{threading.current_thread().name}] Unexpected error: {e}')
+    finally:
+        conn.close()
 
 while True:
     try:
         # Wait for a connection
         conn, addr = sock.accept()
-        logging.info(f'Received connection from {addr}')
-        threading.Thread(target=handle_client, args=(conn, addr, next_server_index), daemon=True).start()
+        request_log.info('Received connection from %s', addr)
+        threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
     except Exception as e:
         logging.error(f'Unexpected error: {e}')
 
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+# Create the listening socket for one worker.
+# With reuse_port every worker binds its own socket to the same address and the
+# kernel spreads new connections across them (SO_REUSEPORT, Linux >= 3.9)
+def create_listener(address, port, reuse_port=False, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+# Accept loop: every client is a coroutine instead of a thread, so idle
+# keep-alive clients only cost a socket and a few KB of stream buffers.
+# max_clients bounds the number of open client connections: once it is reached
+# we stop calling accept() and new clients queue in the kernel backlog
+# (backpressure) instead of piling up in the process
+async def serve(handler, sock, max_clients=10000):
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_clients)
+    tasks = set()
+
+    async def run_client(conn, addr):
+        try:
+            reader, writer = await asyncio.open_connection(sock=conn)
+        except OSError as e:
+            logging.error(f'Could not set up connection from {addr}: {e}')
+            conn.close()
+            slots.release()
+            return
+        try:
+            await handler(reader, writer, addr)
+        except Exception as e:
+            logging.error(f'Unexpected error while handling {addr}: {e}')
+        finally:
+            writer.close()
+            slots.release()
+
+    while True:
+        await slots.acquire()
+        try:
+            conn, addr = await loop.sock_accept(sock)
+        except OSError as e:
+            # e.g. EMFILE: back off a little instead of spinning on accept
+            logging.error(f'Error accepting connection: {e}')
+            slots.release()
+            await asyncio.sleep(0.1)
+            continue
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        task = loop.create_task(run_client(conn, addr))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+# Run the event loop for one worker process.
+# init(index) is called in the worker before serving, e.g. to start background
+# threads, which do not survive the fork; index numbers the workers from 0
+def run_worker(handler, address, port, max_clients, reuse_port, init=None, index=0):
+    sock = create_listener(address, port, reuse_port=reuse_port)
+    if init is not None:
+        init(index)
+    try:
+        asyncio.run(serve(handler, sock, max_clients=max_clients))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+# Turn SIGTERM into KeyboardInterrupt so the parent also stops its workers
+def stop_workers(signum, frame):
+    raise KeyboardInterrupt
+
+# Start the load balancer with the given number of worker processes.
+# workers == 1 runs in the current process; workers > 1 forks one event loop
+# per worker, each with its own SO_REUSEPORT listener, and waits for them.
+# Note that every worker keeps its own scheduler state (round-robin index,
+# connection counts), exactly like separate load balancer replicas would
+def run(handler, address, port, workers=1, max_clients=10000, init=None):
+    if workers <= 1:
+        run_worker(handler, address, port, max_clients, reuse_port=False, init=init)
+        return
+
+    if not hasattr(os, "fork"):
+        raise RuntimeError("multi-worker mode needs os.fork")
+
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(handler, address, port, max_clients, reuse_port=True, init=init, index=index)
+            except Exception as e:
+                logging.error(f'Worker {os.getpid()} failed: {e}')
+                status = 1
+            finally:
+                os._exit(status)
+        children.append(pid)
+        logging.info(f'Started worker {pid}')
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            os.waitpid(pid, 0)
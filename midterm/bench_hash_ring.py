@@ -0,0 +1,61 @@
+import argparse
+import time
+from collections import Counter
+from hash_ring import HashRing
+from scheduler import ConsistentHashScheduler
+
+# Benchmark of the consistent hash ring used by the Redis balancer:
+#   lookup    - microseconds per HashRing.get()
+#   add/remove churn - share of keys that move to another node when one node
+#               joins or leaves (ideal: 1/(n+1) and 1/n), versus the share that
+#               moves with modulo hashing (hash(key) % n), the naive alternative
+#   max/avg   - load of the busiest node relative to the average
+#   bounded   - the same with bounded loads (keys held in flight, factor 1.25)
+
+def modulo_churn(keys, n):
+    return sum(hash(key) % n != hash(key) % (n + 1) for key in keys) / len(keys)
+
+def run(node_counts, num_keys, vnodes, load_factor):
+    keys = [f"key:{i}" for i in range(num_keys)]
+    print(f"{num_keys} keys, {vnodes} virtual nodes per node")
+    print(f"{'nodes':>6} {'build ms':>9} {'lookup us':>10} {'add churn':>10} {'remove churn':>13} {'modulo churn':>13} {'max/avg':>8} {'bounded':>8}")
+
+    for n in node_counts:
+        nodes = [f"10.0.{i // 256}.{i % 256}:6379" for i in range(n)]
+
+        start = time.perf_counter()
+        ring = HashRing(nodes, vnodes=vnodes)
+        build = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        owners = [ring.get(key) for key in keys]
+        lookup = (time.perf_counter() - start) / num_keys * 1e6
+
+        ring.add("10.1.0.0:6379")
+        added = [ring.get(key) for key in keys]
+        ring.remove("10.1.0.0:6379")
+        ring.remove(nodes[0])
+        removed = [ring.get(key) for key in keys]
+
+        add_churn = sum(a != b for a, b in zip(owners, added)) / num_keys
+        remove_churn = sum(a != b for a, b in zip(owners, removed)) / num_keys
+        loads = Counter(owners)
+        spread = max(loads.values()) / (num_keys / n)
+
+        # Every key stays in flight, so the bound applies to the whole key set
+        scheduler = ConsistentHashScheduler(nodes, vnodes=vnodes, load_factor=load_factor)
+        for key in keys:
+            scheduler.acquire(key)
+        bounded = max(scheduler.snapshot().values()) / (num_keys / n)
+
+        print(f"{n:>6} {build:>9.1f} {lookup:>10.2f} {add_churn:>10.4f} {remove_churn:>13.4f} "
+              f"{modulo_churn(keys, n):>13.4f} {spread:>8.2f} {bounded:>8.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark consistent hash ring lookups and rebalance churn")
+    parser.add_argument("--nodes", default="10,50,100,500,1000", help="comma separated node counts")
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--vnodes", type=int, default=160)
+    parser.add_argument("--load-factor", type=float, default=1.25)
+    args = parser.parse_args()
+    run([int(n) for n in args.nodes.split(",")], args.keys, args.vnodes, args.load_factor)
@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from load_generator import format_ms, http_client, resp_client, run_load
+
+# Benchmark of the load balancer variants against local stub backends:
+#   python bench_lb.py 4th --rps 500 --duration 20 --latency exp:5ms,exp:5ms,lognormal:20ms:1.0
+# Starts the stub backends (stub_backends.py), then for every scheduling policy
+# starts the balancer pointed at them, drives it with the open-loop load
+# generator and reports throughput, p50/p99/p999 latency and the balancer's
+# memory (resident and peak, workers included). --output saves the results
+# as JSON; --baseline compares against a saved run and exits with status 1
+# when throughput or p99 got worse by more than --max-regression
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# target -> (script, protocol, policies it supports)
+TARGETS = {
+    "1st": ("load_balancer.py", "http", ("round_robin",)),
+    "2nd": ("2nd_version.py", "http", ("round_robin",)),
+    "3rd": ("3rd_version.py", "http", ("round_robin",)),
+    "4th": ("4th_version.py", "http", ("round_robin", "least_connections", "power_of_two", "peak_ewma")),
+    "5th": ("5th_version.py", "resp", ("round_robin", "least_connections", "power_of_two", "peak_ewma", "consistent_hash")),
+    "l4": ("l4_proxy.py", "resp", ("round_robin", "least_connections", "power_of_two")),
+}
+
+def free_ports(count):
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+# Whether something listens on port, from /proc/net/tcp. Connecting to find out
+# would already make the http balancers forward a request
+def is_listening(port):
+    with open("/proc/net/tcp") as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if fields[3] == "0A" and int(fields[1].split(":")[1], 16) == port:
+                return True
+    return False
+
+def wait_for_port(port, process, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process exited with status {process.returncode} before listening on {port}")
+        if is_listening(port):
+            return
+        time.sleep(0.05)
+    raise RuntimeError(f"nothing listening on port {port} after {timeout} seconds")
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+# (resident, peak resident) memory in MB of pid and all its descendants
+def process_memory(pid):
+    rss = peak = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children(current))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        peak += int(line.split()[1])
+        except OSError:
+            pass
+    return rss / 1024, peak / 1024
+
+def stop(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def start_stubs(protocol, ports, args):
+    command = [sys.executable, os.path.join(HERE, "stub_backends.py"), protocol, *map(str, ports),
+               "--latency", args.latency, "--error-rate", str(args.error_rate), "--size", str(args.size),
+               "--cache-control", args.cache_control]
+    process = subprocess.Popen(command, cwd=HERE, stdout=subprocess.DEVNULL)
+    for port in ports:
+        wait_for_port(port, process)
+    return process
+
+def balancer_env(protocol, policy, port, backend_ports, args):
+    env = dict(os.environ)
+    env.update({
+        "LB_ADDRESS": "127.0.0.1",
+        "LB_PORT": str(port),
+        "LB_POLICY": policy,
+        "LB_WORKERS": str(args.workers),
+        "LB_METRICS_PORT": "0",
+        "LB_STATS_INTERVAL": "0",
+        "LB_CACHE_BYTES": str(args.cache_bytes),
+        "REDIS_CACHE_SIZE": str(args.cache_keys),
+    })
+    if protocol == "http":
+        env["LB_BACKENDS"] = ",".join(f"http://127.0.0.1:{p}/" for p in backend_ports)
+    else:
+        env["REDIS_HOSTS"] = env["LB_BACKENDS"] = ",".join(f"127.0.0.1:{p}" for p in backend_ports)
+    return env
+
+def run_policy(target, policy, backend_ports, args):
+    script, protocol, _ = TARGETS[target]
+    port = free_ports(1)[0]
+    log = open(args.log, "ab") if args.log else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, script)], cwd=HERE,
+                               env=balancer_env(protocol, policy, port, backend_ports, args),
+                               stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port, process)
+        # A new client for each event loop: resp_client keeps its connections,
+        # which belong to the loop that opened them
+        if protocol == "http":
+            make_client = lambda: http_client("127.0.0.1", port, args.size)
+        else:
+            make_client = lambda: resp_client("127.0.0.1", port, args.keys)
+        if args.warmup > 0:
+            asyncio.run(run_load(make_client(), args.rps, args.warmup, args.concurrency))
+        result = asyncio.run(run_load(make_client(), args.rps, args.duration, args.concurrency,
+                                      poisson=not args.uniform))
+        summary = result.summary()
+        summary["rss_mb"], summary["peak_mb"] = process_memory(process.pid)
+        return summary
+    finally:
+        stop(process)
+        if log is not subprocess.DEVNULL:
+            log.close()
+
+def print_results(results):
+    print(f"{'policy':>18} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} {'errors':>7} {'dropped':>8} {'RSS MB':>7} {'peak MB':>8}")
+    for policy, summary in results.items():
+        print(f"{policy:>18} {summary['throughput']:>9.1f} {format_ms(summary['p50']):>8} {format_ms(summary['p99']):>8} "
+              f"{format_ms(summary['p999']):>8} {summary['errors']:>7} {summary['dropped']:>8} "
+              f"{summary['rss_mb']:>7.1f} {summary['peak_mb']:>8.1f}")
+
+# Policies whose throughput dropped or whose p99 rose by more than max_regression
+def regressions(results, baseline, max_regression):
+    found = []
+    for policy, summary in results.items():
+        before = baseline.get(policy)
+        if before is None:
+            continue
+        if summary["throughput"] < before["throughput"] * (1 - max_regression):
+            found.append(f"{policy}: throughput {before['throughput']:.1f} -> {summary['throughput']:.1f} req/s")
+        if summary["p99"] is not None and before["p99"] is not None and summary["p99"] > before["p99"] * (1 + max_regression):
+            found.append(f"{policy}: p99 {format_ms(before['p99'])} -> {format_ms(summary['p99'])} ms")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the load balancer variants against local stub backends")
+    parser.add_argument("target", choices=TARGETS)
+    parser.add_argument("--policies", help="comma separated scheduling policies (default: all the target supports)")
+    parser.add_argument("--backends", type=int, default=3, help="number of stub backends")
+    parser.add_argument("--latency", default="exp:2ms", help="backend latency distribution(s), see stub_backends.py")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--size", type=int, default=1024, help="response body (http) or value (resp) size in bytes")
+    parser.add_argument("--rps", type=float, default=200)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measured load per policy")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=200, help="maximum requests in flight")
+    parser.add_argument("--uniform", action="store_true", help="evenly spaced instead of Poisson arrivals")
+    parser.add_argument("--keys", type=int, default=10000, help="resp: number of distinct keys")
+    parser.add_argument("--workers", type=int, default=1, help="4th: LB_WORKERS")
+    parser.add_argument("--cache-bytes", type=int, default=64 * 1024 * 1024,
+                        help="http: LB_CACHE_BYTES (default: the balancers' own default, 0 disables the cache)")
+    parser.add_argument("--cache-control", default="no-store",
+                        help="http: Cache-Control the stub backends send (e.g. max-age=1 for cache hits)")
+    parser.add_argument("--cache-keys", type=int, default=0, help="5th: REDIS_CACHE_SIZE")
+    parser.add_argument("--log", help="append the balancer's output to this file")
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    args = parser.parse_args()
+
+    _, protocol, supported = TARGETS[args.target]
+    policies = args.policies.split(",") if args.policies else supported
+    backend_ports = free_ports(args.backends)
+    print(f"{args.target}: {args.backends} {protocol} backends ({args.latency}, error rate {args.error_rate}), "
+          f"{args.rps:g} req/s for {args.duration:g} s, concurrency {args.concurrency}")
+
+    stubs = start_stubs(protocol, backend_ports, args)
+    try:
+        results = {policy: run_policy(args.target, policy, backend_ports, args) for policy in policies}
+    finally:
+        stop(stubs)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.max_regression)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
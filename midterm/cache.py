@@ -0,0 +1,182 @@
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+# Approximate access frequencies for TinyLFU admission.
+# depth rows of width counters; a key's frequency is the smallest of its
+# counters. After sample_size increments every counter is halved, so old
+# popularity fades out
+class CountMinSketch:
+    def __init__(self, width, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("H", bytes(2 * width)) for _ in range(depth)]
+        self.seeds = [random.getrandbits(32) for _ in range(depth)]
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def indexes(self, key):
+        return [hash((seed, key)) % self.width for seed in self.seeds]
+
+    def increment(self, key):
+        for row, i in zip(self.rows, self.indexes(key)):
+            if row[i] < 0xFFFF:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.age()
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self.indexes(key)))
+
+    def age(self):
+        for row in self.rows:
+            for i in range(self.width):
+                row[i] >>= 1
+        self.additions //= 2
+
+# Size-bounded in-process cache with optional TTLs.
+# Entries are kept in LRU order and evicted from the cold end once the total
+# size exceeds max_size; sizeof(key, value) gives an entry's size (1 by
+# default, i.e. max_size counts entries).
+# policy="tinylfu" adds TinyLFU admission: a new key only replaces the LRU
+# victim if it has been requested more often recently, so a burst of
+# one-off keys cannot flush the hot ones
+class LocalCache:
+    def __init__(self, max_size=10000, ttl=None, policy="lru", sizeof=None):
+        if policy not in ("lru", "tinylfu"):
+            raise ValueError(f"Unknown cache policy: {policy}")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda key, value: 1)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, expires at, size)
+        self.size = 0
+        self.sketch = None
+        if policy == "tinylfu":
+            self.sketch = CountMinSketch(min(max(4 * max_size, 1024), 1 << 20))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+
+    # Returns (True, value) on a hit and (False, None) on a miss
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            if self.sketch is not None:
+                self.sketch.increment(key)
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires, size = entry
+                if expires is None or expires > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                self.remove(key)
+                self.expirations += 1
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        size = self.sizeof(key, value)
+        if size > self.max_size:
+            return False
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            elif self.sketch is not None and self.size + size > self.max_size:
+                victim = next(iter(self.entries))
+                if self.sketch.estimate(key) <= self.sketch.estimate(victim):
+                    self.rejections += 1
+                    return False
+            self.entries[key] = (value, expires, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+    def remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "rejections": self.rejections,
+            }
+
+# One in-progress fetch that other callers can wait for
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("timed out waiting for a concurrent fetch")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+# Request coalescing: concurrent misses on the same key share one fetch.
+#   leader, call = flights.begin(key)
+#   if leader:  fetch, then flights.finish(key, call, value)  (or error=...)
+#   else:       value = call.wait()
+# do(key, fetch) wraps this for the single key case
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def begin(self, key):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return False, call
+            call = self.calls[key] = Call()
+            return True, call
+
+    def finish(self, key, call, value=None, error=None):
+        with self.lock:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+        call.value = value
+        call.error = error
+        call.done.set()
+
+    def do(self, key, fetch, timeout=None):
+        leader, call = self.begin(key)
+        if not leader:
+            return call.wait(timeout)
+        try:
+            value = fetch()
+        except Exception as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, value)
+        return value
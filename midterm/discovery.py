@@ -0,0 +1,175 @@
+import logging
+import threading
+
+# Raised by a discovery source when the resourceVersion we watch from is too
+# old (HTTP 410 Gone): the registry has to list everything again
+class ResourceVersionExpired(Exception):
+    pass
+
+# Discovery source for a fixed list of backends (load_balancer.py style)
+class StaticSource:
+    def __init__(self, urls):
+        self.urls = list(urls)
+
+    def list(self):
+        return {url: url for url in self.urls}, None
+
+# Discovery source for backend pods in Kubernetes.
+#   list()  -> ({pod name: backend url}, resourceVersion)
+#   watch() -> yields (event type, pod name, backend url or None, resourceVersion)
+# Only running pods with an IP are backends; namespace=None watches all
+# namespaces and label_selector is passed to the API server so unrelated pods
+# are never sent to us
+class KubernetesPodSource:
+    def __init__(self, v1, namespace=None, label_selector=None, name_prefix="", port=8000):
+        self.v1 = v1
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.name_prefix = name_prefix
+        self.port = port
+
+    def list_function(self):
+        if self.namespace:
+            return self.v1.list_namespaced_pod, {"namespace": self.namespace}
+        return self.v1.list_pod_for_all_namespaces, {}
+
+    def selector(self):
+        return {"label_selector": self.label_selector} if self.label_selector else {}
+
+    def backend_url(self, pod):
+        if not pod.metadata.name.startswith(self.name_prefix):
+            return None
+        if pod.status.phase != "Running" or not pod.status.pod_ip:
+            return None
+        return f"http://{pod.status.pod_ip}:{self.port}"
+
+    def list(self):
+        function, kwargs = self.list_function()
+        pods = function(watch=False, **kwargs, **self.selector())
+        backends = {}
+        for pod in pods.items:
+            url = self.backend_url(pod)
+            if url:
+                backends[pod.metadata.name] = url
+        return backends, pods.metadata.resource_version
+
+    def watch(self, resource_version, timeout):
+        from kubernetes import watch
+        from kubernetes.client.rest import ApiException
+
+        function, kwargs = self.list_function()
+        stream = watch.Watch()
+        try:
+            for event in stream.stream(function, resource_version=resource_version, timeout_seconds=timeout,
+                                       allow_watch_bookmarks=True, **kwargs, **self.selector()):
+                pod = event["object"]
+                if event["type"] == "ERROR":
+                    if isinstance(pod, dict) and pod.get("code") == 410:
+                        raise ResourceVersionExpired(pod.get("message"))
+                    raise RuntimeError(f"Watch error: {pod}")
+                if event["type"] == "BOOKMARK":
+                    yield "BOOKMARK", None, None, pod.metadata.resource_version
+                    continue
+                url = None if event["type"] == "DELETED" else self.backend_url(pod)
+                yield event["type"], pod.metadata.name, url, pod.metadata.resource_version
+        except ApiException as e:
+            if e.status == 410:
+                raise ResourceVersionExpired(str(e)) from e
+            raise
+        finally:
+            stream.stop()
+
+# Current set of backends, listed once and then kept up to date by a
+# background thread that watches the source from the last resourceVersion
+# (or polls sources without watch support).
+# The request path only reads self.backends, a tuple that is replaced as a
+# whole on every change, so it never takes a lock
+class BackendRegistry:
+    def __init__(self, source, poll_interval=5, watch_timeout=300, retry_delay=1):
+        self.source = source
+        self.poll_interval = poll_interval
+        self.watch_timeout = watch_timeout
+        self.retry_delay = retry_delay
+
+        self.backends = ()
+        self.members = {}
+        self.resource_version = None
+        self.stale = True
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def get(self):
+        return self.backends
+
+    # callback(backends) is called from the registry thread after every change
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+    def publish(self):
+        backends = tuple(sorted(set(self.members.values())))
+        if backends == self.backends:
+            return
+        self.backends = backends
+        logging.info(f"Backends changed: {len(backends)} available")
+        for callback in self.listeners:
+            try:
+                callback(backends)
+            except Exception as e:
+                logging.error(f"Error in backend listener: {e}")
+
+    def relist(self):
+        members, resource_version = self.source.list()
+        with self.lock:
+            self.members = members
+            self.resource_version = resource_version
+            self.stale = False
+            self.publish()
+
+    def apply(self, event_type, name, url, resource_version):
+        with self.lock:
+            if resource_version:
+                self.resource_version = resource_version
+            if event_type == "BOOKMARK":
+                return
+            if url:
+                self.members[name] = url
+            else:
+                self.members.pop(name, None)
+            self.publish()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.stale:
+                    self.relist()
+                if hasattr(self.source, "watch"):
+                    for event in self.source.watch(self.resource_version, self.watch_timeout):
+                        if self.stopped.is_set():
+                            return
+                        self.apply(*event)
+                elif not self.stopped.wait(self.poll_interval):
+                    self.stale = True
+            except ResourceVersionExpired:
+                logging.info("Backend watch expired, listing again")
+                self.stale = True
+            except Exception as e:
+                logging.error(f"Error watching backends: {e}")
+                self.stale = True
+                self.stopped.wait(self.retry_delay)
+
+    # List the backends once (so the first request already has them), then
+    # keep them current in the background
+    def start(self):
+        if self.thread is not None:
+            return
+        try:
+            self.relist()
+        except Exception as e:
+            logging.error(f"Error listing backends: {e}")
+        self.thread = threading.Thread(target=self.run, name="backend-discovery", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,78 @@
+import hashlib
+from bisect import bisect
+
+# 64-bit position on the ring for a key or virtual node name
+def hash_value(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+# Consistent hash ring with virtual nodes.
+# Every node owns `vnodes` points on the ring and a key belongs to the first
+# point clockwise from its hash, so adding or removing a node only moves the
+# keys of that node (about 1/n of them) instead of reshuffling everything.
+# Membership changes build new lists and swap them in one assignment, so
+# lookups never see a half-updated ring
+class HashRing:
+    def __init__(self, nodes=(), vnodes=160):
+        self.vnodes = vnodes
+        self.ring = ((), ())  # (sorted point hashes, node owning each point)
+        self.nodes = set()
+        self.set_nodes(nodes)
+
+    def node_points(self, node):
+        return [(hash_value(f"{node}#{i}"), node) for i in range(self.vnodes)]
+
+    def build(self, entries):
+        entries.sort()
+        self.ring = (tuple(point for point, _ in entries), tuple(node for _, node in entries))
+
+    def set_nodes(self, nodes):
+        nodes = set(nodes)
+        if nodes == self.nodes:
+            return
+        entries = []
+        for node in nodes:
+            entries.extend(self.node_points(node))
+        self.nodes = nodes
+        self.build(entries)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        points, owners = self.ring
+        self.nodes = self.nodes | {node}
+        self.build(list(zip(points, owners)) + self.node_points(node))
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        points, owners = self.ring
+        self.nodes = self.nodes - {node}
+        self.build([(point, owner) for point, owner in zip(points, owners) if owner != node])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    # Node responsible for key, or None if the ring is empty
+    def get(self, key):
+        points, owners = self.ring
+        if not points:
+            return None
+        return owners[bisect(points, hash_value(key)) % len(points)]
+
+    # Distinct nodes in ring order starting from the owner of key: the
+    # fallbacks when the owner cannot take the key (bounded loads, failures)
+    def successors(self, key):
+        points, owners = self.ring
+        if not points:
+            return
+        start = bisect(points, hash_value(key))
+        seen = set()
+        for i in range(len(points)):
+            node = owners[(start + i) % len(points)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
@@ -0,0 +1,226 @@
+import http.client
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Probes return True when the backend looks healthy and never raise
+
+# HTTP probe: GET the backend URL (or path instead of its own path);
+# anything below 500 counts as up
+def http_probe(backend, timeout, path=None):
+    parts = urlsplit(backend)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    conn = connection_class(parts.hostname, parts.port, timeout=timeout)
+    try:
+        conn.request("GET", path or parts.path or "/", headers={"Connection": "close"})
+        return conn.getresponse().status < 500
+    except (OSError, http.client.HTTPException):
+        return False
+    finally:
+        conn.close()
+
+# Split "host:port" or "scheme://host:port/..." into (host, port)
+def host_port(backend, default_port):
+    if "://" in backend:
+        parts = urlsplit(backend)
+        return parts.hostname, parts.port or (443 if parts.scheme == "https" else default_port)
+    host, _, port = backend.rpartition(":")
+    return host, int(port)
+
+# TCP probe: the backend accepts connections
+def tcp_probe(backend, timeout):
+    try:
+        socket.create_connection(host_port(backend, 80), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+# Redis probe: PING answered with +PONG (raw RESP, no client library)
+def redis_probe(backend, timeout):
+    try:
+        with socket.create_connection(host_port(backend, 6379), timeout=timeout) as sock:
+            sock.sendall(b"*1\r\n$4\r\nPING\r\n")
+            return sock.recv(64).startswith(b"+PONG")
+    except OSError:
+        return False
+
+# No active probe: only passive ejection through the circuit breakers
+def no_probe(backend, timeout):
+    return True
+
+PROBES = {"http": http_probe, "tcp": tcp_probe, "redis": redis_probe, "none": no_probe}
+
+# Passive health of one backend, from the results of real requests.
+# closed    - normal; failure_threshold consecutive failures open the circuit
+# open      - the backend is ejected until its ejection time has passed; the
+#             time doubles with every ejection in a row (up to max_ejection)
+# half_open - the backend gets traffic again: a success closes the circuit,
+#             a failure opens it again straight away
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, base_ejection=10, max_ejection=300):
+        self.failure_threshold = failure_threshold
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.state = "closed"
+        self.failures = 0
+        self.ejections = 0
+        self.open_until = 0
+
+    def record(self, ok, now):
+        if ok:
+            self.failures = 0
+            if self.state == "half_open":
+                self.state = "closed"
+                self.ejections = 0
+            return False
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.trip(now)
+            return True
+        return False
+
+    def trip(self, now):
+        self.state = "open"
+        self.ejections += 1
+        self.open_until = now + min(self.base_ejection * 2 ** (self.ejections - 1), self.max_ejection)
+
+    # Move an open circuit to half-open once its ejection time is over
+    def tick(self, now):
+        if self.state == "open" and now >= self.open_until:
+            self.state = "half_open"
+            return True
+        return False
+
+# Health of a set of backends: active probes every interval (rise successes
+# mark a backend up, fall failures mark it down) plus a CircuitBreaker per
+# backend fed by the request path through report().
+# A backend is available when it is up and its circuit is not open. The
+# available backends are pushed to subscribers (e.g. Scheduler.set_backends)
+# on every change. Passive ejection never takes out more than
+# max_ejection_percent of the backends, and if nothing at all is available
+# the ejected (or even the down) backends are used again (panic mode) rather
+# than failing all requests
+class BackendHealth:
+    def __init__(self, probe="tcp", interval=5, timeout=2, rise=2, fall=3, failure_threshold=5,
+                 base_ejection=10, max_ejection=300, max_ejection_percent=50):
+        self.probe = PROBES[probe] if isinstance(probe, str) else probe
+        self.interval = interval
+        self.timeout = timeout
+        self.rise = rise
+        self.fall = fall
+        self.breaker_options = {
+            "failure_threshold": failure_threshold,
+            "base_ejection": base_ejection,
+            "max_ejection": max_ejection,
+        }
+        self.max_ejection_percent = max_ejection_percent
+
+        self.lock = threading.Lock()
+        self.backends = ()
+        self.up = {}
+        self.streaks = {}
+        self.breakers = {}
+        self.available = ()
+        self.listeners = []
+        self.stopped = threading.Event()
+        self.thread = None
+        self.prober = None
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+        callback(self.available)
+
+    def get(self):
+        return self.available
+
+    def is_available(self, backend):
+        return backend in self.available
+
+    # New backends start out up, so they get traffic before their first probe
+    def set_backends(self, backends):
+        with self.lock:
+            self.backends = tuple(backends)
+            self.up = {backend: self.up.get(backend, True) for backend in self.backends}
+            self.streaks = {backend: self.streaks.get(backend, 0) for backend in self.backends}
+            self.breakers = {backend: self.breakers.get(backend) or CircuitBreaker(**self.breaker_options)
+                             for backend in self.backends}
+        self.publish()
+
+    # Result of a real request to backend (True for success)
+    def report(self, backend, ok):
+        with self.lock:
+            breaker = self.breakers.get(backend)
+            if breaker is None:
+                return
+            ejected = sum(1 for other in self.breakers.values() if other.state == "open")
+            if not ok and breaker.state == "closed" and ejected + 1 > len(self.backends) * self.max_ejection_percent / 100:
+                # Over the ejection limit: keep counting but do not trip
+                breaker.failures += 1
+                return
+            tripped = breaker.record(ok, time.monotonic())
+        if tripped:
+            logging.warning(f"Ejecting {backend} after {breaker.failures} failed requests")
+            self.publish()
+
+    def publish(self):
+        with self.lock:
+            available = tuple(backend for backend in self.backends
+                              if self.up[backend] and self.breakers[backend].state != "open")
+            if not available:
+                # Panic mode: ignore the circuit breakers, then the probes too
+                available = tuple(backend for backend in self.backends if self.up[backend]) or self.backends
+            changed = available != self.available
+            self.available = available
+        if changed:
+            logging.info(f"Available backends: {len(available)} of {len(self.backends)}")
+            for callback in self.listeners:
+                try:
+                    callback(available)
+                except Exception as e:
+                    logging.error(f"Error in health listener: {e}")
+
+    def check(self, backend):
+        return backend, self.probe(backend, self.timeout)
+
+    # One round of active probes, run in parallel so one slow backend does
+    # not delay the others
+    def check_all(self):
+        backends = self.backends
+        results = list(self.prober.map(self.check, backends)) if backends else []
+        now = time.monotonic()
+        with self.lock:
+            for backend, ok in results:
+                if backend not in self.up:
+                    continue
+                streak = self.streaks[backend]
+                streak = max(streak, 0) + 1 if ok else min(streak, 0) - 1
+                self.streaks[backend] = streak
+                if not self.up[backend] and streak >= self.rise:
+                    self.up[backend] = True
+                    logging.info(f"{backend} is up")
+                elif self.up[backend] and -streak >= self.fall:
+                    self.up[backend] = False
+                    logging.warning(f"{backend} is down")
+            for breaker in self.breakers.values():
+                breaker.tick(now)
+        self.publish()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check_all()
+            except Exception as e:
+                logging.error(f"Error checking backends: {e}")
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.prober = ThreadPoolExecutor(max_workers=32, thread_name_prefix="health-probe")
+        self.thread = threading.Thread(target=self.run, name="health-check", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,239 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cache import LocalCache, SingleFlight
+
+# Case-insensitive header lookup
+def find_header(headers, name):
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+# Cached backend response. It can be read like an UpstreamStream (read,
+# readinto, close), so the relay code sends it the same way as a live one
+class CachedResponse:
+    def __init__(self, url, status, reason, headers, content, fresh_until, stale_until):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.position = 0
+
+    # Every reader gets its own read position over the shared body
+    def reader(self):
+        return CachedResponse(self.url, self.status, self.reason, self.headers, self.content,
+                              self.fresh_until, self.stale_until)
+
+    def header(self, name):
+        return find_header(self.headers, name)
+
+    def raise_for_status(self):
+        pass
+
+    def read(self):
+        data = self.content[self.position:]
+        self.position = len(self.content)
+        return data
+
+    def readinto(self, buffer):
+        n = min(len(buffer), len(self.content) - self.position)
+        buffer[:n] = memoryview(self.content)[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Parse a Cache-Control header into {directive: value or True}
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else True
+    return directives
+
+def seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+# Shared (proxy) cache of backend GET responses in front of an UpstreamPool.
+#  - freshness comes from Cache-Control s-maxage/max-age minus Age, or
+#    default_ttl when the backend sends neither; no-store and private
+#    responses are never stored, no-cache ones are revalidated every time
+#  - stale responses are revalidated with If-None-Match / If-Modified-Since,
+#    so an unchanged body costs a 304 instead of a full download
+#  - within stale-while-revalidate (from the header, or default_swr) the stale
+#    copy is served at once and refreshed in the background
+#  - concurrent misses on the same URL share one upstream fetch
+#  - bodies count against max_bytes and are evicted in LRU order; bodies over
+#    max_entry_bytes are not cached at all
+#  - the caching decision is made from the status and headers alone: only
+#    responses that will be stored are read into memory here, anything else
+#    (no-store, too large, no Content-Length, errors) is returned as the live
+#    UpstreamStream, unread, so it is still streamed to the client
+# Requests always carry the same headers, so Vary is not taken into account
+class ResponseCache:
+    def __init__(self, upstream, max_bytes=64 * 1024 * 1024, max_entry_bytes=None, default_ttl=0, default_swr=0):
+        self.upstream = upstream
+        self.default_ttl = default_ttl
+        self.default_swr = default_swr
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.entries = LocalCache(max_size=max_bytes, sizeof=lambda url, entry: len(entry.content) + len(url) + 512)
+        self.flights = SingleFlight()
+        self.refresher = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache-refresh")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    # Return the response for url, from the cache when possible.
+    # Raises UpstreamError like UpstreamPool does
+    def get(self, url):
+        found, entry = self.entries.get(url)
+        now = time.monotonic()
+        if found and now < entry.fresh_until:
+            self.count("hits")
+            return entry.reader()
+        if found and now < entry.stale_until:
+            self.count("stale_hits")
+            self.refresher.submit(self.refresh, url, entry)
+            return entry.reader()
+        self.count("misses")
+        leader, call = self.flights.begin(url)
+        if not leader:
+            shared = call.wait()
+            # None: the leader's response could not be shared, fetch our own
+            return shared.reader() if shared is not None else self.fetch(url, entry if found else None)
+        try:
+            response = self.fetch(url, entry if found else None)
+        except Exception as e:
+            self.flights.finish(url, call, error=e)
+            raise
+        if isinstance(response, CachedResponse):
+            self.flights.finish(url, call, response)
+            return response.reader()
+        self.flights.finish(url, call, None)
+        return response
+
+    # Background refresh for stale-while-revalidate, at most one per URL
+    def refresh(self, url, entry):
+        # Several stale hits may have queued a refresh: only the first one runs
+        found, current = self.entries.get(url)
+        if found and current is not entry:
+            return
+        leader, call = self.flights.begin(url)
+        if not leader:
+            return
+        try:
+            value = self.fetch(url, entry)
+        except Exception as e:
+            logging.error(f'Error revalidating {url}: {e}')
+            self.flights.finish(url, call, error=e)
+            return
+        if not isinstance(value, CachedResponse):
+            # No longer cacheable: nobody is going to read the body
+            value.close()
+            value = None
+        self.flights.finish(url, call, value)
+
+    # A CachedResponse when the response is stored (or was not modified),
+    # otherwise the open UpstreamStream. Error statuses raise UpstreamError
+    def fetch(self, url, entry):
+        headers = {}
+        if entry is not None:
+            etag = entry.header("etag")
+            last_modified = entry.header("last-modified")
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        stream = self.upstream.open(url, headers=headers)
+        if stream.status == 304 and entry is not None:
+            with stream:
+                stream.read()
+            self.count("revalidated")
+            # Not modified: keep the body, take the new caching headers
+            merged = dict(entry.headers)
+            merged.update(stream.headers)
+            return self.store(url, entry.status, entry.reason, merged, entry.content)
+
+        stream.raise_for_status()
+        if not self.cacheable(stream.status, stream.headers):
+            self.entries.delete(url)
+            return stream
+        with stream:
+            content = stream.read()
+        return self.store(url, stream.status, stream.reason, stream.headers, content)
+
+    def store(self, url, status, reason, headers, content):
+        fresh_for, stale_for = self.lifetime(headers)
+        now = time.monotonic()
+        result = CachedResponse(url, status, reason, headers, content, now + fresh_for, now + fresh_for + stale_for)
+        # A 304 may come with headers that no longer allow caching
+        if self.cacheable(status, headers):
+            self.entries.set(url, result)
+        else:
+            self.entries.delete(url)
+        return result
+
+    # Whether a response with these status and headers is worth reading into
+    # the cache: a storable 200 of known length up to max_entry_bytes, with a
+    # lifetime or a validator
+    def cacheable(self, status, headers):
+        if status != 200 or not self.storable(headers):
+            return False
+        length = seconds(find_header(headers, "content-length"))
+        if length is None or length > self.max_entry_bytes:
+            return False
+        fresh_for, stale_for = self.lifetime(headers)
+        return fresh_for > 0 or stale_for > 0 or bool(find_header(headers, "etag") or find_header(headers, "last-modified"))
+
+    def storable(self, headers):
+        directives = parse_cache_control(find_header(headers, "cache-control"))
+        return "no-store" not in directives and "private" not in directives
+
+    # (seconds the response is fresh, extra seconds it may be served stale)
+    def lifetime(self, headers):
+        directives = parse_cache_control(find_header(headers, "cache-control"))
+        if "no-cache" in directives:
+            fresh_for = 0
+        else:
+            fresh_for = seconds(directives.get("s-maxage"))
+            if fresh_for is None:
+                fresh_for = seconds(directives.get("max-age"))
+            if fresh_for is None:
+                fresh_for = self.default_ttl
+            fresh_for = max(fresh_for - (seconds(find_header(headers, "age")) or 0), 0)
+        stale_for = seconds(directives.get("stale-while-revalidate"))
+        if stale_for is None:
+            stale_for = self.default_swr
+        if "must-revalidate" in directives or "proxy-revalidate" in directives or "no-cache" in directives:
+            stale_for = 0
+        return fresh_for, stale_for
+
+    def stats(self):
+        with self.lock:
+            counts = {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses, "revalidated": self.revalidated}
+        counts.update(self.entries.stats())
+        counts["coalesced"] = self.flights.coalesced
+        return counts
@@ -0,0 +1,407 @@
+import errno
+import logging
+import os
+import selectors
+import socket
+import time
+from scheduler import make_scheduler, parse_weights
+from health import BackendHealth, host_port
+from metrics import Registry, start_http_server
+from logs import SampledLogger, setup_logging
+from async_server import create_listener
+
+# Layer-4 load balancer: every client connection is paired with a connection
+# to a backend chosen by the scheduler, and the bytes are relayed unchanged in
+# both directions. Nothing is parsed, so it balances any TCP protocol (HTTP,
+# RESP, ...) and a request costs two socket reads and two writes, not a
+# request to the backend of our own.
+#   LB_BACKENDS=10.0.0.1:8000,10.0.0.2:8000 LB_POLICY=least_connections python l4_proxy.py
+# One thread runs a selectors (epoll) loop over all the sockets. Each
+# direction of a connection has one buffer, taken from a pool shared by all
+# connections; while it holds bytes the destination has not taken yet, the
+# source is not read (backpressure), so memory per connection stays at two
+# buffers whatever the traffic. When one side closes its half (FIN), the
+# other side's write half is shut down once the buffer is drained, and the
+# connection is closed when both directions are done.
+# A backend is acquired for the life of the connection, so least_connections
+# balances open connections; consistent_hash uses the client IP as its key
+# (client affinity), and peak_ewma learns from the connect times
+
+# Configure logging: written by a background thread, and only LB_LOG_SAMPLE
+# of the per-connection lines are kept (warnings and errors always are)
+setup_logging(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] [%(process)d] %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S',
+)
+request_log = SampledLogger(logging.getLogger(), float(os.getenv("LB_LOG_SAMPLE", 0.01)))
+
+# One direction of a connection: bytes read from src wait in
+# buffer[start:end] until dst has taken them
+class Pipe:
+    def __init__(self, src, dst, buffer):
+        self.src = src
+        self.dst = dst
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = self.end = 0
+        self.eof = False  # src shut down its write half
+        self.shut = False  # and dst has been told
+        self.relayed = 0
+
+    def pending(self):
+        return self.end > self.start
+
+    def readable(self):
+        return not self.eof and not self.pending()
+
+    # Read what src has and pass it on to dst right away; whatever dst does
+    # not take now waits for dst to be writable
+    def read(self):
+        if not self.readable():
+            return
+        try:
+            n = self.src.recv_into(self.view)
+        except BlockingIOError:
+            return
+        if n == 0:
+            self.eof = True
+        else:
+            self.start, self.end = 0, n
+            self.relayed += n
+        self.flush()
+
+    def flush(self):
+        while self.start < self.end:
+            try:
+                self.start += self.dst.send(self.view[self.start:self.end])
+            except BlockingIOError:
+                return
+        if self.eof and not self.shut:
+            self.dst.shutdown(socket.SHUT_WR)
+            self.shut = True
+
+    def done(self):
+        return self.shut
+
+# Relay buffers of every connection: taken when a backend accepts the
+# connection and given back when it closes, so they are only allocated while
+# the number of open connections grows
+class BufferPool:
+    def __init__(self, size, max_free=1024):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+
+    def get(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def put(self, buffer):
+        if len(self.free) < self.max_free:
+            self.free.append(buffer)
+
+class Connection:
+    def __init__(self, client, addr):
+        self.client = client
+        self.addr = addr
+        self.upstream = None
+        self.backend = None
+        self.tried = []
+        self.deadline = None
+        self.connect_start = None
+        self.up = None  # client -> backend
+        self.down = None  # backend -> client
+        self.events = {}  # socket -> events it is registered for
+        self.closed = False
+
+    def connecting(self):
+        return self.upstream is not None and self.up is None
+
+class TcpProxy:
+    def __init__(self, scheduler, health=None, buffer_size=64 * 1024, connect_timeout=5, max_attempts=2,
+                 max_clients=10000, accept_batch=64):
+        self.scheduler = scheduler
+        self.health = health
+        self.buffers = BufferPool(buffer_size)
+        self.connect_timeout = connect_timeout
+        self.max_attempts = max_attempts
+        self.max_clients = max_clients
+        self.accept_batch = accept_batch
+        self.selector = selectors.DefaultSelector()
+        self.listener = None
+        self.accepting = False
+        self.connections = set()
+        # Connections waiting for their backend to accept
+        self.pending = set()
+        # outcome -> connections, backend -> [connections, bytes up, bytes down]
+        self.outcomes = {}
+        self.traffic = {}
+
+    def count(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def serve(self, listener):
+        self.listener = listener
+        self.listener.setblocking(False)
+        self.resume_accepting()
+        while True:
+            for key, events in self.selector.select(self.select_timeout()):
+                if key.data is None:
+                    self.accept()
+                elif not key.data.closed:
+                    self.handle(key.data, key.fileobj, events)
+            self.expire_connects()
+
+    def select_timeout(self):
+        if not self.pending:
+            return None
+        return max(min(conn.deadline for conn in self.pending) - time.monotonic(), 0)
+
+    # Once max_clients connections are open we stop accepting and new
+    # clients wait in the kernel backlog
+    def resume_accepting(self):
+        if not self.accepting:
+            self.selector.register(self.listener, selectors.EVENT_READ, None)
+            self.accepting = True
+
+    def pause_accepting(self):
+        if self.accepting:
+            self.selector.unregister(self.listener)
+            self.accepting = False
+
+    def accept(self):
+        for _ in range(self.accept_batch):
+            if len(self.connections) >= self.max_clients:
+                self.pause_accepting()
+                return
+            try:
+                client, addr = self.listener.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # e.g. EMFILE: the client stays in the backlog until a
+                # connection closes
+                logging.error(f'Error accepting connection: {e}')
+                if self.connections:
+                    self.pause_accepting()
+                return
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(client, addr)
+            self.connections.add(conn)
+            request_log.info('Received connection from %s', addr)
+            self.connect(conn)
+
+    # Start a non-blocking connect to the next backend for conn
+    def connect(self, conn):
+        backend = self.scheduler.acquire(conn.addr[0], exclude=conn.tried)
+        if backend is None:
+            logging.error("No backends available, closing connection from %s", conn.addr)
+            self.count("no_backend")
+            self.close(conn)
+            return
+        conn.tried.append(backend)
+        conn.backend = backend
+        conn.upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.upstream.setblocking(False)
+        conn.upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.connect_start = time.monotonic()
+        conn.deadline = conn.connect_start + self.connect_timeout
+        self.pending.add(conn)
+        error = conn.upstream.connect_ex(host_port(backend, 80))
+        if error not in (0, errno.EINPROGRESS):
+            self.connect_failed(conn, OSError(error, os.strerror(error)))
+            return
+        self.update(conn)
+
+    def connected(self, conn):
+        error = conn.upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.connect_failed(conn, OSError(error, os.strerror(error)))
+            return
+        self.pending.discard(conn)
+        self.scheduler.observe(conn.backend, time.monotonic() - conn.connect_start)
+        if self.health is not None:
+            self.health.report(conn.backend, True)
+        conn.up = Pipe(conn.client, conn.upstream, self.buffers.get())
+        conn.down = Pipe(conn.upstream, conn.client, self.buffers.get())
+        request_log.info('Relaying %s to %s', conn.addr, conn.backend)
+        # The client may have sent its request already
+        conn.up.read()
+
+    # Give up on the backend and try another one, up to max_attempts in all
+    def connect_failed(self, conn, error):
+        logging.warning(f'Could not connect to {conn.backend} for {conn.addr}: {error}')
+        if self.health is not None:
+            self.health.report(conn.backend, False)
+        self.pending.discard(conn)
+        self.register(conn, conn.upstream, 0)
+        conn.upstream.close()
+        conn.upstream = None
+        self.scheduler.release(conn.backend)
+        conn.backend = None
+        if len(conn.tried) < self.max_attempts:
+            self.connect(conn)
+        else:
+            self.count("connect_error")
+            self.close(conn)
+
+    def expire_connects(self):
+        if not self.pending:
+            return
+        now = time.monotonic()
+        for conn in [conn for conn in self.pending if conn.deadline <= now]:
+            if not conn.closed:
+                self.connect_failed(conn, TimeoutError("connect timed out"))
+
+    def handle(self, conn, sock, events):
+        try:
+            if conn.connecting():
+                if sock is conn.upstream:
+                    self.connected(conn)
+            elif sock is conn.client:
+                if events & selectors.EVENT_WRITE:
+                    conn.down.flush()
+                if events & selectors.EVENT_READ:
+                    conn.up.read()
+            else:
+                if events & selectors.EVENT_WRITE:
+                    conn.up.flush()
+                if events & selectors.EVENT_READ:
+                    conn.down.read()
+        except OSError as e:
+            # Reset by either side: nothing more can be relayed
+            request_log.info('Connection from %s failed: %s', conn.addr, e)
+            self.count("error")
+            self.close(conn)
+            return
+        if conn.closed:
+            return
+        if conn.up is not None and conn.up.done() and conn.down.done():
+            self.count("ok")
+            self.close(conn)
+        else:
+            self.update(conn)
+
+    # Register each socket for what its pipes need: reading while the pipe
+    # it feeds is empty, writing while the pipe it drains has bytes waiting
+    def update(self, conn):
+        if conn.connecting():
+            self.register(conn, conn.client, 0)
+            self.register(conn, conn.upstream, selectors.EVENT_WRITE)
+            return
+        up, down = conn.up, conn.down
+        self.register(conn, conn.client, (selectors.EVENT_READ if up.readable() else 0)
+                      | (selectors.EVENT_WRITE if down.pending() else 0))
+        self.register(conn, conn.upstream, (selectors.EVENT_READ if down.readable() else 0)
+                      | (selectors.EVENT_WRITE if up.pending() else 0))
+
+    def register(self, conn, sock, events):
+        current = conn.events.get(sock, 0)
+        if events == current:
+            return
+        if not current:
+            self.selector.register(sock, events, conn)
+        elif not events:
+            self.selector.unregister(sock)
+        else:
+            self.selector.modify(sock, events, conn)
+        conn.events[sock] = events
+
+    def close(self, conn):
+        conn.closed = True
+        self.pending.discard(conn)
+        for sock, events in conn.events.items():
+            if events:
+                self.selector.unregister(sock)
+        conn.events = {}
+        conn.client.close()
+        if conn.upstream is not None:
+            conn.upstream.close()
+        if conn.backend is not None:
+            self.scheduler.release(conn.backend)
+            traffic = self.traffic.setdefault(conn.backend, [0, 0, 0])
+            traffic[0] += 1
+            if conn.up is not None:
+                traffic[1] += conn.up.relayed
+                traffic[2] += conn.down.relayed
+        for pipe in (conn.up, conn.down):
+            if pipe is not None:
+                pipe.view.release()
+                self.buffers.put(pipe.buffer)
+        self.connections.discard(conn)
+        request_log.info('Closed connection from %s', conn.addr)
+        self.resume_accepting()
+
+if __name__ == "__main__":
+    # Backends as "host:port,host:port"
+    backends = os.getenv("LB_BACKENDS", "127.0.0.1:8000").split(",")
+
+    # Load balancer server address and port
+    lb_address = os.getenv("LB_ADDRESS", "127.0.0.1")
+    lb_port = int(os.getenv("LB_PORT", 8080))
+
+    # Scheduling policy: "round_robin" (default), "least_connections",
+    # "power_of_two", "peak_ewma" or "consistent_hash" (by client IP),
+    # optionally weighted with LB_WEIGHTS="10.0.0.1:8000=2,..."
+    lb_policy = os.getenv("LB_POLICY", "round_robin")
+    lb_weights = parse_weights(os.getenv("LB_WEIGHTS"))
+    scheduler = make_scheduler(lb_policy, weights=lb_weights)
+
+    # Health of the backends: TCP connects every LB_HEALTH_INTERVAL seconds
+    # plus ejection of backends that keep refusing connections. Only
+    # available backends reach the scheduler
+    backend_health = BackendHealth(
+        probe=os.getenv("LB_HEALTH_PROBE", "tcp"),
+        interval=float(os.getenv("LB_HEALTH_INTERVAL", 5)),
+        timeout=float(os.getenv("LB_HEALTH_TIMEOUT", 2)),
+        failure_threshold=int(os.getenv("LB_EJECT_FAILURES", 5)),
+        base_ejection=float(os.getenv("LB_EJECT_TIME", 10)),
+        max_ejection_percent=float(os.getenv("LB_MAX_EJECTION_PERCENT", 50)),
+    )
+    backend_health.set_backends(backends)
+    backend_health.subscribe(lambda servers: scheduler.set_backends(servers, lb_weights))
+
+    # A backend that refuses the connection or does not accept it within
+    # LB_CONNECT_TIMEOUT seconds is replaced by another one (LB_MAX_ATTEMPTS
+    # attempts in total); once bytes flow, failures are passed on to the client
+    proxy = TcpProxy(
+        scheduler,
+        health=backend_health,
+        buffer_size=int(os.getenv("LB_RELAY_BUFFER", 64 * 1024)),
+        connect_timeout=float(os.getenv("LB_CONNECT_TIMEOUT", 5)),
+        max_attempts=int(os.getenv("LB_MAX_ATTEMPTS", 2)),
+        max_clients=int(os.getenv("LB_MAX_CLIENTS", 10000)),
+    )
+
+    # Metrics in the Prometheus format on LB_METRICS_PORT (0 disables them).
+    # They are read from the proxy's counters on every scrape, so the event
+    # loop does no extra work for them
+    metrics_port = int(os.getenv("LB_METRICS_PORT", 9100))
+    metrics = Registry()
+    metrics.callback("lb_connections_total", "Closed client connections by outcome", "counter",
+                     lambda: {(outcome,): count for outcome, count in proxy.outcomes.copy().items()}, ("outcome",))
+    metrics.callback("lb_backend_connections_total", "Closed client connections by backend", "counter",
+                     lambda: {(backend,): traffic[0] for backend, traffic in proxy.traffic.copy().items()}, ("backend",))
+    metrics.callback("lb_relayed_bytes_total", "Bytes relayed by backend and direction", "counter",
+                     lambda: {(backend, direction): traffic[i]
+                              for backend, traffic in proxy.traffic.copy().items()
+                              for i, direction in ((1, "up"), (2, "down"))}, ("backend", "direction"))
+    metrics.callback("lb_open_connections", "Open client connections", "gauge", lambda: len(proxy.connections))
+    metrics.callback("lb_inflight_requests", "Open connections per backend", "gauge",
+                     lambda: {(backend,): count for backend, count in scheduler.snapshot().items()}, ("backend",))
+    metrics.callback("lb_available_backends", "Backends that pass their health checks", "gauge",
+                     lambda: len(backend_health.get()))
+
+    backend_health.start()
+    if metrics_port:
+        start_http_server(metrics, lb_address, metrics_port)
+
+    listener = create_listener(lb_address, lb_port)
+    logging.info(f'L4 load balancer listening on {lb_address}:{lb_port} (policy {lb_policy}, {len(backends)} backends)')
+    try:
+        proxy.serve(listener)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
@@ -1,13 +1,36 @@
+import os
 import socket
 import random
-import requests
+from upstream_pool import UpstreamPool, UpstreamError
+from http_cache import ResponseCache
+from relay import relay_response
+from health import BackendHealth
 
-# List of Reddit server addresses
+# List of Reddit server addresses (LB_BACKENDS="http://host:port/,..." replaces
+# them, e.g. with local stub backends for benchmarks)
 reddit_servers = ['https://www.reddit.com/r/Music/', 'https://www.reddit.com/r/musictheory/', 'https://www.reddit.com/r/red_velvet/']
+if os.getenv("LB_BACKENDS"):
+    reddit_servers = os.getenv("LB_BACKENDS").split(",")
+
+# Keep-alive connections to the Reddit servers, reused across clients
+upstream = UpstreamPool(max_connections=10)
+
+# Responses are relayed through one fixed buffer ("splice", "stream" or "buffered")
+relay_mode = 'splice'
+relay_buffer = bytearray(64 * 1024)
+
+# Cache of Reddit server responses, as far as their Cache-Control/ETag allow
+response_cache = ResponseCache(upstream, max_bytes=64 * 1024 * 1024)
+
+# Health of the Reddit servers: HTTP probes every 5 seconds, and servers
+# whose requests keep failing are ejected for a while
+backend_health = BackendHealth(probe="http", interval=5)
+backend_health.set_backends(reddit_servers)
+backend_health.start()
 
 # Load balancer server address and port
-lb_address = '127.0.0.1'
-lb_port = 8080
+lb_address = os.getenv("LB_ADDRESS", '127.0.0.1')
+lb_port = int(os.getenv("LB_PORT", 8080))
 
 # Create a socket for the load balancer
 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -19,13 +42,15 @@ sock.listen(5)
 next_server_index = 0
 
 def handle_request_round_robin(next_server_index):
-    reddit_server = reddit_servers[next_server_index]
-    next_server_index = (next_server_index + 1) % len(reddit_servers)
+    available_servers = backend_health.get()
+    next_server_index %= len(available_servers)
+    reddit_server = available_servers[next_server_index]
+    next_server_index = (next_server_index + 1) % len(available_servers)
     return reddit_server, next_server_index
 
 # Least connections load balancing algorithm
 def handle_request_least_connections(next_server_index):
-    reddit_server = min(reddit_servers, key=lambda server: server.get_connection_count())
+    reddit_server = min(backend_health.get(), key=lambda server: server.get_connection_count())
     return reddit_server, next_server_index
 
 
@@ -44,14 +69,23 @@ while True:
 
     # Forward the request to the Reddit server
     try:
-        response = requests.get(reddit_server)
+        response = response_cache.get(reddit_server)
         response.raise_for_status()
-    except requests.exceptions.RequestException as e:
+    except UpstreamError as e:
+        backend_health.report(reddit_server, not e.is_backend_failure())
         print(f'Error forwarding request to Reddit server: {e}')
         conn.sendall(b'Error: Could not connect to Reddit server.')
         conn.close()
         continue
 
-    # Send the response back to the client
-    conn.sendall(response.content)
+    backend_health.report(reddit_server, True)
+
+    # Send the response back to the client as it arrives
+    try:
+        with response:
+            relay_response(response, conn, relay_buffer, relay_mode)
+    except (UpstreamError, OSError) as e:
+        print(f'Error relaying response to {addr}: {e}')
+        conn.close()
+        continue
     conn.close()
\ No newline at end of file
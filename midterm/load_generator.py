@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import random
+from resp import encode_command
+
+# Open-loop load generator for the load balancers.
+# Requests are started on a fixed schedule (Poisson or evenly spaced arrivals
+# at rps per second) whether or not earlier ones have finished, like real
+# independent clients, and latency is measured from the scheduled start. A
+# closed loop that waits for each response would slow down together with the
+# balancer and hide exactly the queueing delays we want to see (coordinated
+# omission). At most concurrency requests are in flight: an arrival that finds
+# them all busy is counted as dropped instead of being delayed
+
+class LoadResult:
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.errors = 0
+        self.dropped = 0
+        self.elapsed = 0.0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def summary(self):
+        return {
+            "sent": self.sent,
+            "completed": len(self.latencies),
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "throughput": len(self.latencies) / self.elapsed if self.elapsed else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": max(self.latencies) if self.latencies else None,
+        }
+
+async def run_load(request, rps, duration, concurrency, poisson=True):
+    loop = asyncio.get_running_loop()
+    result = LoadResult()
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def send(scheduled):
+        try:
+            ok = await request()
+        except Exception:
+            # Any failed request is an error, not just connection problems
+            ok = False
+        finally:
+            slots.release()
+        if ok:
+            result.latencies.append(loop.time() - scheduled)
+        else:
+            result.errors += 1
+
+    start = loop.time()
+    scheduled = start
+    while scheduled < start + duration:
+        wait = scheduled - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        result.sent += 1
+        if slots.locked():
+            result.dropped += 1
+        else:
+            await slots.acquire()
+            task = loop.create_task(send(scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        scheduled += random.expovariate(rps) if poisson else 1 / rps
+    if tasks:
+        await asyncio.wait(tasks)
+    result.elapsed = loop.time() - start
+    return result
+
+# Protocol of load_balancer.py and the 2nd-4th versions: the balancer sends
+# the backend's response body as soon as a client connects, and the client
+# hangs up once it has it
+def http_client(host, port, expected_bytes, timeout=10):
+    async def fetch():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            received = 0
+            while received < expected_bytes:
+                data = await reader.read(65536)
+                if not data or (not received and data.startswith(b"Error:")):
+                    return False
+                received += len(data)
+            return True
+        finally:
+            writer.close()
+
+    async def request():
+        return await asyncio.wait_for(fetch(), timeout)
+    return request
+
+# Protocol of 5th_version.py: RESP GET of a random key out of keys, over a
+# pool of persistent connections (one per request in flight)
+def resp_client(host, port, keys=10000, timeout=10):
+    idle = []
+
+    async def fetch():
+        if idle:
+            reader, writer = idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(encode_command("GET", f"key:{random.randrange(keys)}"))
+            line = await reader.readline()
+            if not line:
+                raise EOFError("connection closed")
+            if line.startswith(b"$") and not line.startswith(b"$-1"):
+                await reader.readexactly(int(line[1:]) + 2)
+        except BaseException:
+            writer.close()
+            raise
+        idle.append((reader, writer))
+        return not line.startswith(b"-")
+
+    async def request():
+        return await asyncio.wait_for(fetch(), timeout)
+    return request
+
+def format_ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.2f}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the load balancers")
+    parser.add_argument("protocol", choices=("http", "resp"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--rps", type=float, default=100, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=100, help="maximum requests in flight")
+    parser.add_argument("--uniform", action="store_true", help="evenly spaced instead of Poisson arrivals")
+    parser.add_argument("--bytes", type=int, default=1024, help="http: response size to wait for")
+    parser.add_argument("--keys", type=int, default=10000, help="resp: number of distinct keys")
+    args = parser.parse_args()
+
+    if args.protocol == "http":
+        client = http_client(args.host, args.port, args.bytes)
+    else:
+        client = resp_client(args.host, args.port, args.keys)
+    summary = asyncio.run(run_load(client, args.rps, args.duration, args.concurrency, poisson=not args.uniform)).summary()
+    print(f"sent {summary['sent']}, completed {summary['completed']}, errors {summary['errors']}, dropped {summary['dropped']}")
+    print(f"throughput {summary['throughput']:.1f} req/s, p50 {format_ms(summary['p50'])} ms, "
+          f"p99 {format_ms(summary['p99'])} ms, p999 {format_ms(summary['p999'])} ms")
@@ -0,0 +1,90 @@
+import atexit
+import itertools
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Logging off the hot path: request threads and the event loop only put the
+# record on a queue, and a background thread formats and writes it. When the
+# queue is full records are dropped (and counted) instead of blocking.
+# Per-request lines go through a SampledLogger, which keeps only one in every
+# 1/sample_rate of them and skips the others before a LogRecord is even
+# created, so they cost next to nothing at high request rates
+
+# Logger wrapper that samples debug and info calls; warnings and errors are
+# always logged. Messages should use %-style arguments so that dropped calls
+# do no formatting either
+class SampledLogger:
+    def __init__(self, logger, sample_rate):
+        self.logger = logger
+        self.every = round(1 / sample_rate) if sample_rate > 0 else 0
+        self.seen = itertools.count()
+
+    def sampled(self):
+        return self.every > 0 and next(self.seen) % self.every == 0
+
+    def debug(self, msg, *args):
+        if self.sampled():
+            self.logger.debug(msg, *args)
+
+    def info(self, msg, *args):
+        if self.sampled():
+            self.logger.info(msg, *args)
+
+    def warning(self, msg, *args):
+        self.logger.warning(msg, *args)
+
+    def error(self, msg, *args):
+        self.logger.error(msg, *args)
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    # The listener thread formats the record; nothing is formatted here
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class AsyncLogging:
+    def __init__(self, handler, queue_size=10000):
+        self.handler = handler
+        self.records = queue.Queue(queue_size)
+        self.queue_handler = DroppingQueueHandler(self.records)
+        self.listener = None
+
+    def start(self):
+        self.listener = QueueListener(self.records, self.handler)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+# Configure the root logger like logging.basicConfig(level, format, datefmt),
+# but asynchronous. The writer thread is stopped around fork() and started
+# again in both processes, so forked workers keep logging
+def setup_logging(level=logging.INFO, format=None, datefmt=None, queue_size=10000):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(format, datefmt))
+    async_logging = AsyncLogging(handler, queue_size)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(async_logging.queue_handler)
+    async_logging.start()
+    atexit.register(async_logging.stop)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(
+            before=async_logging.stop,
+            after_in_parent=async_logging.start,
+            after_in_child=async_logging.start,
+        )
+    return async_logging
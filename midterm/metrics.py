@@ -0,0 +1,232 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# In-process metrics, served in the Prometheus text format:
+#   registry = Registry()
+#   requests = registry.counter("lb_requests_total", "Requests forwarded", ("backend",))
+#   requests.labels(backend).inc()
+#   start_http_server(registry, "0.0.0.0", 9100)   # GET /metrics
+# Updating a metric is a dict lookup plus a locked add; everything else
+# (cumulative buckets, text formatting) happens when the endpoint is scraped.
+# Values that other objects already keep (pool stats, scheduler counts) are
+# read at scrape time through registry.callback() instead of being copied on
+# every request
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Gauge(Counter):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+# Upper bounds of the exported buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# HDR-style histogram: values are recorded in whole units (microseconds for
+# scale=1e6) into log-linear buckets, 2**SUB_BITS buckets per power of two, so
+# every value is kept to within 1/16 (~6%) at any magnitude in a fixed array.
+# Quantiles come from the fine buckets; Prometheus gets cumulative counts at
+# the fixed bounds, so the series stay the same from scrape to scrape
+class Histogram:
+    SUB_BITS = 4
+    SUB_COUNT = 1 << SUB_BITS
+    SIZE = 640  # up to 2**39 units, i.e. several days in microseconds
+
+    def __init__(self, bounds=LATENCY_BUCKETS, scale=1e6):
+        self.bounds = bounds
+        self.scale = scale
+        self.lock = threading.Lock()
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.sum = 0.0
+
+    @classmethod
+    def index(cls, units):
+        if units < 2 * cls.SUB_COUNT:
+            return units
+        shift = units.bit_length() - cls.SUB_BITS - 1
+        return min((shift << cls.SUB_BITS) + (units >> shift), cls.SIZE - 1)
+
+    # Smallest value (in units) above every value of bucket i
+    @classmethod
+    def upper(cls, i):
+        if i < 2 * cls.SUB_COUNT:
+            return i + 1
+        shift = (i >> cls.SUB_BITS) - 1
+        return ((i - (shift << cls.SUB_BITS)) + 1) << shift
+
+    def observe(self, value):
+        i = self.index(max(int(value * self.scale), 0))
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return self.upper(i) / self.scale
+        return self.upper(len(counts) - 1) / self.scale
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+            value_sum = self.sum
+        samples = []
+        cumulative = 0
+        i = 0
+        for bound in self.bounds:
+            limit = bound * self.scale
+            while i < len(counts) and self.upper(i) <= limit:
+                cumulative += counts[i]
+                i += 1
+            samples.append((name + "_bucket", labels + (("le", format_value(bound)),), cumulative))
+        samples.append((name + "_bucket", labels + (("le", "+Inf"),), total))
+        samples.append((name + "_sum", labels, value_sum))
+        samples.append((name + "_count", labels, total))
+        return samples
+
+# A metric with its label names and one child (Counter, Gauge or Histogram)
+# per combination of label values
+class Family:
+    def __init__(self, name, help, type, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def samples(self):
+        samples = []
+        for values, child in list(self.children.items()):
+            samples.extend(child.samples(self.name, tuple(zip(self.labelnames, values))))
+        return samples
+
+# A metric whose values are read from fn() when it is scraped.
+# fn returns {label values tuple: value}, or a single number without labels
+class Callback:
+    def __init__(self, name, help, type, labelnames, fn):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            return [(self.name, (), values)]
+        return [(self.name, tuple(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Duplicate metric: {metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    # Without labels these return the metric itself, otherwise the Family
+    def counter(self, name, help, labelnames=()):
+        return self.family(name, help, "counter", labelnames, Counter)
+
+    def gauge(self, name, help, labelnames=()):
+        return self.family(name, help, "gauge", labelnames, Gauge)
+
+    def histogram(self, name, help, labelnames=(), bounds=LATENCY_BUCKETS, scale=1e6):
+        return self.family(name, help, "histogram", labelnames, lambda: Histogram(bounds, scale))
+
+    def family(self, name, help, type, labelnames, factory):
+        family = self.register(Family(name, help, type, labelnames, factory))
+        return family if labelnames else family.labels()
+
+    def callback(self, name, help, type, fn, labelnames=()):
+        return self.register(Callback(name, help, type, labelnames, fn))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                lines.append(f"# Error collecting {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+# Serve registry.render() on GET /metrics from a daemon thread
+def start_http_server(registry, address, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
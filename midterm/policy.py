@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Raised when no backend could be acquired for a request
+class NoBackendError(Exception):
+    pass
+
+# Latencies of the last window successful requests. Quantiles are computed
+# from a sorted copy, and only again after refresh new samples
+class LatencyTracker:
+    def __init__(self, window=1000, refresh=100):
+        self.samples = deque(maxlen=window)
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.added = 0
+        self.quantiles = {}
+
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+            self.added += 1
+            if self.added >= self.refresh:
+                self.added = 0
+                self.quantiles = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def quantile(self, q):
+        with self.lock:
+            if not self.samples:
+                return None
+            value = self.quantiles.get(q)
+            if value is None:
+                ordered = sorted(self.samples)
+                value = self.quantiles[q] = ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+            return value
+
+# Token bucket for retries and hedges: every request adds ratio tokens (up to
+# max_tokens) and every extra attempt takes one, so extra attempts stay below
+# ratio of the traffic and a failing backend cannot multiply the load on the
+# others
+class RetryBudget:
+    def __init__(self, ratio=0.2, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+# Forwarding policy on top of a Scheduler:
+#   backend, result = policy.forward(send, key)   # send(backend) -> result
+#   ...
+#   scheduler.release(backend)
+#  - a failed attempt is retried on a different backend, up to max_attempts
+#    in total, as long as retryable(error) and the retry budget allow it
+#  - with hedge=True, a request still running after the hedge_quantile
+#    latency of recent requests (at least hedge_min_delay) gets a second
+#    attempt on another backend and the first result wins. The loser's result
+#    is closed and its backend released when it arrives
+#  - every response time goes to scheduler.observe() (for peak_ewma) and, with
+#    health, every result to health.report()
+# The winning backend stays acquired; forward() releases all the others
+class ForwardPolicy:
+    def __init__(self, scheduler, health=None, max_attempts=2, retryable=None, hedge=False, hedge_quantile=0.95,
+                 hedge_min_delay=0.01, hedge_default_delay=0.1, budget_ratio=0.2, max_workers=64):
+        self.scheduler = scheduler
+        self.health = health
+        self.max_attempts = max_attempts
+        self.retryable = retryable or (lambda error: True)
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.latencies = LatencyTracker()
+        self.budget = RetryBudget(budget_ratio)
+        self.executor = None
+        if hedge:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    # How long to wait for an attempt before hedging it
+    def hedge_delay(self):
+        if len(self.latencies) < 20:
+            return self.hedge_default_delay
+        return max(self.latencies.quantile(self.hedge_quantile), self.hedge_min_delay)
+
+    def forward(self, send, key=None):
+        self.count("requests")
+        self.budget.deposit()
+        tried = []
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                if not self.retryable(error) or not self.budget.withdraw():
+                    break
+            backend = self.scheduler.acquire(key, exclude=tried)
+            if backend is None:
+                break
+            if attempt > 0:
+                self.count("retries")
+                logging.warning(f"Retrying on {backend} after error from {tried[-1]}: {error}")
+            tried.append(backend)
+            try:
+                if self.executor is None:
+                    return backend, self.attempt(send, backend)
+                return self.hedged(send, key, backend, tried)
+            except Exception as e:
+                error = e
+        if error is None:
+            raise NoBackendError("No backends available")
+        raise error
+
+    # One attempt on an acquired backend; the backend is released if it fails
+    def attempt(self, send, backend):
+        start = time.monotonic()
+        try:
+            result = send(backend)
+        except Exception as e:
+            self.scheduler.release(backend)
+            if self.health is not None:
+                self.health.report(backend, not self.retryable(e))
+            raise
+        latency = time.monotonic() - start
+        self.latencies.record(latency)
+        self.scheduler.observe(backend, latency)
+        if self.health is not None:
+            self.health.report(backend, True)
+        return result
+
+    def hedged(self, send, key, backend, tried):
+        primary = self.executor.submit(self.attempt, send, backend)
+        pending = {primary: backend}
+        done, _ = wait([primary], timeout=self.hedge_delay())
+        if not done and self.budget.withdraw():
+            other = self.scheduler.acquire(key, exclude=tried)
+            if other is not None:
+                tried.append(other)
+                self.count("hedges")
+                pending[self.executor.submit(self.attempt, send, other)] = other
+
+        error = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                winner = pending.pop(future)
+                error = future.exception()
+                if error is not None:
+                    continue
+                if future is not primary:
+                    self.count("hedge_wins")
+                for loser, loser_backend in pending.items():
+                    loser.add_done_callback(lambda future, loser_backend=loser_backend: self.discard(future, loser_backend))
+                return winner, future.result()
+        raise error
+
+    # Drop the result of an attempt that lost the race
+    def discard(self, future, backend):
+        if future.exception() is not None:
+            return
+        close = getattr(future.result(), "close", None)
+        if close is not None:
+            close()
+        self.scheduler.release(backend)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_delay": self.hedge_delay(),
+            }
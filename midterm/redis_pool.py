@@ -0,0 +1,91 @@
+import threading
+import time
+import redis
+
+# Waits for a free connection, per Redis host
+class PoolStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0      # acquisitions that did not get a connection immediately
+        self.timeouts = 0    # acquisitions that gave up after pool_timeout
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, timed_out):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.acquired += 1
+            # Below 1 ms a connection was free, anything above was a real wait
+            if wait > 0.001:
+                self.waited += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "timeouts": self.timeouts,
+                "wait_time": self.wait_time,
+                "max_wait": self.max_wait,
+            }
+
+# BlockingConnectionPool that records how long callers wait for a connection
+class TimedConnectionPool(redis.BlockingConnectionPool):
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def get_connection(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except redis.exceptions.ConnectionError:
+            self.stats.record(time.monotonic() - start, timed_out=True)
+            raise
+        self.stats.record(time.monotonic() - start, timed_out=False)
+        return connection
+
+# One bounded pool of persistent connections per Redis host ("host:port"),
+# created up front and shared by all client threads. When all max_connections
+# of a host are busy, callers wait up to pool_timeout seconds for one
+class RedisPools:
+    def __init__(self, hosts, max_connections=50, pool_timeout=5, socket_timeout=5):
+        self.stats = {}
+        self.clients = {}
+        for host in hosts:
+            self.add(host, max_connections, pool_timeout, socket_timeout)
+
+    def add(self, host, max_connections, pool_timeout, socket_timeout):
+        address, port = host.rsplit(":", 1)
+        self.stats[host] = PoolStats()
+        pool = TimedConnectionPool(
+            self.stats[host],
+            host=address,
+            port=int(port),
+            max_connections=max_connections,
+            timeout=pool_timeout,
+            socket_timeout=socket_timeout,
+        )
+        self.clients[host] = redis.Redis(connection_pool=pool)
+
+    def client(self, host):
+        return self.clients[host]
+
+    # GET several keys on one host in a single round trip (MGET);
+    # returns the values in key order, None for missing keys
+    def get_many(self, host, keys):
+        if len(keys) == 1:
+            return [self.clients[host].get(keys[0])]
+        return self.clients[host].mget(keys)
+
+    def snapshot(self):
+        return {host: stats.snapshot() for host, stats in self.stats.items()}
+
+    def close(self):
+        for client in self.clients.values():
+            client.connection_pool.disconnect()
@@ -0,0 +1,156 @@
+import asyncio
+import errno
+import os
+import select
+import ssl
+from upstream_pool import UpstreamStream
+
+# Default per-connection relay buffer (and splice pipe) size
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+# os.splice moves bytes socket -> pipe -> socket inside the kernel (Linux, Python >= 3.10)
+HAS_SPLICE = hasattr(os, "splice")
+
+# Copy the upstream body to the client chunk by chunk through one reusable
+# buffer, so memory per connection stays at len(buffer) whatever the body size.
+# Returns the number of bytes relayed
+def relay_stream(stream, conn, buffer):
+    view = memoryview(buffer)
+    relayed = 0
+    while True:
+        n = stream.readinto(view)
+        if not n:
+            break
+        conn.sendall(view[:n])
+        relayed += n
+    return relayed
+
+# Zero-copy only works for a live response on a plain TCP upstream socket
+# with a body of known length (no TLS, no chunked encoding, not cached);
+# anything else uses relay_stream
+def can_splice(stream):
+    if not isinstance(stream, UpstreamStream):
+        return False
+    response = stream.response
+    sock = stream.conn.sock
+    return (
+        HAS_SPLICE
+        and sock is not None
+        and not isinstance(sock, ssl.SSLSocket)
+        and not response.chunked
+        # An empty body (Content-Length: 0, 204, 304, HEAD) has nothing to
+        # splice, and looking for its bytes would wait on an idle socket
+        and response.length is not None
+        and response.length > 0
+    )
+
+# Relay the upstream body with os.splice when possible, falling back to
+# relay_stream. Bytes http.client has already buffered while parsing the
+# headers are sent through the buffer first (all of them, in several rounds
+# when the buffer is smaller than the reader's read-ahead: splice reads the
+# socket and would skip any left behind), the rest never enters user space
+def relay_zero_copy(stream, conn, buffer):
+    if not can_splice(stream):
+        return relay_stream(stream, conn, buffer)
+
+    response = stream.response
+    view = memoryview(buffer)
+    relayed = 0
+    # peek() returns the whole read-ahead, and reading no more than that never
+    # touches the socket. With nothing buffered it waits for the first bytes
+    # of the body, which are on their way (length > 0, see can_splice)
+    buffered = min(len(response.fp.peek(0)), response.length)
+    while buffered:
+        n = stream.readinto(view[:min(buffered, len(view))])
+        if not n:
+            raise ConnectionError("upstream closed the connection mid-body")
+        conn.sendall(view[:n])
+        relayed += n
+        buffered -= n
+
+    remaining = response.length
+    if remaining:
+        splice(stream.conn.sock, conn, remaining, len(buffer))
+        relayed += remaining
+        # The body has been consumed behind http.client's back: finish the
+        # response so the connection can go back to the pool
+        response.length = 0
+        response.read()
+    return relayed
+
+# Send the upstream body to a blocking client socket using one of the modes:
+# "buffered" reads the whole body first, "stream" relays chunk by chunk and
+# "splice" (default) relays with zero copy when the upstream allows it
+def relay_response(stream, conn, buffer, mode="splice"):
+    if mode == "buffered":
+        content = stream.read()
+        conn.sendall(content)
+        return len(content)
+    if mode == "stream":
+        return relay_stream(stream, conn, buffer)
+    return relay_zero_copy(stream, conn, buffer)
+
+# Event-loop version of relay_stream for asyncio clients: the blocking upstream
+# reads run on the executor, and the transport may only hold up to len(buffer)
+# unsent bytes before we stop reading from the upstream
+async def relay_stream_async(stream, writer, buffer, executor=None):
+    loop = asyncio.get_running_loop()
+    writer.transport.set_write_buffer_limits(high=len(buffer))
+    view = memoryview(buffer)
+    relayed = 0
+    while True:
+        n = await loop.run_in_executor(executor, stream.readinto, view)
+        if not n:
+            break
+        # The transport keeps whatever it could not send right away, so it
+        # gets a copy rather than a view of the buffer we are about to reuse
+        writer.write(bytes(view[:n]))
+        await writer.drain()
+        relayed += n
+    return relayed
+
+# Wait until fd is ready, honouring the socket timeout (None means forever)
+def wait_ready(sock, for_write):
+    timeout = sock.gettimeout()
+    if for_write:
+        _, ready, _ = select.select([], [sock], [], timeout)
+    else:
+        ready, _, _ = select.select([sock], [], [], timeout)
+    if not ready:
+        raise TimeoutError("timed out while relaying")
+
+# Move exactly count bytes from src to dst socket through a kernel pipe of
+# pipe_size bytes. Sockets with a timeout are non-blocking underneath, so
+# EAGAIN means waiting with select
+def splice(src, dst, count, pipe_size=DEFAULT_BUFFER_SIZE):
+    read_fd, write_fd = os.pipe()
+    try:
+        try:
+            import fcntl
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, pipe_size)
+        except (ImportError, AttributeError, OSError):
+            pass
+
+        while count:
+            try:
+                n = os.splice(src.fileno(), write_fd, min(count, pipe_size), flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+            except BlockingIOError:
+                wait_ready(src, for_write=False)
+                continue
+            if n == 0:
+                raise ConnectionError("upstream closed the connection mid-body")
+            count -= n
+            while n:
+                try:
+                    sent = os.splice(read_fd, dst.fileno(), n, flags=os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+                except BlockingIOError:
+                    wait_ready(dst, for_write=True)
+                    continue
+                except OSError as e:
+                    if e.errno == errno.EPIPE:
+                        raise ConnectionError("client closed the connection") from e
+                    raise
+                n -= sent
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
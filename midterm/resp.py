@@ -0,0 +1,114 @@
+# Request framing for the Redis balancer.
+# Clients can speak either
+#   RESP     - "*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n", answered in RESP, or
+#   lines    - "foo\n", one key per line (the original 5th_version protocol),
+#              answered with the value (or an error text) and "\n".
+# Any number of requests can be pipelined on one connection and split across
+# reads in any way: RequestParser keeps the incomplete tail for the next feed()
+
+# Same limits as Redis itself
+MAX_BULK_LENGTH = 512 * 1024 * 1024
+MAX_ARRAY_LENGTH = 1024 * 1024
+MAX_INLINE_LENGTH = 64 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+RESP = "resp"
+LINE = "line"
+
+class RequestParser:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+
+    # Add received bytes and return the complete requests as (protocol, args)
+    # tuples: args is the RESP command array, or [key] for a line request
+    def feed(self, data):
+        self.buffer += data
+        requests = []
+        while self.position < len(self.buffer):
+            if self.buffer[self.position:self.position + 1] == b"*":
+                request = self.parse_array()
+            else:
+                request = self.parse_line()
+            if request is None:
+                break
+            # Empty lines and empty arrays are ignored, like Redis does
+            if request[1]:
+                requests.append(request)
+        # Drop the consumed bytes only once per feed to keep parsing linear
+        del self.buffer[:self.position]
+        self.position = 0
+        return requests
+
+    # Read a CRLF (or LF) terminated header line starting at start.
+    # Returns (line, position after it) or None if it is not complete yet
+    def read_line(self, start):
+        end = self.buffer.find(b"\n", start)
+        if end == -1:
+            if len(self.buffer) - start > MAX_INLINE_LENGTH:
+                raise ProtocolError("line too long")
+            return None
+        line = bytes(self.buffer[start:end])
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        return line, end + 1
+
+    def parse_line(self):
+        result = self.read_line(self.position)
+        if result is None:
+            return None
+        key, self.position = result
+        return LINE, [key] if key else []
+
+    def parse_int(self, line, prefix, maximum):
+        if not line.startswith(prefix):
+            raise ProtocolError(f"expected '{prefix.decode()}', got {line[:16]!r}")
+        try:
+            value = int(line[1:])
+        except ValueError:
+            raise ProtocolError(f"invalid length {line[:16]!r}") from None
+        if value > maximum:
+            raise ProtocolError("length too large")
+        return value
+
+    def parse_array(self):
+        result = self.read_line(self.position)
+        if result is None:
+            return None
+        header, position = result
+        count = self.parse_int(header, b"*", MAX_ARRAY_LENGTH)
+        args = []
+        for _ in range(max(count, 0)):
+            result = self.read_line(position)
+            if result is None:
+                return None
+            header, position = result
+            length = self.parse_int(header, b"$", MAX_BULK_LENGTH)
+            if len(self.buffer) < position + length + 2:
+                return None
+            args.append(bytes(self.buffer[position:position + length]))
+            if self.buffer[position + length:position + length + 2] != b"\r\n":
+                raise ProtocolError("bulk string not terminated by CRLF")
+            position += length + 2
+        self.position = position
+        return RESP, args
+
+def encode_simple(text):
+    return b"+" + text.encode() + b"\r\n"
+
+def encode_error(text):
+    return b"-" + text.encode() + b"\r\n"
+
+def encode_bulk(value):
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+def encode_array(values):
+    return b"*%d\r\n" % len(values) + b"".join(encode_bulk(value) for value in values)
+
+# Encode a command for a Redis server (used by stub/test clients)
+def encode_command(*args):
+    return encode_array([arg if isinstance(arg, bytes) else str(arg).encode() for arg in args])
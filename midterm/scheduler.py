@@ -0,0 +1,314 @@
+from fractions import Fraction
+import itertools
+import math
+import random
+import threading
+import time
+from hash_ring import HashRing
+
+# Schedulers pick a backend for each request and track how many requests
+# every backend has in flight:
+#   backend = scheduler.acquire(key)   # None when there are no backends
+#   ...
+#   scheduler.release(backend)
+# acquire() counts the request atomically with the choice, so two threads can
+# never both see the same backend as the least loaded one. Backends can be
+# replaced at any time with set_backends() (e.g. from BackendRegistry.subscribe);
+# releasing a backend that was removed in the meantime is ignored.
+# weights maps backend -> weight (default 1): a backend with weight 2 is given
+# twice as many requests. key is only used by key-aware policies
+# (consistent_hash) and ignored by the others. Retries pass the backends they
+# already tried as exclude, and latency-aware policies (peak_ewma) learn from
+# scheduler.observe(backend, seconds) after each response
+
+# Parse LB_WEIGHTS style settings: "host1:6379=3,host2:6379=1". Weights must
+# be positive (the policies divide by them)
+def parse_weights(text):
+    weights = {}
+    for item in filter(None, (part.strip() for part in (text or "").split(","))):
+        backend, _, weight = item.rpartition("=")
+        weights[backend] = float(weight)
+        if not 0 < weights[backend] < math.inf:
+            raise ValueError(f"Weight of {backend} must be a positive number, not {weight}")
+    return weights
+
+class Scheduler:
+    def __init__(self, backends=(), weights=None):
+        self.lock = threading.Lock()
+        self.weights = dict(weights or {})
+        self.counts = {}
+        self.set_backends(backends)
+
+    def weight(self, backend):
+        return self.weights.get(backend, 1)
+
+    def count(self, backend):
+        return self.counts.get(backend, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def set_backends(self, backends, weights=None):
+        with self.lock:
+            if weights is not None:
+                self.weights = dict(weights)
+            self.counts = {backend: self.counts.get(backend, 0) for backend in backends}
+            self.update_backends()
+
+    def update_backends(self):
+        pass
+
+    def acquire(self, key=None, exclude=()):
+        with self.lock:
+            if not self.counts:
+                return None
+            backend = self.choose(key)
+            if backend in exclude:
+                backend = self.choose_other(exclude)
+                if backend is None:
+                    return None
+            self.counts[backend] += 1
+            self.changed(backend, 1)
+            return backend
+
+    def release(self, backend):
+        with self.lock:
+            if self.counts.get(backend, 0) > 0:
+                self.counts[backend] -= 1
+                self.changed(backend, -1)
+
+    # Called under the lock after the in-flight count of backend moved by delta
+    def changed(self, backend, delta):
+        pass
+
+    # Fallback when the policy's choice was excluded: the least loaded of the
+    # other backends. Only retries get here, so a scan is fine
+    def choose_other(self, exclude):
+        others = [backend for backend in self.counts if backend not in exclude]
+        if not others:
+            return None
+        return min(others, key=lambda backend: self.counts[backend] / self.weight(backend))
+
+    # Response time of a request to backend, in seconds
+    def observe(self, backend, latency):
+        pass
+
+# Smooth weighted round-robin (the nginx algorithm): with equal weights it is
+# plain round-robin, otherwise heavier backends are picked more often but
+# still interleaved with the others.
+# The picks repeat with a period of the sum of the weights (scaled to the
+# smallest whole numbers), so one period is worked out when the backends
+# change and choose() just steps through it. Weights whose period would cost
+# more than MAX_CYCLE_STEPS to work out are scanned on every request instead
+MAX_CYCLE_STEPS = 1 << 20
+
+class RoundRobinScheduler(Scheduler):
+    def update_backends(self):
+        self.backends = list(self.counts)
+        self.current = {backend: 0 for backend in self.backends}
+        self.cycle = self.make_cycle()
+        self.index = 0
+
+    def make_cycle(self):
+        if not self.backends:
+            return []
+        weights = [Fraction(self.weight(backend)) for backend in self.backends]
+        denominator = math.lcm(*(weight.denominator for weight in weights))
+        numerators = [int(weight * denominator) for weight in weights]
+        divisor = math.gcd(*numerators)
+        whole = {backend: numerator // divisor for backend, numerator in zip(self.backends, numerators)}
+        period = sum(whole.values())
+        if period * len(self.backends) > MAX_CYCLE_STEPS:
+            return None
+        current = dict.fromkeys(self.backends, 0)
+        cycle = []
+        for _ in range(period):
+            for backend in self.backends:
+                current[backend] += whole[backend]
+            best = max(self.backends, key=current.__getitem__)
+            current[best] -= period
+            cycle.append(best)
+        return cycle
+
+    def choose(self, key):
+        if self.cycle is not None:
+            backend = self.cycle[self.index]
+            self.index = (self.index + 1) % len(self.cycle)
+            return backend
+        total = 0
+        best = None
+        for backend in self.backends:
+            weight = self.weight(backend)
+            self.current[backend] += weight
+            total += weight
+            if best is None or self.current[backend] > self.current[best]:
+                best = backend
+        self.current[best] -= total
+        return best
+
+# Weighted least-connections over an indexed binary min-heap: acquire and
+# release are O(log n) instead of a scan over all backends.
+# A backend's key is (in-flight + 1) / weight, the load it would have with one
+# more request, and ties go to the backend that was used least recently
+class LeastConnectionsScheduler(Scheduler):
+    def update_backends(self):
+        self.sequence = itertools.count()
+        self.used = {backend: next(self.sequence) for backend in self.counts}
+        self.heap = list(self.counts)
+        self.heap.sort(key=self.key)
+        self.position = {backend: i for i, backend in enumerate(self.heap)}
+
+    def key(self, backend):
+        return (self.counts[backend] + 1) / self.weight(backend), self.used[backend]
+
+    def choose(self, key):
+        return self.heap[0]
+
+    def changed(self, backend, delta):
+        self.used[backend] = next(self.sequence)
+        i = self.position[backend]
+        self.sift_up(i)
+        self.sift_down(self.position[backend])
+
+    def swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.position[heap[i]] = i
+        self.position[heap[j]] = j
+
+    def sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if self.key(self.heap[i]) >= self.key(self.heap[parent]):
+                break
+            self.swap(i, parent)
+            i = parent
+
+    def sift_down(self, i):
+        size = len(self.heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and self.key(self.heap[child]) < self.key(self.heap[smallest]):
+                    smallest = child
+            if smallest == i:
+                return
+            self.swap(i, smallest)
+            i = smallest
+
+# Power of two choices: compare two random backends and take the less loaded
+# one. O(1) per request and, unlike strict least-connections, several load
+# balancers with their own counts do not all pile onto the same backend
+class PowerOfTwoScheduler(Scheduler):
+    def update_backends(self):
+        self.backends = list(self.counts)
+
+    def choose(self, key):
+        if len(self.backends) == 1:
+            return self.backends[0]
+        first, second = random.sample(self.backends, 2)
+        if self.counts[second] / self.weight(second) < self.counts[first] / self.weight(first):
+            return second
+        return first
+
+# Consistent hashing with bounded loads (Mirrokni et al.): a key goes to its
+# owner on the hash ring unless that backend already has more than
+# load_factor times the average in-flight requests, in which case the next
+# backend clockwise that is under the bound takes it. load_factor=None is
+# plain consistent hashing. Weights are not used
+class ConsistentHashScheduler(Scheduler):
+    def __init__(self, backends=(), weights=None, vnodes=160, load_factor=1.25):
+        self.ring = HashRing(vnodes=vnodes)
+        self.load_factor = load_factor
+        self.inflight = 0
+        super().__init__(backends, weights)
+
+    def update_backends(self):
+        self.ring.set_nodes(self.counts)
+        self.inflight = sum(self.counts.values())
+
+    def choose(self, key):
+        if key is None:
+            key = str(random.random())
+        if self.load_factor is None:
+            return self.ring.get(key)
+        capacity = math.ceil(self.load_factor * (self.inflight + 1) / len(self.counts))
+        for backend in self.ring.successors(key):
+            if self.counts[backend] < capacity:
+                return backend
+        return self.ring.get(key)
+
+    def changed(self, backend, delta):
+        self.inflight += delta
+
+# Peak EWMA (as in Finagle and Linkerd): every backend has a moving average of
+# its response time that jumps straight up to any slower sample and otherwise
+# decays with time constant decay seconds. A backend costs that latency times
+# (in-flight + 1) / weight and the cheaper of two random backends is chosen,
+# so a backend that turns slow stops getting requests within a few responses.
+# Backends without a measurement yet get one request at a time until they have
+# one
+class PeakEwmaScheduler(Scheduler):
+    UNMEASURED_PENALTY = 1e6
+
+    def __init__(self, backends=(), weights=None, decay=10.0):
+        self.decay = decay
+        self.latency = {}
+        self.stamps = {}
+        super().__init__(backends, weights)
+
+    def update_backends(self):
+        self.backends = list(self.counts)
+        self.latency = {backend: self.latency.get(backend, 0.0) for backend in self.backends}
+        self.stamps = {backend: self.stamps.get(backend, 0.0) for backend in self.backends}
+
+    # The average decays towards 0 while a backend gets no responses, so a
+    # backend that was slow once is tried again eventually
+    def decayed(self, backend, now):
+        return self.latency[backend] * math.exp(-(now - self.stamps[backend]) / self.decay)
+
+    def cost(self, backend, now):
+        latency = self.decayed(backend, now)
+        pending = self.counts[backend]
+        if latency == 0 and pending:
+            return self.UNMEASURED_PENALTY + pending
+        return latency * (pending + 1) / self.weight(backend)
+
+    def choose(self, key):
+        if len(self.backends) == 1:
+            return self.backends[0]
+        now = time.monotonic()
+        first, second = random.sample(self.backends, 2)
+        if self.cost(second, now) < self.cost(first, now):
+            return second
+        return first
+
+    def observe(self, backend, latency):
+        with self.lock:
+            if backend not in self.latency:
+                return
+            now = time.monotonic()
+            decay = math.exp(-(now - self.stamps[backend]) / self.decay)
+            average = self.latency[backend] * decay
+            if latency > average:
+                self.latency[backend] = latency
+            else:
+                self.latency[backend] = average + latency * (1 - decay)
+            self.stamps[backend] = now
+
+SCHEDULERS = {
+    "round_robin": RoundRobinScheduler,
+    "least_connections": LeastConnectionsScheduler,
+    "power_of_two": PowerOfTwoScheduler,
+    "consistent_hash": ConsistentHashScheduler,
+    "peak_ewma": PeakEwmaScheduler,
+}
+
+# Create the scheduler for an LB_POLICY value; options are passed on to the
+# scheduler class (e.g. vnodes and load_factor for consistent_hash, decay
+# for peak_ewma)
+def make_scheduler(policy, backends=(), weights=None, **options):
+    if policy not in SCHEDULERS:
+        raise ValueError(f"Unknown load balancing policy: {policy} (expected one of {', '.join(SCHEDULERS)})")
+    return SCHEDULERS[policy](backends, weights, **options)
@@ -0,0 +1,171 @@
+import argparse
+import math
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from resp import RequestParser, ProtocolError, encode_array, encode_bulk, encode_error, encode_simple
+
+# Local stand-ins for the Reddit servers (HTTP) and Redis servers (RESP), so
+# the load balancers can be benchmarked without reddit.com or a live Redis.
+# Every response is delayed by a sample of a latency distribution and fails
+# with probability error_rate:
+#   python stub_backends.py http 9001 9002 9003 --latency exp:5ms --error-rate 0.01
+#   python stub_backends.py resp 7001 7002 --latency const:1ms,lognormal:1ms:1.0
+
+UNITS = {"us": 1e-6, "ms": 1e-3, "s": 1}
+
+# "250us", "5ms", "0.2s" or a plain number of seconds
+def parse_duration(text):
+    for unit in ("us", "ms", "s"):
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * UNITS[unit]
+    return float(text)
+
+# Latency distributions, parsed from "kind:arguments":
+#   const:5ms                 always 5 ms
+#   uniform:1ms:9ms           uniform between 1 and 9 ms
+#   exp:5ms                   exponential with mean 5 ms
+#   lognormal:5ms:1.0         log-normal with median 5 ms and sigma 1.0
+#   pareto:2ms:1.5            Pareto with minimum 2 ms and shape 1.5 (heavy tail)
+#   bimodal:2ms:200ms:0.05    2 ms, but 200 ms for 5% of the requests
+def parse_latency(spec):
+    kind, *args = spec.split(":")
+    if kind == "const":
+        value = parse_duration(args[0])
+        return lambda: value
+    if kind == "uniform":
+        low, high = parse_duration(args[0]), parse_duration(args[1])
+        return lambda: random.uniform(low, high)
+    if kind == "exp":
+        mean = parse_duration(args[0])
+        return lambda: random.expovariate(1 / mean) if mean > 0 else 0
+    if kind == "lognormal":
+        median, sigma = parse_duration(args[0]), float(args[1]) if len(args) > 1 else 1.0
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    if kind == "pareto":
+        minimum, shape = parse_duration(args[0]), float(args[1]) if len(args) > 1 else 1.5
+        return lambda: minimum * random.paretovariate(shape)
+    if kind == "bimodal":
+        fast, slow, slow_fraction = parse_duration(args[0]), parse_duration(args[1]), float(args[2])
+        return lambda: slow if random.random() < slow_fraction else fast
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+# One distribution per backend from "spec,spec,...": the last one is repeated
+# for the remaining backends
+def parse_latencies(text, count):
+    specs = text.split(",")
+    return [parse_latency(specs[min(i, len(specs) - 1)]) for i in range(count)]
+
+def delay(latency):
+    seconds = latency()
+    if seconds > 0:
+        time.sleep(seconds)
+
+# HTTP/1.1 backend with keep-alive: every GET answers body_size bytes, or a 503
+# for the failed ones. Responses carry cache_control (no-store by default, so
+# a balancer's response cache does not hide the backend; e.g. "max-age=1" to
+# benchmark cache hits)
+def make_http_server(address, port, latency, error_rate=0.0, body_size=1024, cache_control="no-store"):
+    body = b"x" * body_size
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are separate writes: without this, Nagle plus
+        # delayed ACKs add ~40 ms to every keep-alive response
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            delay(latency)
+            if random.random() < error_rate:
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Cache-Control", cache_control)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), StubHandler)
+    server.daemon_threads = True
+    return server
+
+# Redis backend: GET and MGET answer value_size byte values for every key,
+# PING answers PONG; a failed command answers an error reply
+def make_resp_server(address, port, latency, error_rate=0.0, value_size=64):
+    value = b"v" * value_size
+
+    def reply(args):
+        command = args[0].upper()
+        if command == b"PING":
+            return encode_simple("PONG")
+        delay(latency)
+        if random.random() < error_rate:
+            return encode_error("ERR stub error")
+        if command == b"GET":
+            return encode_bulk(value)
+        if command == b"MGET":
+            return encode_array([value] * (len(args) - 1))
+        return encode_error(f"ERR unknown command '{command.decode(errors='replace')}'")
+
+    class StubHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            parser = RequestParser()
+            while True:
+                data = self.request.recv(65536)
+                if not data:
+                    return
+                try:
+                    requests = parser.feed(data)
+                except ProtocolError as e:
+                    self.request.sendall(encode_error(f"ERR Protocol error: {e}"))
+                    return
+                if requests:
+                    self.request.sendall(b"".join(reply(args) for _, args in requests))
+
+    class StubServer(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    return StubServer((address, port), StubHandler)
+
+# Start one server per port in background threads and return them
+def start_servers(protocol, address, ports, latencies, error_rate=0.0, size=1024, cache_control="no-store"):
+    make_server = make_http_server if protocol == "http" else make_resp_server
+    options = {"cache_control": cache_control} if protocol == "http" else {}
+    servers = []
+    for port, latency in zip(ports, latencies):
+        server = make_server(address, port, latency, error_rate, size, **options)
+        threading.Thread(target=server.serve_forever, name=f"stub-{port}", daemon=True).start()
+        servers.append(server)
+    return servers
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub HTTP/Redis backends for load balancer benchmarks")
+    parser.add_argument("protocol", choices=("http", "resp"))
+    parser.add_argument("ports", type=int, nargs="+")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--latency", default="const:0", help="latency distribution(s), one per backend (comma separated)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--size", type=int, default=1024, help="response body (http) or value (resp) size in bytes")
+    parser.add_argument("--cache-control", default="no-store", help="http: Cache-Control of the responses")
+    args = parser.parse_args()
+
+    latencies = parse_latencies(args.latency, len(args.ports))
+    start_servers(args.protocol, args.address, args.ports, latencies, args.error_rate, args.size, args.cache_control)
+    print(f"Stub {args.protocol} backends listening on {', '.join(str(port) for port in args.ports)}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
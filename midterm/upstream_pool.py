@@ -0,0 +1,321 @@
+import http.client
+import select
+import threading
+import time
+from collections import deque
+from urllib.parse import urljoin, urlsplit
+
+# Raised for anything that went wrong talking to a backend (connect errors,
+# timeouts, protocol errors, exhausted pool, error status codes).
+# status is the HTTP status for error responses and None otherwise
+class UpstreamError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    # Whether the backend itself is to blame (as opposed to e.g. a 404)
+    def is_backend_failure(self):
+        return self.status is None or self.status >= 500
+
+# Response of a backend request, with the whole body already read
+class UpstreamResponse:
+    def __init__(self, url, status, reason, headers, content):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise UpstreamError(f'{self.status} {self.reason} for url: {self.url}', self.status)
+
+# Response of a backend request whose body has not been read yet.
+# The connection goes back to the pool on close() only if the body was read
+# to the end and the backend allows keep-alive; otherwise it is closed
+class UpstreamStream:
+    def __init__(self, pool, conn, url, response):
+        self.pool = pool
+        self.conn = conn
+        self.url = url
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = dict(response.getheaders())
+        self.closed = False
+
+    # The body of an error response is not needed: the stream is closed first
+    def raise_for_status(self):
+        if self.status >= 400:
+            self.close()
+            raise UpstreamError(f'{self.status} {self.reason} for url: {self.url}', self.status)
+
+    def read(self):
+        try:
+            return self.response.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise UpstreamError(f'Error reading response from {self.url}: {e}') from e
+
+    def readinto(self, buffer):
+        try:
+            return self.response.readinto(buffer)
+        except (OSError, http.client.HTTPException) as e:
+            raise UpstreamError(f'Error reading response from {self.url}: {e}') from e
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put_idle(self.conn)
+        else:
+            self.conn.close()
+        self.pool.slots.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Split a backend URL into the pool key (scheme, host, port) and the request path
+def parse_url(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        raise UpstreamError(f'Unsupported URL scheme: {url}')
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return (parts.scheme, parts.hostname, port), path
+
+# A pooled socket is only reused if the backend has not closed it (or sent
+# unexpected bytes) while it was idle: in both cases it would be readable
+def is_connection_alive(conn):
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+# Keep-alive connections to a single backend
+class BackendPool:
+    def __init__(self, key, max_connections, idle_timeout, timeout):
+        self.key = key
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = deque()  # (connection, time it was returned)
+
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.waited = 0      # acquisitions that did not get a connection immediately
+        self.timeouts = 0    # acquisitions that gave up after pool_timeout
+        self.wait_time = 0.0
+
+    def new_connection(self):
+        scheme, host, port = self.key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        with self.lock:
+            self.created += 1
+        return conn
+
+    # Take the most recently used healthy connection, dropping stale ones.
+    # Returns None when a new connection has to be opened
+    def take_idle(self):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                conn, returned_at = self.idle.pop()
+            if now - returned_at < self.idle_timeout and is_connection_alive(conn):
+                with self.lock:
+                    self.reused += 1
+                return conn
+            conn.close()
+            with self.lock:
+                self.evicted += 1
+
+    def record_wait(self, wait, timed_out):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            # Below 1 ms a connection was free, anything above was a real wait
+            if wait > 0.001:
+                self.waited += 1
+            self.wait_time += wait
+
+    def put_idle(self, conn):
+        with self.lock:
+            self.idle.append((conn, time.monotonic()))
+
+    # Close connections that have been idle for longer than idle_timeout.
+    # The oldest connections sit at the left end of the deque
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        stale = []
+        with self.lock:
+            while self.idle and self.idle[0][1] < deadline:
+                stale.append(self.idle.popleft()[0])
+            self.evicted += len(stale)
+        for conn in stale:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            conns = [conn for conn, _ in self.idle]
+            self.idle.clear()
+        for conn in conns:
+            conn.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "idle": len(self.idle),
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+                "waited": self.waited,
+                "timeouts": self.timeouts,
+                "wait_time": self.wait_time,
+            }
+
+# Per-backend pools of keep-alive HTTP/1.1 connections, shared by all threads.
+# max_connections bounds the open connections per backend: callers wait up to
+# pool_timeout seconds for a free one. Redirects are followed as requests
+# does (at most max_redirects, 303 and a redirected POST become a GET);
+# follow_redirects=False returns the 3xx response itself
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+class UpstreamPool:
+    def __init__(self, max_connections=10, idle_timeout=30, timeout=10, pool_timeout=5, headers=None,
+                 follow_redirects=True, max_redirects=30):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pool_timeout = pool_timeout
+        self.headers = headers or {}
+        self.follow_redirects = follow_redirects
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        self.backends = {}
+        self.reaper = None
+        self.stopped = threading.Event()
+
+    def backend_pool(self, key):
+        with self.lock:
+            pool = self.backends.get(key)
+            if pool is None:
+                pool = BackendPool(key, self.max_connections, self.idle_timeout, self.timeout)
+                self.backends[key] = pool
+            return pool
+
+    def get(self, url):
+        return self.request("GET", url)
+
+    # Send a request and read the whole body
+    def request(self, method, url, headers=None):
+        with self.open(url, method=method, headers=headers) as stream:
+            content = stream.read()
+        return UpstreamResponse(stream.url, stream.status, stream.reason, stream.headers, content)
+
+    # Send a request and return once the response headers have arrived; the
+    # body is read from the returned stream, which must be closed to give the
+    # connection back to the pool
+    def open(self, url, method="GET", headers=None):
+        stream = self.open_once(url, method, headers)
+        redirects = 0
+        while self.follow_redirects and stream.status in REDIRECT_STATUSES:
+            location = stream.response.getheader("Location")
+            if location is None:
+                break
+            # The body of a redirect is read so its connection can be reused
+            with stream:
+                stream.read()
+            redirects += 1
+            if redirects > self.max_redirects:
+                raise UpstreamError(f'Exceeded {self.max_redirects} redirects for url: {url}')
+            if stream.status == 303 and method != "HEAD" or stream.status in (301, 302) and method == "POST":
+                method = "GET"
+            stream = self.open_once(urljoin(stream.url, location), method, headers)
+        return stream
+
+    def open_once(self, url, method="GET", headers=None):
+        key, path = parse_url(url)
+        pool = self.backend_pool(key)
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
+
+        start = time.monotonic()
+        acquired = pool.slots.acquire(timeout=self.pool_timeout)
+        pool.record_wait(time.monotonic() - start, timed_out=not acquired)
+        if not acquired:
+            raise UpstreamError(f'Timed out waiting for a connection to {url}')
+        try:
+            conn = pool.take_idle()
+            reused = conn is not None
+            if conn is None:
+                conn = pool.new_connection()
+            try:
+                response = self.send(conn, method, path, request_headers)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                # A reused connection may have been closed by the backend just
+                # as we picked it up: retry once on a fresh connection
+                if not reused:
+                    raise UpstreamError(f'Error requesting {url}: {e}') from e
+                conn = pool.new_connection()
+                try:
+                    response = self.send(conn, method, path, request_headers)
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    raise UpstreamError(f'Error requesting {url}: {e}') from e
+        except BaseException:
+            pool.slots.release()
+            raise
+        return UpstreamStream(pool, conn, url, response)
+
+    def send(self, conn, method, path, headers):
+        conn.request(method, path, headers=headers)
+        return conn.getresponse()
+
+    # Close idle connections of every backend in the background
+    def start_reaper(self, interval=None):
+        if self.reaper is not None:
+            return
+        interval = interval or max(self.idle_timeout / 2, 1)
+
+        def reap():
+            while not self.stopped.wait(interval):
+                self.evict_idle()
+
+        self.reaper = threading.Thread(target=reap, name="upstream-reaper", daemon=True)
+        self.reaper.start()
+
+    def evict_idle(self):
+        with self.lock:
+            pools = list(self.backends.values())
+        for pool in pools:
+            pool.evict_idle()
+
+    def stats(self):
+        with self.lock:
+            pools = dict(self.backends)
+        return {f'{scheme}://{host}:{port}': pool.stats() for (scheme, host, port), pool in pools.items()}
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            pools = list(self.backends.values())
+            self.backends.clear()
+        for pool in pools:
+            pool.close()